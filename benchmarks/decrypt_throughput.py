@@ -0,0 +1,96 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Decrypt throughput: the old 4 KiB loop against crypt.decrypt_progress and crypt.decrypt_parallel.
+
+Usage: python benchmarks/decrypt_throughput.py [--size 512M] [--buffer-size 8M] [-j 4] [--dir DIR]
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+from Cryptodome.Cipher import AES
+from tqdm import tqdm
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from samloader import crypt  # noqa: E402
+from samloader import store  # noqa: E402
+
+KEY = bytes(range(16))
+
+
+def legacy_decrypt(inf, outf, key, length, pbar):
+    """ The loop decrypt_progress used before: 4 KiB reads, a new bytes object and a bar update per block. """
+    cipher = AES.new(key, AES.MODE_ECB)
+    chunks = (length + 4095) // 4096
+    for i in range(chunks):
+        block = inf.read(4096)
+        if not block:
+            break
+        decblock = cipher.decrypt(block)
+        outf.write(crypt.unpad(decblock) if i == chunks - 1 else decblock)
+        pbar.update(len(block))
+
+
+def make_input(path, size):
+    cipher = AES.new(KEY, AES.MODE_ECB)
+    chunk = 8 * 1024 * 1024
+    with open(path, "wb") as fh:
+        left = size
+        while True:
+            n = min(chunk, left)
+            data = os.urandom(n)
+            left -= n
+            if not left:
+                pad = 16 - n % 16
+                fh.write(cipher.encrypt(data + bytes([pad]) * pad))
+                return
+            fh.write(cipher.encrypt(data))
+
+
+def timed(label, size, fn):
+    start = time.perf_counter()
+    fn()
+    secs = time.perf_counter() - start
+    print(f"{label:<28} {size / secs / 1024 ** 2:8.1f} MiB/s  ({secs:.2f}s)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--size", default="512M", help="plaintext size (default: 512M)")
+    parser.add_argument("--buffer-size", default="8M", help="buffer for the new loops (default: 8M)")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count() or 1, help="threads for decrypt_parallel")
+    parser.add_argument("--dir", default=None, help="directory for the temporary files (default: system temp)")
+    args = parser.parse_args()
+    size = store.parse_size(args.size)
+    bufsize = store.parse_size(args.buffer_size)
+    with tempfile.TemporaryDirectory(dir=args.dir) as tmp:
+        enc = os.path.join(tmp, "input.enc4")
+        dec = os.path.join(tmp, "output.zip")
+        make_input(enc, size)
+        length = os.path.getsize(enc)
+        # Progress bars are drawn to /dev/null so their cost is counted but not shown
+        with open(os.devnull, "w") as null:
+            def legacy():
+                with open(enc, "rb") as inf, open(dec, "wb") as outf, tqdm(total=length, file=null) as pbar:
+                    legacy_decrypt(inf, outf, KEY, length, pbar)
+
+            def sequential():
+                with open(enc, "rb") as inf, open(dec, "wb") as outf, tqdm(total=length, file=null) as pbar:
+                    crypt.decrypt_progress(inf, outf, KEY, length, bufsize, pbar.update)
+
+            def parallel():
+                with tqdm(total=length, file=null) as pbar:
+                    crypt.decrypt_parallel(enc, dec, KEY, args.jobs, pbar.update, bufsize)
+
+            print(f"{length / 1024 ** 2:.0f} MiB, buffer {bufsize // 1024} KiB, {os.cpu_count()} CPUs")
+            timed("before: 4 KiB loop", length, legacy)
+            timed("after: decrypt_progress", length, sequential)
+            timed(f"after: decrypt_parallel -j {args.jobs}", length, parallel)
+
+
+if __name__ == "__main__":
+    main()
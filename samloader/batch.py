@@ -0,0 +1,236 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Download many model/region pairs from a manifest with one client and one connection budget. """
+
+import csv
+import json
+import os
+import queue
+import threading
+from dataclasses import dataclass
+from typing import List, Optional
+
+from tqdm import tqdm
+
+from . import downloader
+from . import imei
+from . import request
+from . import versionfetch
+
+
+@dataclass
+class Job:
+    """ One manifest entry; the remaining fields are filled in by resolve() and run(). """
+    model: str
+    region: str
+    imei: Optional[str] = None
+    version: Optional[str] = None
+    path: Optional[str] = None
+    filename: Optional[str] = None
+    size: int = 0
+    duplicate_of: Optional["Job"] = None
+    status: str = "pending"
+    error: Optional[str] = None
+    command: str = "download"  # lets imei.fixup_imei treat a Job like parsed arguments
+
+    @property
+    def dev_imei(self):
+        return self.imei
+
+    @dev_imei.setter
+    def dev_imei(self, value):
+        self.imei = value
+
+    @property
+    def dev_model(self):
+        return self.model
+
+    @property
+    def label(self) -> str:
+        return f"{self.model}/{self.region}"
+
+
+def load_manifest(path: str) -> List[Job]:
+    """ Read jobs from a JSON list (or {"jobs": [...]}) of objects, or a CSV file with a
+    header row. Columns/keys: model, region, and optionally imei and version
+    (default: the latest firmware). Raises ValueError for a malformed manifest. """
+    if path.lower().endswith(".csv"):
+        with open(path, "r", encoding="utf-8", newline="") as fh:
+            rows = [{(k or "").strip().lower(): (v or "").strip() for k, v in row.items()}
+                    for row in csv.DictReader(fh)]
+    else:
+        with open(path, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        rows = data.get("jobs") if isinstance(data, dict) else data
+        if not isinstance(rows, list) or not all(isinstance(r, dict) for r in rows):
+            raise ValueError("JSON manifest must be a list of objects (or {\"jobs\": [...]})")
+    jobs = []
+    for num, row in enumerate(rows, 1):
+        model = str(row.get("model") or "").strip()
+        region = str(row.get("region") or "").strip()
+        if not model or not region:
+            raise ValueError(f"manifest entry {num}: model and region are required")
+        jobs.append(Job(model.upper(), region.upper(), str(row.get("imei") or "").strip() or None,
+                        str(row.get("version") or "").strip() or None))
+    return jobs
+
+
+def resolve(client, jobs: List[Job], log=print):
+    """ Resolve every job to a server file with one client, and mark jobs that resolve
+    to a BINARY_NAME already claimed by an earlier job as duplicates of it.
+
+    Multi-CSC builds (OXM, EUX, ...) are served under the multi-CSC code for every
+    sales code (see request._effective_local_code), so pairs that map to the same
+    model/version/local code reuse the first BinaryInform answer.
+    """
+    from .main import getbinaryfile
+    answers = {}
+    owners = {}
+    for job in jobs:
+        try:
+            if imei.fixup_imei(job):
+                raise Exception("IMEI/serial missing or invalid")
+            ver = versionfetch.normalizevercode(job.version or versionfetch.getlatestver(job.model, job.region))
+            job.version = ver
+            key = (job.model, ver, request._effective_local_code(ver, job.region))
+            if key not in answers:
+                answers[key] = getbinaryfile(client, ver, job.model, job.imei, job.region)
+            job.path, job.filename, job.size = answers[key]
+        except Exception as e:
+            job.status = "failed"
+            job.error = str(e)
+            log(f"{job.label}: {e}")
+            continue
+        first = owners.setdefault(job.filename, job)
+        if first is not job:
+            job.duplicate_of = first
+            job.status = "duplicate"
+        log(f"{job.label}: {job.filename}" + (f" (same as {first.label})" if first is not job else ""))
+
+
+class _Progress:
+    """ A total progress bar plus one bar per running download, and an optional
+    progress.JsonLinesSink (which replaces the bars when it writes to stdout). """
+    def __init__(self, total: int, sink=None):
+        self.lock = threading.Lock()
+        self.sink = sink
+        self.quiet = sink is not None and sink.stdout
+        self.total = tqdm(total=total, unit="B", unit_scale=True, desc="total", position=0, disable=self.quiet)
+
+    def write(self, text: str):
+        if self.quiet:
+            return
+        with self.lock:
+            self.total.write(text)
+
+    def close(self):
+        self.total.close()
+
+
+class _JobEvents(downloader.DownloadEvents):
+    def __init__(self, board: _Progress, job: Job, slot: int):
+        self.board = board
+        self.job = job
+        self.slot = slot
+        self.bar = None
+        self.done = 0
+
+    def started(self, filename, size, done, resuming):
+        self.done = done
+        if self.board.sink is not None:
+            self.board.sink.event("start", file=filename, job=self.job.label, done=done, total=size,
+                                  resuming=resuming)
+        with self.board.lock:
+            self.board.total.update(done)
+            self.bar = tqdm(total=size, initial=done, unit="B", unit_scale=True, leave=False,
+                            desc=filename[:40], position=self.slot, disable=self.board.quiet)
+
+    def progress(self, n):
+        self.done += n
+        with self.board.lock:
+            self.bar.update(n)
+            self.board.total.update(n)
+        if self.board.sink is not None:
+            self.board.sink.progress(self.job.filename, n, self.done, self.job.size)
+
+    def message(self, text):
+        if self.board.sink is not None:
+            self.board.sink.event("message", file=self.job.filename, job=self.job.label, text=text)
+        self.board.write(f"{self.job.filename}: {text}")
+
+    def close(self):
+        if self.bar is not None:
+            with self.board.lock:
+                self.bar.close()
+        if self.board.sink is not None:
+            self.board.sink.event("end", file=self.job.filename, job=self.job.label, status=self.job.status,
+                                  error=self.job.error)
+
+
+def run(client, jobs: List[Job], out_dir: str, connections: int = 8, parallel: int = 2, retries: int = 10,
+        verify: bool = True, sync: str = "checkpoint", store=None, sink=None) -> bool:
+    """ Download every resolved, non-duplicate job into `out_dir`, `parallel` files at a
+    time, with at most `connections` connections in total. Connections are handed out
+    per range, so a job that finishes early frees its share for the others.
+    Finished files are skipped and partial ones resumed; with `store` (a
+    store.FirmwareStore) stored copies are linked instead of downloaded.
+    `sink` (a progress.JsonLinesSink) also receives start/progress/end records.
+    Returns True if all succeeded. """
+    todo = [j for j in jobs if j.status == "pending"]
+    os.makedirs(out_dir, exist_ok=True)
+    budget = threading.BoundedSemaphore(max(1, connections))
+    work = queue.Queue()
+    for job in todo:
+        work.put(job)
+    board = _Progress(sum(j.size for j in todo), sink)
+
+    def runner(slot):
+        while True:
+            try:
+                job = work.get_nowait()
+            except queue.Empty:
+                return
+            out = os.path.join(out_dir, job.filename)
+            events = _JobEvents(board, job, slot)
+            try:
+                result = downloader.download(client, job.path, job.filename, job.size, out, max(1, connections),
+                                             resume=True, retries=retries, verify=verify, sync=sync,
+                                             events=events, budget=budget, store=store)
+                job.status = "skipped" if result["skipped"] else "stored" if result["store"] else "ok"
+                if result["skipped"] or result["store"]:
+                    with board.lock:
+                        board.total.update(job.size)
+            except Exception as e:
+                job.status = "failed"
+                job.error = str(e)
+                board.write(f"{job.filename}: download failed: {e}")
+            finally:
+                events.close()
+
+    runners = [threading.Thread(target=runner, args=(i + 1,), daemon=True)
+               for i in range(max(1, min(parallel, len(todo))))]
+    for t in runners:
+        t.start()
+    try:
+        for t in runners:
+            while t.is_alive():
+                t.join(0.5)
+    finally:
+        board.close()
+    for job in jobs:
+        if job.duplicate_of is not None:
+            job.status = job.duplicate_of.status
+            job.error = job.duplicate_of.error
+    return all(j.status in ("ok", "skipped", "stored") for j in jobs)
+
+
+def summary(jobs: List[Job]) -> str:
+    """ One line per manifest entry. """
+    lines = []
+    for job in jobs:
+        what = job.filename or "-"
+        if job.duplicate_of is not None:
+            what += f" (shared with {job.duplicate_of.label})"
+        state = f"failed: {job.error}" if job.status == "failed" else job.status
+        lines.append(f"{job.label} {job.version or ''}: {what} [{state}]")
+    return "\n".join(lines)
@@ -0,0 +1,159 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" MD5 verification of downloaded firmware (inline while downloading, or after the fact). """
+
+import base64
+import hashlib
+import json
+import mmap
+import os
+import threading
+from typing import Optional
+
+MD5_SUFFIX = ".md5"
+READ_SIZE = 8 * 1024 * 1024  # 8 MiB
+
+_CACHE_PATH = os.path.join(os.path.expanduser("~"), ".samloader", "md5.json")
+
+
+def md5_from_header(resp) -> Optional[str]:
+    """ Expected MD5 (hex) from a FUS download response's Content-MD5 header, if any. """
+    value = resp.headers.get("Content-MD5") if resp is not None else None
+    if not value:
+        return None
+    try:
+        digest = base64.b64decode(value)
+    except Exception:
+        return None
+    return digest.hex() if len(digest) == 16 else None
+
+
+def save_expected(path: str, md5hex: str):
+    """ Remember the expected MD5 of `path`: an md5sum-style sidecar next to it and
+    an entry keyed by file name in ~/.samloader/md5.json. """
+    try:
+        with open(path + MD5_SUFFIX, "w", encoding="utf-8") as fh:
+            fh.write(f"{md5hex}  {os.path.basename(path)}\n")
+    except OSError:
+        pass
+    try:
+        os.makedirs(os.path.dirname(_CACHE_PATH), exist_ok=True)
+        try:
+            with open(_CACHE_PATH, "r", encoding="utf-8") as fh:
+                cache = json.load(fh) or {}
+        except Exception:
+            cache = {}
+        cache[os.path.basename(path)] = md5hex
+        with open(_CACHE_PATH, "w", encoding="utf-8") as fh:
+            json.dump(cache, fh, indent=2)
+    except Exception:
+        pass
+
+
+def load_expected(path: str) -> Optional[str]:
+    """ Look up a previously saved expected MD5 for `path` (sidecar first, then the cache). """
+    try:
+        with open(path + MD5_SUFFIX, "r", encoding="utf-8") as fh:
+            value = fh.read().split()
+        if value and len(value[0]) == 32:
+            return value[0].lower()
+    except OSError:
+        pass
+    try:
+        with open(_CACHE_PATH, "r", encoding="utf-8") as fh:
+            return (json.load(fh) or {}).get(os.path.basename(path))
+    except Exception:
+        return None
+
+
+def md5_file(path: str, progress=None) -> str:
+    """ MD5 of a whole file using an mmap (large buffered reads as a fallback). """
+    h = hashlib.md5()
+    size = os.path.getsize(path)
+    with open(path, "rb") as fh:
+        if size:
+            try:
+                with mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    view = memoryview(mm)
+                    try:
+                        for off in range(0, size, READ_SIZE):
+                            h.update(view[off:off + READ_SIZE])
+                            if progress:
+                                progress(min(READ_SIZE, size - off))
+                    finally:
+                        view.release()
+                return h.hexdigest()
+            except (OSError, ValueError):
+                fh.seek(0)
+                h = hashlib.md5()
+        buf = bytearray(READ_SIZE)
+        view = memoryview(buf)
+        while True:
+            n = fh.readinto(buf)
+            if not n:
+                break
+            h.update(view[:n])
+            if progress:
+                progress(n)
+    return h.hexdigest()
+
+
+class Md5Follower(threading.Thread):
+    """ Hash a file that is being written out of order by following the
+    contiguous prefix recorded in a RangeJournal.
+
+    The thread reads back each newly contiguous region with large reads into
+    one reusable buffer. When
+    `encrypt_key` is set the file holds plaintext of an AES-ECB payload, so the
+    bytes are re-encrypted (ECB is deterministic) to hash the server's bytes.
+    """
+    def __init__(self, path: str, jr, encrypt_key: bytes = None):
+        super().__init__(daemon=True)
+        self.path = path
+        self.jr = jr
+        self.size = jr.size
+        self.pos = 0
+        self.error = None
+        self._md5 = hashlib.md5()
+        self._cipher = None
+        if encrypt_key:
+            from Cryptodome.Cipher import AES
+            self._cipher = AES.new(encrypt_key, AES.MODE_ECB)
+        self._cancelled = threading.Event()
+
+    def watermark(self) -> int:
+        done = self.jr.done_ranges()
+        return done[0][1] + 1 if done and done[0][0] == 0 else 0
+
+    def run(self):
+        try:
+            # Unbuffered: read-ahead past the watermark would cache bytes not written yet
+            buf = memoryview(bytearray(READ_SIZE))
+            with open(self.path, "rb", buffering=0) as fh:
+                while self.pos < self.size:
+                    mark = self.watermark()
+                    if mark <= self.pos:
+                        if self._cancelled.wait(0.2):
+                            return
+                        continue
+                    fh.seek(self.pos)
+                    while self.pos < mark:
+                        n = fh.readinto(buf[:min(READ_SIZE, mark - self.pos)])
+                        if not n:
+                            raise Exception("short read while hashing")
+                        data = buf[:n]
+                        if self._cipher:
+                            self._cipher.encrypt(data, output=data)
+                        self._md5.update(data)
+                        self.pos += n
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self._cancelled.set()
+
+    def hexdigest(self) -> Optional[str]:
+        """ Final digest, or None if the whole file has not been hashed. """
+        if self.error is not None or self.pos != self.size:
+            return None
+        return self._md5.hexdigest()
@@ -4,21 +4,41 @@
 """ Calculate keys and decrypt encrypted firmware packages. """
 
 import hashlib
+import io
+import json
+import os
+import queue
+import threading
 import xml.etree.ElementTree as ET
 from Cryptodome.Cipher import AES
 from tqdm import tqdm
 
+from . import downloader
 from . import fusclient
+from . import journal
+from . import keystore
+from . import progress
 from . import request
 from . import versionfetch
+from . import writer
+
+DECRYPT_BUFFER = 8 * 1024 * 1024  # bytes read, decrypted in place and written per step
+PARALLEL_SEGMENT = 64 * 1024 * 1024  # unit of work handed to a decrypt thread
+INPLACE_CHUNK = 32 * 1024 * 1024  # in-place decryption: bytes overwritten per crash-safe step
+UNDO_SUFFIX = ".samundo"
 
 # PKCS#7 unpad
 unpad = lambda d: d[:-d[-1]]
 
-def getv4key(version, model, region, imei):
-    """ Retrieve the AES key for V4 encryption. """
-    client = fusclient.FUSClient()
+def getv4key(version, model, region, imei, keys=None):
+    """ Retrieve the AES key for V4 encryption: from the key store (`keys`,
+    default keystore.KeyStore()) if known there, else from FUS, storing it. """
     version = versionfetch.normalizevercode(version)
+    keys = keys or keystore.KeyStore()
+    known = keys.get(model, region, version)
+    if known:
+        return known
+    client = fusclient.FUSClient()
     req = request.binaryinform(version, model, region, imei, client.nonce)
     resp = client.makereq("NF_DownloadBinaryInform.do", req)
     try:
@@ -29,31 +49,319 @@ def getv4key(version, model, region, imei):
         print("Could not get decryption key from servers - bad model/region/imei?")
         return None
     deckey = request.getlogiccheck(fwver, logicval)
-    return hashlib.md5(deckey.encode()).digest()
+    key = hashlib.md5(deckey.encode()).digest()
+    try:
+        keys.put(model, region, version, key)
+    except OSError:
+        pass  # a read-only store only costs the next FUS round trip
+    return key
 
 def getv2key(version, model, region, _imei):
     """ Calculate the AES key for V2 (legacy) encryption. """
     deckey = region + ":" + model + ":" + version
     return hashlib.md5(deckey.encode()).digest()
 
-def decrypt_progress(inf, outf, key, length):
-    """ Decrypt a stream of data while showing a progress bar. """
+def _read_full(fh, view) -> int:
+    """ readinto() until `view` is full or the file ends. """
+    got = 0
+    while got < len(view):
+        n = fh.readinto(view[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+def decrypt_progress(inf, outf, key, length, bufsize=DECRYPT_BUFFER, progress_cb=None):
+    """ Decrypt a stream of data while showing a progress bar, or reporting to
+    `progress_cb(n)` instead. Data is read with readinto() into one reusable
+    buffer of `bufsize` bytes and decrypted in place. """
     cipher = AES.new(key, AES.MODE_ECB)
     if length % 16 != 0:
         raise Exception("invalid input block size")
-    # Number of 4096-byte chunks (ceil division)
-    chunks = (length + 4095) // 4096
-    pbar = tqdm(total=length, unit="B", unit_scale=True)
+    bufsize = max(16, bufsize - bufsize % 16)
+    view = memoryview(bytearray(min(bufsize, max(16, length))))
+    pbar = tqdm(total=length, unit="B", unit_scale=True) if progress_cb is None else None
+    report = progress_cb or pbar.update
+    done = 0
     try:
-        for i in range(chunks):
-            block = inf.read(4096)
-            if not block:
+        while done < length:
+            n = _read_full(inf, view[:min(len(view), length - done)])
+            if not n:
                 break
-            decblock = cipher.decrypt(block)
-            if i == chunks - 1:
-                outf.write(unpad(decblock))
-            else:
-                outf.write(decblock)
-            pbar.update(len(block))
+            if n % 16:
+                raise Exception("unexpected end of encrypted data")
+            block = view[:n]
+            cipher.decrypt(block, output=block)
+            done += n
+            outf.write(unpad(block) if done == length else block)
+            report(n)
+    finally:
+        if pbar is not None:
+            pbar.close()
+
+class DecryptReader(io.RawIOBase):
+    """ Read-only, seekable file object over the plaintext of encrypted file
+    object `fh` (`length` bytes), padding stripped: lets a consumer such as
+    zipstream pull decrypted data, and skip what it does not need without
+    decrypting it. `progress_cb(n)` gets the encrypted bytes consumed. """
+    def __init__(self, fh, key, length, progress_cb=None):
+        if length % 16 != 0 or not length:
+            raise Exception("invalid input block size")
+        self.fh = fh
+        self.length = length
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        self.progress_cb = progress_cb
+        fh.seek(length - 16)
+        last = self.cipher.decrypt(fh.read(16))
+        if not 1 <= last[-1] <= 16:
+            raise Exception("invalid padding (wrong key?)")
+        self.size = length - last[-1]
+        self.pos = 0
+        self._raw_pos = -1  # where `fh` is positioned, -1 if unknown
+        self._block = bytearray(16)
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def _read_at(self, pos: int, view) -> int:
+        if self._raw_pos != pos:
+            self.fh.seek(pos)
+        n = _read_full(self.fh, view)
+        self._raw_pos = pos + n
+        if n % 16:
+            raise Exception("unexpected end of encrypted data")
+        self.cipher.decrypt(view[:n], output=view[:n])
+        if self.progress_cb is not None:
+            self.progress_cb(n)
+        return n
+
+    def readinto(self, b) -> int:
+        view = memoryview(b).cast("B")
+        want = min(len(view), self.size - self.pos)
+        if want <= 0:
+            return 0
+        if self.pos % 16 == 0 and want >= 16:
+            # The usual case: whole blocks decrypted straight into the caller's buffer
+            n = self._read_at(self.pos, view[:want - want % 16])
+        else:
+            start = self.pos - self.pos % 16
+            self._read_at(start, memoryview(self._block))
+            skip = self.pos - start
+            n = min(want, 16 - skip)
+            view[:n] = self._block[skip:skip + n]
+        self.pos += n
+        return n
+
+def decrypt_parallel(inpath, outpath, key, jobs, progress_cb=None, bufsize=DECRYPT_BUFFER):
+    """ Decrypt file `inpath` to `outpath` with `jobs` threads, resumably.
+
+    AES-ECB blocks are independent, so the input is cut into aligned
+    PARALLEL_SEGMENT pieces that the threads decrypt (pycryptodome releases
+    the GIL) and write with positional writes into the preallocated output;
+    the PKCS#7 padding is stripped once everything is written. Each thread
+    uses one `bufsize` buffer. Written ranges reach the range journal
+    `<outpath>.samjournal` at fsync'ed checkpoints (writer.OutputWriter), so
+    calling this again after an interruption only decrypts what is missing.
+    `progress_cb(n)` receives coalesced byte counts from one publisher thread,
+    starting with the bytes an earlier run already did.
+    """
+    length = os.stat(inpath).st_size
+    if length % 16 != 0:
+        raise Exception("invalid input block size")
+    jpath = journal.journal_path(outpath)
+    jr = journal.RangeJournal.load(jpath, os.path.basename(inpath), length, "decrypt") \
+        if os.path.isfile(outpath) else None
+    if jr is None:
+        with open(outpath, "wb") as fd:
+            if not writer.preallocate(fd.fileno(), length):
+                fd.truncate(length)
+        jr = journal.RangeJournal.create(jpath, os.path.basename(inpath), length, mode="decrypt")
+    segments = queue.Queue()
+    for first, last in jr.missing():
+        for pos in range(first, last + 1, PARALLEL_SEGMENT):
+            segments.put((pos, min(last + 1, pos + PARALLEL_SEGMENT)))
+    bus = progress.ProgressBus(length)
+    if progress_cb is not None:
+        bus.subscribe(lambda delta, _done, _total: progress_cb(delta))
+        if jr.done_bytes():
+            progress_cb(jr.done_bytes())
+    bus.start()
+    wr = writer.OutputWriter(outpath, jr, sync="checkpoint")
+    errors = []
+    def worker():
+        cipher = AES.new(key, AES.MODE_ECB)
+        view = memoryview(bytearray(max(16, bufsize - bufsize % 16)))
+        try:
+            with open(inpath, "rb", buffering=0) as inf:
+                while not errors:
+                    try:
+                        pos, end = segments.get_nowait()
+                    except queue.Empty:
+                        return
+                    inf.seek(pos)
+                    while pos < end and not errors:
+                        n = _read_full(inf, view[:min(len(view), end - pos)])
+                        if n == 0 or n % 16:
+                            raise Exception(f"{inpath}: unexpected end of file")
+                        cipher.decrypt(view[:n], output=view[:n])
+                        wr.pwrite(view[:n], pos)
+                        wr.commit(pos, pos + n - 1)
+                        pos += n
+                        bus.add(n)
+        except Exception as e:
+            errors.append(e)
+    threads = [threading.Thread(target=worker, daemon=True) for _ in range(max(1, jobs))]
+    try:
+        for t in threads:
+            t.start()
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        # Let the threads stop, then checkpoint what they wrote
+        errors.append(Exception("interrupted"))
+        for t in threads:
+            t.join()
+        raise
+    finally:
+        wr.close()
+        jr.close()
+        bus.close()
+    if errors:
+        raise errors[0]
+    if not jr.complete():
+        raise Exception("decryption incomplete, run again to continue")
+    downloader.finish_decrypted(outpath, length)
+    jr.remove()
+
+def decrypted_name(path: str) -> str:
+    """ `path` without a trailing .enc2/.enc4 extension. """
+    return path[:-5] if path.lower().endswith((".enc2", ".enc4")) else path
+
+def _inplace_journal(path: str, size: int):
+    """ The in-place journal of `path` (now `size` bytes long), also when the padding
+    was already stripped (the original size is then the next multiple of 16). """
+    name = os.path.basename(path)
+    jpath = journal.journal_path(path)
+    for orig in (size, size + 16 - size % 16):
+        jr = journal.RangeJournal.load(jpath, name, orig, "inplace")
+        if jr is not None:
+            return jr
+    return None
+
+def inplace_pending(path: str) -> bool:
+    """ True if `path` is partly decrypted by an interrupted decrypt_in_place(). """
+    if not os.path.isfile(journal.journal_path(path)) or not os.path.isfile(path):
+        return False
+    jr = _inplace_journal(path, os.path.getsize(path))
+    if jr is None:
+        return False
+    jr.close()
+    return True
+
+def _save_undo(undo_path: str, offset: int, data):
+    with open(undo_path, "wb") as fh:
+        fh.write((json.dumps({"offset": offset, "length": len(data),
+                              "md5": hashlib.md5(data).hexdigest()}) + "\n").encode())
+        fh.write(data)
+        fh.flush()
+        os.fsync(fh.fileno())
+
+def _load_undo(undo_path: str):
+    """ (offset, ciphertext) of a complete undo record, or None. """
+    try:
+        with open(undo_path, "rb") as fh:
+            hdr = json.loads(fh.readline().decode())
+            data = fh.read()
+    except (OSError, ValueError):
+        return None
+    if not isinstance(hdr, dict) or len(data) != hdr.get("length") \
+            or hashlib.md5(data).hexdigest() != hdr.get("md5"):
+        return None  # torn write: the chunk it describes was never touched
+    return hdr["offset"], data
+
+def decrypt_in_place(path, key, out=None, progress_cb=None, chunk=INPLACE_CHUNK) -> str:
+    """ Decrypt `path` over itself, strip the padding and rename it to `out`
+    (default: decrypted_name(path)); returns the final path. Needs no second
+    copy of the file on disk.
+
+    Crash safety: before a chunk is overwritten its ciphertext is saved (and
+    fsync'ed) in `<path>.samundo`; once the plaintext is fsync'ed the chunk is
+    recorded in the range journal `<path>.samjournal`. Calling this again after
+    an interruption replays the chunk that was in flight from the undo record
+    and continues with the rest. `progress_cb(n)` is told about every chunk,
+    including the ones already done by an earlier run.
+    """
+    out = out or decrypted_name(path)
+    jpath = journal.journal_path(path)
+    undo_path = path + UNDO_SUFFIX
+    if not os.path.exists(path) and os.path.isfile(out) and os.path.isfile(jpath):
+        # Interrupted after the rename: only the bookkeeping is left
+        jr = _inplace_journal(path, os.path.getsize(out))
+        if jr is not None and jr.complete():
+            if os.path.exists(undo_path):
+                os.remove(undo_path)
+            jr.remove()
+            return out
+    st = os.stat(path)
+    if st.st_nlink > 1:
+        raise Exception(f"{path} has other hard links (e.g. in the firmware store); decrypting it in place "
+                        "would change them too. Copy it first or decrypt without --in-place.")
+    jr = _inplace_journal(path, st.st_size)
+    if jr is None:
+        if st.st_size % 16 != 0:
+            raise Exception("invalid input block size")
+        jr = journal.RangeJournal.create(jpath, os.path.basename(path), st.st_size, mode="inplace")
+    size = jr.size
+    cipher = AES.new(key, AES.MODE_ECB)
+    try:
+        with open(path, "r+b", buffering=0) as fh:
+            def overwrite(offset, view):
+                cipher.decrypt(view, output=view)
+                fh.seek(offset)
+                fh.write(view)
+                os.fsync(fh.fileno())
+                jr.commit(offset, offset + len(view) - 1)
+            undo = _load_undo(undo_path)
+            if undo is not None:
+                offset, data = undo
+                last = offset + len(data) - 1
+                if data and any(a <= last and offset <= b for a, b in jr.missing()):
+                    # The chunk in flight may be half plaintext: write it again from the saved ciphertext
+                    overwrite(offset, memoryview(bytearray(data)))
+            if progress_cb is not None and jr.done_bytes():
+                progress_cb(jr.done_bytes())
+            buf = memoryview(bytearray(min(chunk, max(16, size))))
+            for first, last in jr.missing():
+                pos = first
+                while pos <= last:
+                    n = min(len(buf), last - pos + 1)
+                    view = buf[:n]
+                    fh.seek(pos)
+                    if _read_full(fh, view) != n:
+                        raise Exception(f"{path}: unexpected end of file")
+                    _save_undo(undo_path, pos, view)
+                    overwrite(pos, view)
+                    pos += n
+                    if progress_cb is not None:
+                        progress_cb(n)
     finally:
-        pbar.close()
+        jr.close()
+    downloader.finish_decrypted(path, size)
+    os.replace(path, out)
+    # The journal goes last: while it exists, a rerun knows the rename already happened
+    if os.path.exists(undo_path):
+        os.remove(undo_path)
+    jr.remove()
+    return out
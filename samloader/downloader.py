@@ -0,0 +1,483 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Download engine shared by the CLI (download, checkupdate), the GUI and embedding code.
+
+Typical use::
+
+    client = fusclient.FUSClient()
+    path, filename, size = main.getbinaryfile(client, fw, model, imei, region)
+    result = downloader.download(client, path, filename, size, out, threads="auto", resume=True,
+                                 events=MyEvents())
+"""
+
+import hashlib
+import os
+import threading
+import time
+
+from Cryptodome.Cipher import AES
+
+from . import checksum
+from . import fusclient
+from . import journal
+from . import progress
+from . import ratelimit
+from . import request
+from . import segments
+from . import writer
+
+RECV_SIZE = 0x10000  # bytes asked of the socket per read (progress, rate limit and range claims follow it)
+
+
+class DownloadEvents:
+    """ Callbacks from download(); override the ones you need.
+    progress() is called from a publisher thread with the bytes written since its
+    last call, at most progress.PUBLISH_HZ times a second; the others are called
+    from the calling thread. """
+    def started(self, filename: str, size: int, done: int, resuming: bool):
+        """ The transfer begins; `done` bytes are already on disk. """
+    def progress(self, n: int):
+        """ `n` more bytes were written. """
+    def md5(self, expected: str):
+        """ The server's expected MD5 is known. """
+    def message(self, text: str):
+        """ An informational line (verification result, connection count, ...). """
+
+
+def download(client, path, filename, size, out, threads=1, resume=False, retries=10, hedge=False, verify=True,
+             key=None, sync="checkpoint", events=None, budget=None, store=None) -> dict:
+    """ Download server file `path`+`filename` (`size` bytes) to `out`.
+
+    `threads` is a connection count or "auto". With `resume`, a journaled
+    segmented download or a plain partial file is continued. With `key`, the
+    AES key of an .enc2/.enc4 file, `out` receives the decrypted data (see
+    download_segmented). The data is checked against the server's MD5 unless
+    `verify` is false, and the expected MD5 is saved next to `out` (not with
+    `key`: it is the MD5 of the encrypted file). `budget`
+    is a connection semaphore shared with concurrent downloads. With `store`
+    (a store.FirmwareStore), a stored copy is linked to `out` without
+    contacting the server, and a verified download is added to the store.
+    Raises on failure; the result dict has "skipped" (already complete),
+    "md5" and the statistics returned by download_segmented.
+    """
+    events = events or DownloadEvents()
+    mode = "dec" if key else "raw"
+    jpath = journal.journal_path(out)
+    resume = bool(resume) and os.path.exists(out)
+    jr_exists = resume and os.path.isfile(jpath)
+    done = os.stat(out).st_size if resume and not key else 0
+    if jr_exists:
+        # The output is preallocated; the journal knows how much is really there
+        jr = journal.RangeJournal.load(jpath, filename, size, mode)
+        if jr is None:
+            # Journal belongs to another download: start over
+            resume = jr_exists = False
+            done = 0
+        elif jr.complete() and not key:
+            jr.remove()
+            done = size
+        else:
+            done = jr.done_bytes()
+            jr.close()
+    result = {"skipped": False, "md5": None, "threads": threads, "peak": threads, "steals": 0, "hedges": 0,
+              "writes": 0, "fsyncs": 0, "store": None}
+    if store is not None and not key and done != size:
+        hit = store.lookup(filename, size)
+        if hit is not None:
+            if jr_exists:
+                journal.RangeJournal(jpath, filename, size).remove()
+            result["store"] = store.materialize(hit, out)
+            result["md5"] = hit["md5"]
+            checksum.save_expected(out, hit["md5"])
+            events.message(f"{filename}: taken from the local store ({result['store']})")
+            return result
+    if done == size and not key:
+        result["skipped"] = True
+        return result
+    if not resume and os.path.isfile(out) and os.stat(out).st_nlink > 1:
+        # Shared with the store (a hardlink): replace the file instead of truncating it
+        os.remove(out)
+    writer.check_free_space([(out, writer.space_needed(out, size))])
+    events.started(filename, size, done, resume)
+    # Workers only bump per-thread counters; events.progress sees coalesced totals
+    bus = progress.ProgressBus(size, done)
+    bus.subscribe(lambda delta, _done, _total: events.progress(delta))
+    bus.start()
+    try:
+        initdownload(client, filename)
+        if key or budget is not None or threads == "auto" or threads > 1 or jr_exists:
+            md5 = fetch_expected_md5(client, path, filename)
+            if md5:
+                events.md5(md5)
+            jr = open_segmented(out, filename, size, resume, mode)
+            used = download_segmented(client, path, filename, out, jr, threads, retries, bus.add,
+                                      hedge=hedge, key=key, md5=md5 if verify else None, sync=sync, budget=budget)
+            result.update(used)
+            verified = bool(md5 and verify)
+        else:
+            md5, verified, io = _download_single(client, path, filename, size, out, done, retries, verify, sync,
+                                                 events, bus.add)
+            result.update(threads=1, peak=1, writes=io[0], fsyncs=io[1])
+    finally:
+        bus.close()
+    if threads == "auto":
+        events.message(f"auto: settled on {result['threads']} connections (peak {result['peak']})")
+    result["md5"] = md5
+    if verified:
+        events.message(f"MD5 verified: {md5}")
+    if md5 and verify and not key:
+        checksum.save_expected(out, md5)
+    if store is not None and not key:
+        if not verified:
+            # The store is matched on name and size alone, so it only takes checked files
+            events.message(f"{filename} was not verified against the server's MD5, not adding it to the local store")
+        else:
+            try:
+                store.add(out, filename, size, md5)
+            except OSError as e:
+                events.message(f"could not add {filename} to the local store: {e}")
+    return result
+
+
+def _download_single(client, path, filename, size, out, pos, retries, verify, sync, events, progress):
+    """ One sequential stream from `pos`, continued after errors; `progress(n)` is
+    called per chunk.
+    Returns (expected md5, whether it was verified, (writes, fsyncs)). """
+    if not pos:
+        # Start fresh: truncate file to zero to avoid mixing with old partials
+        with open(out, "wb"):
+            pass
+        try:
+            os.remove(journal.journal_path(out))
+        except FileNotFoundError:
+            pass
+    attempts = 0
+    backoff = 1
+    md5 = None
+    md5_known = False
+    # Hash bytes as they land; a resumed prefix is hashed from disk first
+    hasher = hashlib.md5() if verify else None
+    hashed = 0
+    wr = writer.OutputWriter(out, None, sync)
+    try:
+        while pos < size:
+            try:
+                if hasher is not None and hashed != pos:
+                    hashed = _md5_catch_up(hasher, out, hashed, pos)
+                    if hashed != pos:
+                        hasher = None
+                r = client.downloadfile(path + filename, pos)
+                if not md5_known:
+                    md5 = checksum.md5_from_header(r)
+                    if md5:
+                        events.md5(md5)
+                    md5_known = True
+                body = fusclient.BodyReader(r)
+                buf = wr.buffer(pos)
+                try:
+                    while True:
+                        space = buf.space()[:RECV_SIZE]
+                        n = body.readinto(space)
+                        if not n:
+                            break
+                        ratelimit.throttle(n)
+                        if hasher is not None:
+                            hasher.update(space[:n])
+                            hashed += n
+                        buf.advance(n)
+                        progress(n)
+                finally:
+                    # Continue from what actually reached the file
+                    r.close()
+                    buf.close()
+                    wr.commit(pos, buf.offset - 1)
+                    pos = buf.offset
+                # Successful stream; reset attempts and backoff for next loop (if any)
+                attempts = 0
+                backoff = 1
+            except Exception as e:
+                attempts += 1
+                if attempts > retries:
+                    raise Exception(f"failed after {retries} retries: {e}")
+                time.sleep(min(60, backoff))
+                backoff *= 2
+    finally:
+        wr.close()
+    verified = bool(md5) and hasher is not None and hashed == size
+    if verified and hasher.hexdigest() != md5:
+        # A full-size file would look complete to --resume: drop it so the next run fetches it again
+        os.remove(out)
+        raise Exception(f"MD5 mismatch for {out}: expected {md5}, got {hasher.hexdigest()}. "
+                        "The corrupt file was removed; run again to re-download it.")
+    return md5, verified, (wr.writes, wr.fsyncs)
+
+
+def initdownload(client, filename):
+    req = request.binaryinit(filename, client.nonce)
+    client.makereq("NF_DownloadBinaryInitForMass.do", req)
+
+
+def open_segmented(out, filename, size, resume, mode="raw"):
+    """ Prepare `out` for a segmented download and return its range journal.
+    When resuming, a valid journal is reused; a plain partial file (from a
+    single-threaded run) seeds the journal with its contiguous prefix.
+    `mode` is "dec" when `out` receives decrypted data (see download_segmented).
+    """
+    jpath = journal.journal_path(out)
+    if resume:
+        jr = journal.RangeJournal.load(jpath, filename, size, mode)
+        if jr is not None:
+            if not jr.complete():
+                with open(out, "r+b") as fd:
+                    fd.truncate(size)
+                    writer.preallocate(fd.fileno(), size)
+            return jr
+        try:
+            have = min(os.stat(out).st_size, size)
+        except FileNotFoundError:
+            have = 0
+        # Only a plain partial (no journal at all) can be trusted as a prefix
+        if have > 0 and mode == "raw" and not os.path.exists(jpath):
+            with open(out, "r+b") as fd:
+                fd.truncate(size)
+                writer.preallocate(fd.fileno(), size)
+                fd.flush()
+                os.fsync(fd.fileno())
+            return journal.RangeJournal.create(jpath, filename, size, [(0, have - 1)])
+    # Preallocate file: real blocks where the OS can, else a sparse file of the right size
+    with open(out, "wb") as fd:
+        if not writer.preallocate(fd.fileno(), size):
+            try:
+                fd.truncate(size)
+            except OSError:
+                # Fallback preallocation method
+                if size > 0:
+                    fd.seek(size - 1)
+                    fd.write(b"\0")
+    return journal.RangeJournal.create(jpath, filename, size, mode=mode)
+
+
+def finish_decrypted(out, size):
+    """ Strip the PKCS#7 padding from a fully written plaintext file.
+    Safe to call again after a crash: an already trimmed file is left alone. """
+    with open(out, "r+b") as fd:
+        fd.seek(0, os.SEEK_END)
+        if fd.tell() != size or size < 16:
+            return
+        fd.seek(size - 1)
+        pad = fd.read(1)[0]
+        if not 1 <= pad <= 16:
+            raise Exception("invalid padding in decrypted output (wrong key?)")
+        fd.truncate(size - pad)
+        fd.flush()
+        os.fsync(fd.fileno())
+
+
+def fetch_expected_md5(client, path, filename):
+    """ Expected MD5 (hex) of a server file, read from the headers of a 1-byte range request. """
+    try:
+        rhead = client.downloadfile(path + filename, 0, 0)
+        try:
+            return checksum.md5_from_header(rhead)
+        finally:
+            rhead.close()
+    except Exception:
+        return None
+
+
+def _md5_catch_up(hasher, out, start, end):
+    """ Feed bytes [start, end) of `out` into `hasher`; returns the new hashed offset. """
+    with open(out, "rb") as fd:
+        fd.seek(start)
+        while start < end:
+            data = fd.read(min(checksum.READ_SIZE, end - start))
+            if not data:
+                break
+            hasher.update(data)
+            start += len(data)
+    return start
+
+
+def download_segmented(client, path, filename, out, jr, threads, retries, progress=None, hedge=False, key=None, md5=None,
+                       sync="checkpoint", budget=None, on_write=None):
+    """ Download the ranges still missing from journal `jr` into `out` using
+    `threads` ranged connections, or "auto" to let an AIMD controller pick the
+    connection count and range size from measured throughput.
+    All workers share one OutputWriter (positional, coalesced writes); `sync`
+    picks when written ranges are fsync'ed and journaled ("always",
+    "checkpoint" or "none"), so an interrupted run (even SIGKILL) can be
+    resumed with all threads. Idle workers steal the tail of the largest range
+    still in flight; `hedge` also lets them take over ranges that have stalled.
+    With `key`, each worker decrypts its range in memory (AES-ECB blocks are
+    independent) and `out` receives plaintext at the same offsets; the padding
+    is stripped once everything is there. With `md5`, a hashing thread follows
+    the contiguous written prefix and the result is checked before finishing;
+    on a mismatch the journal is reset so --resume fetches the file again.
+    `budget` is a semaphore shared with other downloads (see batch): each
+    worker holds one of its slots per range, capping their total connections.
+    `on_write(offset, n)` is passed to the OutputWriter (see serve).
+    The journal is removed on success; errors are raised.
+    Returns {"threads": final connection count, "peak": highest count used,
+    "steals": ranges split, "hedges": stalled ranges taken over,
+    "writes": write syscalls, "fsyncs": fsync calls}.
+    """
+    if key and jr.size % 16 != 0:
+        raise Exception("invalid input block size")
+    sched = segments.RangeScheduler(jr.missing(), hedge=hedge)
+    wr = writer.OutputWriter(out, jr, sync, on_write)
+    follower = None
+    if md5:
+        follower = checksum.Md5Follower(out, jr, encrypt_key=key)
+        follower.start()
+    ctrl = segments.AimdController() if threads == "auto" else None
+    max_workers = ctrl.max_conns if ctrl else max(1, int(threads))
+    stop_event = threading.Event()
+    errors = []
+    def chunk_len():
+        remaining = sched.remaining()
+        if ctrl is None:
+            return segments.fixed_chunk_size(remaining, max_workers)
+        # Keep the tail balanced across the current connection count
+        share = max(segments.MIN_CHUNK, remaining // max(1, ctrl.target * 2))
+        return min(ctrl.chunk_size(), share)
+    def run_task(task):
+        """ Download one task; False once retries are exhausted (the download is stopped). """
+        pos = task.pos
+        attempts = 0
+        backoff = 1
+        cipher = AES.new(key, AES.MODE_ECB) if key else None
+        # task.en shrinks when an idle worker steals the tail of this range
+        while pos <= sched.end_of(task) and not stop_event.is_set():
+            seg = pos
+            carry = 0
+            try:
+                r = client.downloadfile(path + filename, pos, sched.end_of(task))
+                body = fusclient.BodyReader(r)
+                buf = wr.buffer(pos)
+                try:
+                    while not stop_event.is_set():
+                        # Received straight into the pooled buffer; the first `carry`
+                        # bytes are an incomplete AES block left by the previous read
+                        space = buf.space()
+                        got = body.readinto(space[carry:carry + RECV_SIZE])
+                        if not got:
+                            break
+                        ratelimit.throttle(got)
+                        usable = carry + got
+                        if cipher is not None:
+                            # Only whole AES blocks are decrypted (in place) and written
+                            carry = usable % 16
+                            usable -= carry
+                        n = sched.claim(task, usable)
+                        if n:
+                            if cipher is not None:
+                                cipher.decrypt(space[:n], output=space[:n])
+                            buf.advance(n)
+                            pos += n
+                            if ctrl is not None:
+                                ctrl.add(n)
+                            if progress:
+                                progress(n)
+                        if n < usable:
+                            break
+                finally:
+                    # Journal whatever was written, even on a broken stream
+                    r.close()
+                    buf.close()
+                    wr.commit(seg, pos - 1)
+                attempts = 0
+                backoff = 1
+            except Exception as e:
+                attempts += 1
+                if ctrl is not None:
+                    ctrl.error()
+                if attempts > retries:
+                    errors.append(e)
+                    stop_event.set()
+                    return False
+                time.sleep(min(60, backoff))
+                backoff = min(60, backoff * 2)
+        sched.finish(task)
+        return True
+    def dl_worker(idx):
+        while not stop_event.is_set():
+            if ctrl is not None and idx >= ctrl.target:
+                # Parked by the controller; leave once nothing is left to take
+                if sched.empty():
+                    return
+                time.sleep(0.2)
+                continue
+            # A connection from the shared budget is held for the whole task
+            if budget is not None:
+                budget.acquire()
+            try:
+                task = sched.take(chunk_len())
+                if task is not None and not run_task(task):
+                    return
+            finally:
+                if budget is not None:
+                    budget.release()
+            if task is None:
+                if hedge and sched.busy():
+                    # Stay around: a range still in flight may stall and need hedging
+                    time.sleep(0.5)
+                    continue
+                return
+    tlist = []
+    def spawn(n):
+        # Worker slots 0..n-1; a worker that ran out of work and exited is replaced
+        for idx in range(n):
+            if idx < len(tlist) and tlist[idx].is_alive():
+                continue
+            t = threading.Thread(target=dl_worker, args=(idx,), daemon=True)
+            t.start()
+            if idx < len(tlist):
+                tlist[idx] = t
+            else:
+                tlist.append(t)
+    spawn(ctrl.target if ctrl else max_workers)
+    try:
+        while True:
+            alive = [t for t in tlist if t.is_alive()]
+            if not alive:
+                break
+            alive[0].join(0.5)
+            if ctrl is not None and ctrl.tick() and not sched.empty():
+                spawn(ctrl.target)
+    except KeyboardInterrupt:
+        # Let workers journal their in-flight ranges before bailing out
+        stop_event.set()
+        for t in tlist:
+            t.join()
+        wr.close()
+        if follower is not None:
+            follower.cancel()
+        jr.close()
+        raise
+    wr.close()
+    if errors or not jr.complete():
+        if follower is not None:
+            follower.cancel()
+        jr.close()
+        if errors:
+            raise errors[0]
+        raise Exception("download incomplete, run again with --resume")
+    if follower is not None:
+        follower.join()
+        got = follower.hexdigest()
+        if got is None:
+            jr.close()
+            raise Exception(f"could not verify MD5: {follower.error}")
+        if got != md5:
+            # Nothing tells which range is bad: start the whole file over on --resume
+            jr.close()
+            journal.RangeJournal.create(jr.path, jr.filename, jr.size, mode=jr.mode).close()
+            raise Exception(f"MD5 mismatch: expected {md5}, got {got}; run again with --resume to re-download")
+    if key:
+        finish_decrypted(out, jr.size)
+    jr.remove()
+    used = {"threads": max_workers, "peak": max_workers, "steals": sched.steals, "hedges": sched.hedges,
+            "writes": wr.writes, "fsyncs": wr.fsyncs}
+    if ctrl is not None:
+        used.update(threads=ctrl.target, peak=ctrl.peak)
+    return used
@@ -3,24 +3,137 @@
 
 """ FUS request helper (automatically sign requests and update tokens) """
 
+import threading
+from http.cookiejar import DefaultCookiePolicy
+from typing import Dict
+
 import requests
+from requests.adapters import HTTPAdapter
 
 from . import auth
 
+FUS_URL = "https://neofussvr.sslcs.cdngc.net/"
+CLOUD_URL = "http://cloud-neofussvr.samsungmobile.com/"
+
+DEFAULT_POOL_SIZE = 10
+
+# Process-wide keep-alive sessions, one per host, shared by every FUSClient
+_sessions: Dict[str, requests.Session] = {}
+_adapters: Dict[str, list] = {}
+_sessions_lock = threading.Lock()
+
+def _session(base: str, pool_size: int) -> requests.Session:
+    """ Return the pooled session for `base`, growing its pool to `pool_size` if needed. """
+    with _sessions_lock:
+        sess = _sessions.get(base)
+        if sess is None:
+            sess = requests.Session()
+            # Cookies are passed explicitly per client; never let one client's
+            # JSESSIONID leak into another through the shared jar.
+            sess.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+            _sessions[base] = sess
+            _adapters[base] = []
+        adapters = _adapters[base]
+        if not adapters or adapters[-1][1] < pool_size:
+            # Older adapters are not closed: other clients may have requests in
+            # flight on them. New requests use the larger pool; the old ones are
+            # kept for their statistics.
+            adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size)
+            sess.mount(base, adapter)
+            adapters.append((adapter, pool_size))
+        return sess
+
+def connection_stats() -> Dict[str, Dict[str, int]]:
+    """ Per-host HTTP statistics: requests sent, TCP/TLS connections opened, requests served on a reused connection. """
+    stats = {}
+    with _sessions_lock:
+        for base, adapters in _adapters.items():
+            reqs = conns = 0
+            for adapter, _ in adapters:
+                pools = adapter.poolmanager.pools
+                for key in list(pools.keys()):
+                    pool = pools.get(key)
+                    if pool is None:
+                        continue
+                    reqs += pool.num_requests
+                    conns += pool.num_connections
+            stats[base] = {"requests": reqs, "connections": conns, "reused": max(0, reqs - conns)}
+    return stats
+
+def format_connection_stats() -> str:
+    """ One line per host summarizing connection reuse. """
+    lines = []
+    for base, st in connection_stats().items():
+        lines.append(f"{base}: {st['requests']} requests over {st['connections']} connections ({st['reused']} reused)")
+    return "\n".join(lines)
+
+class BodyReader:
+    """ Reads a streamed response body straight into caller-provided buffers.
+
+    iter_content() hands out a new bytes object per chunk. For an uncompressed
+    body this reads from the http.client response underneath instead, so data
+    goes from the socket buffer into the caller's buffer, and the connection is
+    handed back to the pool once the body has been read to the end. Anything
+    else falls back to iter_content() plus a copy.
+    """
+    def __init__(self, r: requests.Response, chunk_size: int = 0x10000):
+        self.r = r
+        fp = getattr(getattr(r, "raw", None), "_fp", None)
+        encoding = r.headers.get("Content-Encoding", "").strip().lower()
+        self._fp = fp if hasattr(fp, "readinto") and encoding in ("", "identity") else None
+        self._chunks = r.iter_content(chunk_size=chunk_size) if self._fp is None else None
+        self._pending = memoryview(b"")
+
+    def readinto(self, view) -> int:
+        """ Read up to len(view) bytes into `view`; 0 once the body is exhausted.
+        Raises if the connection closed before the announced length. """
+        if self._fp is not None:
+            n = self._fp.readinto(view)
+            if not n and len(view):
+                self._finished()
+            return n
+        while not len(self._pending):
+            chunk = next(self._chunks, None)
+            if chunk is None:
+                return 0
+            self._pending = memoryview(chunk)
+        n = min(len(view), len(self._pending))
+        view[:n] = self._pending[:n]
+        self._pending = self._pending[n:]
+        return n
+
+    def _finished(self):
+        left = getattr(self._fp, "length", None)
+        if left:
+            raise Exception(f"connection closed with {left} bytes of the response left")
+        if self._fp.isclosed():
+            # Read to the end: the connection can serve the next range
+            self.r.raw.release_conn()
+
 class FUSClient:
-    """ FUS API client. """
-    def __init__(self):
+    """ FUS API client. With `mirror` (the URL of a `samloader serve` instance),
+    firmware data is fetched from the mirror instead of the FUS cloud host. """
+    def __init__(self, pool_size: int = DEFAULT_POOL_SIZE, mirror: str = None):
         self.auth = ""
         self.sessid = ""
+        self.pool_size = max(1, int(pool_size))
+        # Serializes handshakes: concurrent jobs (batch) share one client and its nonce
+        self._lock = threading.Lock()
+        self.session = _session(FUS_URL, self.pool_size)
+        self.cloud_url = mirror.rstrip("/") + "/" if mirror else CLOUD_URL
+        self.cloud_session = _session(self.cloud_url, self.pool_size)
         self.makereq("NF_DownloadGenerateNonce.do") # initialize nonce
     def makereq(self, path: str, data: str = "") -> str:
         """ Make a FUS request to a given endpoint with retry and 5s timeout per attempt. """
+        with self._lock:
+            return self._makereq(path, data)
+    def _makereq(self, path: str, data: str) -> str:
         authv = 'FUS nonce="", signature="' + self.auth + '", nc="", type="", realm="", newauth="1"'
         last_err = None
         for attempt in range(5):
             try:
-                req = requests.post(
-                    "https://neofussvr.sslcs.cdngc.net/" + path,
+                req = self.session.post(
+                    FUS_URL + path,
                     data=data,
                     headers={"Authorization": authv, "User-Agent": "Kies2.0_FUS"},
                     cookies={"JSESSIONID": self.sessid},
@@ -45,6 +158,8 @@ class FUSClient:
     def downloadfile(self, filename: str, start: int = 0, end=None) -> requests.Response:
         """ Make a FUS cloud request to download a given file (optionally a byte range).
         If 'end' is provided, the Range header will be 'bytes=start-end' (inclusive). Retries with 5s timeout.
+        The response is streamed from a pooled keep-alive connection: read it to the end
+        (or close it) to hand the connection back to the pool.
         """
         # In a cloud request, we also need to pass the server nonce.
         authv = 'FUS nonce="' + self.encnonce + '", signature="' + self.auth \
@@ -58,8 +173,8 @@ class FUSClient:
         last_err = None
         for attempt in range(5):
             try:
-                req = requests.get(
-                    "http://cloud-neofussvr.samsungmobile.com/NF_DownloadBinaryForMass.do",
+                req = self.cloud_session.get(
+                    self.cloud_url + "NF_DownloadBinaryForMass.do",
                     params="file=" + filename,
                     headers=headers,
                     stream=True,
@@ -73,3 +188,6 @@ class FUSClient:
                     continue
                 break
         raise last_err if last_err else Exception("FUS download request failed")
+    def stats(self) -> Dict[str, Dict[str, int]]:
+        """ Connection reuse statistics of the shared pools. """
+        return connection_stats()
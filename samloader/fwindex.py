@@ -0,0 +1,216 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Content index of a firmware bundle, for `samloader extract`.
+
+The index lists every zip member (data offset, sizes, CRC32, compression) and
+every entry of the tar archives stored in it (AP_*.tar.md5 and friends) with
+its absolute offset in the decrypted zip. It is built once and kept next to
+the bundle as `<file>.samindex`, so extracting one image seeks straight to its
+bytes; for .enc2/.enc4 bundles only the AES blocks that are read get decrypted.
+"""
+
+import io
+import json
+import os
+import tarfile
+import zipfile
+from typing import List, Optional
+
+from . import crypt
+from . import zipstream
+
+INDEX_SUFFIX = ".samindex"
+INDEX_VERSION = 1
+SEEK_BUFFER = 0x10000  # read-ahead while indexing: headers are small and far apart
+COPY_CHUNK = 8 * 1024 * 1024
+NESTED = (".tar", ".tar.md5")
+
+
+def index_path(path: str) -> str:
+    return path + INDEX_SUFFIX
+
+
+def is_encrypted(path: str) -> bool:
+    return path.lower().endswith((".enc2", ".enc4"))
+
+
+def open_payload(path: str, key: Optional[bytes] = None, bufsize: int = SEEK_BUFFER):
+    """ A seekable binary file object over the plaintext of `path` (decrypting with `key` for .enc2/.enc4). """
+    if not is_encrypted(path):
+        return open(path, "rb", buffering=bufsize)
+    if key is None:
+        raise Exception(f"{path} is encrypted: the decryption key is needed")
+    raw = open(path, "rb", buffering=0)
+    try:
+        return io.BufferedReader(crypt.DecryptReader(raw, key, os.fstat(raw.fileno()).st_size), bufsize)
+    except Exception:
+        raw.close()
+        raise
+
+
+class _Window(io.RawIOBase):
+    """ Bytes [start, start + size) of seekable `fh`, as a file of its own (for tarfile). """
+    def __init__(self, fh, start: int, size: int):
+        self.fh = fh
+        self.start = start
+        self.size = size
+        self.pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.pos
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        base = {os.SEEK_SET: 0, os.SEEK_CUR: self.pos, os.SEEK_END: self.size}[whence]
+        self.pos = max(0, base + offset)
+        return self.pos
+
+    def readinto(self, b) -> int:
+        n = min(len(b), self.size - self.pos)
+        if n <= 0:
+            return 0
+        self.fh.seek(self.start + self.pos)
+        n = self.fh.readinto(memoryview(b)[:n])
+        self.pos += n
+        return n
+
+
+def _tar_entries(fh, start: int, size: int, prefix: str) -> List[dict]:
+    entries = []
+    try:
+        with tarfile.open(fileobj=_Window(fh, start, size), mode="r:") as tar:
+            for ti in tar:
+                if ti.isfile():
+                    entries.append({"name": prefix + ti.name, "path": ti.name, "offset": start + ti.offset_data,
+                                    "size": ti.size})
+    except tarfile.TarError:
+        pass  # not a tar after all: index the member alone
+    return entries
+
+
+def build(fh) -> dict:
+    """ Index the plaintext bundle readable from seekable `fh`: a zip (with nested
+    tars indexed when stored uncompressed) or a single tar. """
+    index = {"members": [], "entries": []}
+    fh.seek(0)
+    if not zipfile.is_zipfile(fh):
+        fh.seek(0, os.SEEK_END)
+        index["entries"] = _tar_entries(fh, 0, fh.tell(), "")
+        return index
+    fh.seek(0)
+    with zipfile.ZipFile(fh) as z:
+        infos = z.infolist()
+    for info in infos:
+        if info.is_dir():
+            continue
+        fh.seek(info.header_offset + 26)
+        nlen, elen = int.from_bytes(fh.read(2), "little"), int.from_bytes(fh.read(2), "little")
+        data = info.header_offset + 30 + nlen + elen
+        index["members"].append({"name": info.filename, "offset": data, "size": info.file_size,
+                                 "csize": info.compress_size, "method": info.compress_type, "crc": info.CRC})
+        if info.compress_type == zipfile.ZIP_STORED and info.filename.lower().endswith(NESTED):
+            index["entries"] += _tar_entries(fh, data, info.file_size, info.filename + "/")
+    return index
+
+
+def load(path: str) -> Optional[dict]:
+    """ The saved index of `path`, or None if missing or out of date. """
+    try:
+        with open(index_path(path), "r", encoding="utf-8") as fh:
+            index = json.load(fh)
+        st = os.stat(path)
+    except (OSError, ValueError):
+        return None
+    if index.get("version") != INDEX_VERSION or index.get("size") != st.st_size \
+            or index.get("mtime_ns") != st.st_mtime_ns:
+        return None
+    return index
+
+
+def save(path: str, index: dict):
+    st = os.stat(path)
+    index = dict(index, version=INDEX_VERSION, file=os.path.basename(path), size=st.st_size, mtime_ns=st.st_mtime_ns)
+    tmp = index_path(path) + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as fh:
+        json.dump(index, fh, separators=(",", ":"))
+    os.replace(tmp, index_path(path))
+
+
+def get(path: str, key: Optional[bytes] = None, rebuild: bool = False, log=print) -> dict:
+    """ The index of `path`, built and saved first if needed. """
+    index = None if rebuild else load(path)
+    if index is None:
+        log(f"indexing {path}")
+        with open_payload(path, key) as fh:
+            index = build(fh)
+        try:
+            save(path, index)
+        except OSError as e:
+            log(f"could not save the index: {e}")
+    return index
+
+
+def find(index: dict, patterns: Optional[List[str]]) -> List[dict]:
+    """ Members and nested entries whose name or base name matches one of the glob `patterns`. """
+    return [e for e in index["members"] + index["entries"] if zipstream.matches(e["name"], patterns)]
+
+
+def extract(path: str, entries: List[dict], dest: str, key: Optional[bytes] = None, log=print,
+            progress_cb=None) -> List[str]:
+    """ Copy `entries` (from find()) out of bundle `path` into `dest`: members
+    under their own name, nested tar entries in a directory named after their
+    tar without its extension (AP, CSC and HOME_CSC hold images with the same
+    names). """
+    written = []
+    with open_payload(path, key) as fh:
+        for e in entries:
+            target = zipstream.safe_path(dest, _target_name(e))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            log(f"extracting {e['name']}")
+            fh.seek(e["offset"])
+            try:
+                with open(target + ".part", "wb") as out:
+                    if "method" in e:
+                        crc = zipstream.copy_data(fh, e["method"], e["csize"], out)
+                        if crc != e["crc"]:
+                            raise Exception(f"{e['name']}: CRC mismatch (corrupt data or wrong key?)")
+                    else:
+                        _copy(fh, e["size"], out)
+            except BaseException:
+                try:
+                    os.remove(target + ".part")
+                except OSError:
+                    pass
+                raise
+            os.replace(target + ".part", target)
+            if progress_cb is not None:
+                progress_cb(e["size"])
+            written.append(target)
+    return written
+
+
+def _target_name(e: dict) -> str:
+    """ Output name of an entry: "AP_....tar.md5/boot.img" -> "AP_.../boot.img". """
+    tar = e["name"][:len(e["name"]) - len(e.get("path", e["name"]))].rstrip("/")
+    if not tar:
+        return e["name"]
+    for ext in sorted(NESTED, key=len, reverse=True):
+        if tar.lower().endswith(ext):
+            tar = tar[:-len(ext)]
+            break
+    return tar + "/" + e["path"]
+
+
+def _copy(fh, n: int, out):
+    buf = memoryview(bytearray(min(COPY_CHUNK, max(1, n))))
+    while n:
+        got = fh.readinto(buf[:min(len(buf), n)])
+        if not got:
+            raise Exception("unexpected end of data")
+        out.write(buf[:got])
+        n -= got
@@ -22,21 +22,29 @@ try:
     from . import versionfetch
     from . import fusclient
     from . import crypt
+    from . import downloader
     from . import imei
+    from . import journal
+    from . import ratelimit
+    from . import segments
     from . import __version__ as VERSION
     from .regions import get_regions as get_csc_regions
-    from .main import getbinaryfile, initdownload, decrypt_file
+    from .main import getbinaryfile, decrypt_file
 except Exception:  # pragma: no cover
     import samloader.versionfetch as versionfetch
     import samloader.fusclient as fusclient
     import samloader.crypt as crypt
+    import samloader.downloader as downloader
     import samloader.imei as imei
+    import samloader.journal as journal
+    import samloader.ratelimit as ratelimit
+    import samloader.segments as segments
     try:
         from samloader import __version__ as VERSION
     except Exception:
         VERSION = "?"
     from samloader.regions import get_regions as get_csc_regions
-    from samloader.main import getbinaryfile, initdownload, decrypt_file
+    from samloader.main import getbinaryfile, decrypt_file
 
 
 @dataclass
@@ -49,6 +57,24 @@ class ArgsLike:
     fw_ver: Optional[str] = None
 
 
+class _GuiEvents(downloader.DownloadEvents):
+    """ Forward download engine events to the main window through Qt signals. """
+    def __init__(self, window):
+        self.window = window
+
+    def started(self, filename: str, size: int, done: int, resuming: bool):
+        self.window._dl_start_base = done
+        self.window.signals.dl_set_range.emit(done, size)
+        self.window.signals.log.emit(("Resuming" if resuming else "Downloading") + f" {filename}")
+
+    def progress(self, n: int):
+        # Already coalesced by the engine: about ten queued signals a second
+        self.window.signals.dl_progress.emit(n)
+
+    def message(self, text: str):
+        self.window.signals.log.emit(text)
+
+
 class Signals(QObject):
     log = pyqtSignal(str)
     set_status = pyqtSignal(str)
@@ -59,7 +85,7 @@ class Signals(QObject):
 
     # Download
     dl_set_range = pyqtSignal(object, object)  # start_bytes, total_bytes
-    dl_progress = pyqtSignal(int)  # delta bytes
+    dl_progress = pyqtSignal(object)  # delta bytes, coalesced (progress.PUBLISH_HZ updates per second)
     dl_done = pyqtSignal(str)
 
     # Decrypt
@@ -209,18 +235,31 @@ class MainWindow(QMainWindow):
         btn_outdir = QPushButton("Browse…")
         btn_outdir.clicked.connect(self.browse_outdir)
         grid_dl.addWidget(btn_outdir, 1, 4)
-        # Threads selector (1..10)
+        # Threads selector (Auto, 1..10); 0 is shown as "Auto"
         grid_dl.addWidget(QLabel("Threads"), 2, 0)
         self.sp_threads = QSpinBox()
-        self.sp_threads.setRange(1, 10)
-        self.sp_threads.setValue(int(self._settings.get("threads", 1) or 1))
+        self.sp_threads.setRange(0, 10)
+        self.sp_threads.setSpecialValueText("Auto")
+        self.sp_threads.setValue(int(self._settings.get("threads", 1) or 0))
         grid_dl.addWidget(self.sp_threads, 2, 1)
+        # Bandwidth limit for all download threads; applied live while downloading
+        grid_dl.addWidget(QLabel("Speed limit"), 2, 2)
+        self.ed_limit = QLineEdit()
+        self.ed_limit.setPlaceholderText("unlimited (e.g. 20M)")
+        self.ed_limit.editingFinished.connect(self.apply_speed_limit)
+        grid_dl.addWidget(self.ed_limit, 2, 3)
+        self.ed_limit_sched = QLineEdit()
+        self.ed_limit_sched.setPlaceholderText("schedule, e.g. 09:00-18:00=20M")
+        self.ed_limit_sched.editingFinished.connect(self.apply_speed_limit)
+        grid_dl.addWidget(self.ed_limit_sched, 2, 4)
         self.chk_resume = QCheckBox("Resume")
         self.chk_autodec = QCheckBox("Auto-decrypt after download")
         self.chk_autodec.setChecked(bool(self._settings.get("auto_decrypt", False)))
+        self.chk_stream = QCheckBox("Decrypt while downloading (no encrypted copy)")
         hopt = QHBoxLayout()
         hopt.addWidget(self.chk_resume)
         hopt.addWidget(self.chk_autodec)
+        hopt.addWidget(self.chk_stream)
         vdl.addLayout(hopt)
         self.btn_download = QPushButton("Start download")
         self.btn_download.clicked.connect(self.on_download)
@@ -288,8 +327,9 @@ class MainWindow(QMainWindow):
         g = QGridLayout(grp)
         g.addWidget(QLabel("Default threads"), 0, 0)
         self.sp_def_threads = QSpinBox()
-        self.sp_def_threads.setRange(1, 10)
-        self.sp_def_threads.setValue(int(self._settings.get("threads", 1) or 1))
+        self.sp_def_threads.setRange(0, 10)
+        self.sp_def_threads.setSpecialValueText("Auto")
+        self.sp_def_threads.setValue(int(self._settings.get("threads", 1) or 0))
         g.addWidget(self.sp_def_threads, 0, 1)
         self.chk_def_autodec = QCheckBox("Auto-decrypt by default")
         self.chk_def_autodec.setChecked(bool(self._settings.get("auto_decrypt", False)))
@@ -345,7 +385,7 @@ class MainWindow(QMainWindow):
             with open(self._settings_path, "w", encoding="utf-8") as fh:
                 json.dump(self._settings, fh, ensure_ascii=False, indent=2)
             # Apply to current session defaults
-            self.sp_threads.setValue(int(self._settings.get("threads", 1) or 1))
+            self.sp_threads.setValue(int(self._settings.get("threads", 1) or 0))
             self.chk_autodec.setChecked(bool(self._settings.get("auto_decrypt", False)))
             self._log("Settings saved.")
         except Exception as e:
@@ -687,6 +727,17 @@ class MainWindow(QMainWindow):
                 self.signals.set_check_btn.emit(True, "Check latest version")
         threading.Thread(target=worker, daemon=True).start()
 
+    def apply_speed_limit(self) -> bool:
+        """ Configure the shared bandwidth limiter from the Download tab fields. """
+        try:
+            rate = ratelimit.parse_rate(self.ed_limit.text())
+            ratelimit.configure(rate, self.ed_limit_sched.text().strip() or None)
+        except (OSError, ValueError) as e:
+            self.signals.log.emit(f"Speed limit not applied: {e}")
+            return False
+        self.signals.log.emit(f"Speed limit: {ratelimit.format_rate(ratelimit.current_rate())}")
+        return True
+
     def on_download(self):
         common = self.gather_common()
         if not common:
@@ -701,6 +752,9 @@ class MainWindow(QMainWindow):
             QMessageBox.critical(self, "Missing data", "Output directory is required")
             return
         os.makedirs(outdir, exist_ok=True)
+        if not self.apply_speed_limit():
+            QMessageBox.critical(self, "Invalid speed limit", "Check the speed limit and schedule fields")
+            return
         self._current_fwver = fwver
         self.btn_download.setEnabled(False)
         resume = self.chk_resume.isChecked()
@@ -710,7 +764,10 @@ class MainWindow(QMainWindow):
                 args = ArgsLike(dev_model=model, dev_region=region, dev_imei=imei_input, command="download")
                 if imei.fixup_imei(args):
                     raise Exception("IMEI/serial missing or invalid. Provide IMEI prefix (>=8 digits) or serial.")
-                client = fusclient.FUSClient()
+                threads = int(getattr(self, 'sp_threads', None).value()) if hasattr(self, 'sp_threads') else 1
+                if threads == 0:
+                    threads = "auto"
+                client = fusclient.FUSClient(pool_size=segments.AUTO_MAX_THREADS if threads == "auto" else threads)
                 # Normalize version to 4-part form
                 try:
                     fwver_norm = versionfetch.normalizevercode(fwver)
@@ -738,118 +795,34 @@ class MainWindow(QMainWindow):
                 except Exception:
                     size_h = str(size)
                 self.signals.log.emit(f"Preparing: {filename} ({size_h})")
+                key = None
+                target = out_file
+                if self.chk_stream.isChecked():
+                    # Single pass: workers decrypt their ranges straight into the final file
+                    target = out_file[:-5] if out_file.lower().endswith(('.enc2', '.enc4')) else out_file
+                    if target == out_file:
+                        raise Exception(f"{filename} is not an .enc2/.enc4 file, cannot decrypt while downloading")
+                    if os.path.isfile(target) and not (resume and os.path.isfile(journal.journal_path(target))):
+                        raise Exception(f"File {target} already exists, refusing to auto-decrypt!")
+                    args.fw_ver = fwver_norm
+                    getkey = crypt.getv2key if filename.lower().endswith('.enc2') else crypt.getv4key
+                    key = getkey(args.fw_ver, args.dev_model, args.dev_region, args.dev_imei)
+                    if not key:
+                        raise Exception("Failed to obtain decryption key")
                 try:
-                    dloffset = os.stat(out_file).st_size if resume else 0
-                except FileNotFoundError:
-                    dloffset = 0
-                self.signals.log.emit(("Resuming" if dloffset else "Downloading") + f" {filename}")
-                if dloffset == size:
+                    result = downloader.download(client, path, filename, size, target, threads, resume,
+                                                 key=key, events=_GuiEvents(self))
+                except Exception as e:
+                    raise Exception(f"download failed: {e}")
+                if result["skipped"]:
                     self.signals.log.emit("Already downloaded!")
                     self.signals.dl_done.emit(out_file)
                     return
-                threads = int(getattr(self, 'sp_threads', None).value()) if hasattr(self, 'sp_threads') else 1
-                if threads > 1 and not resume and dloffset == 0:
-                    # Multi-threaded download with dynamic 1 GiB chunk queue
-                    self._dl_start_base = 0
-                    self.signals.dl_set_range.emit(0, size)
-                    # Initialize server-side and preallocate file
-                    initdownload(client, filename)
-                    try:
-                        with open(out_file, 'wb') as fd:
-                            fd.truncate(size)
-                    except Exception:
-                        with open(out_file, 'wb') as fd:
-                            if size > 0:
-                                fd.seek(size - 1)
-                                fd.write(b"\0")
-                    import queue
-                    CHUNK = 64 * 1024 * 1024  # 64 MiB
-                    chunks_q = queue.Queue()
-                    off = 0
-                    while off < size:
-                        en = min(off + CHUNK, size) - 1
-                        chunks_q.put((off, en))
-                        off = en + 1
-                    stop_event = threading.Event()
-                    errors = []
-                    def dl_worker():
-                        while not stop_event.is_set():
-                            try:
-                                st, en = chunks_q.get_nowait()
-                            except Exception:
-                                return
-                            pos = st
-                            attempts = 0
-                            backoff = 1
-                            while pos <= en and not stop_event.is_set():
-                                try:
-                                    r = client.downloadfile(path + filename, pos, en)
-                                    with open(out_file, 'r+b') as fdw:
-                                        fdw.seek(pos)
-                                        for chunk in r.iter_content(chunk_size=0x10000):
-                                            if stop_event.is_set():
-                                                return
-                                            if not chunk:
-                                                continue
-                                            fdw.write(chunk)
-                                            pos += len(chunk)
-                                            self.signals.dl_progress.emit(len(chunk))
-                                    attempts = 0
-                                    backoff = 1
-                                except Exception as e:
-                                    attempts += 1
-                                    if attempts > 10:
-                                        errors.append(e)
-                                        stop_event.set()
-                                        return
-                                    time.sleep(min(60, backoff))
-                                    backoff = min(60, backoff * 2)
-                            chunks_q.task_done()
-                    tlist = []
-                    for _ in range(threads):
-                        t = threading.Thread(target=dl_worker, daemon=True)
-                        t.start()
-                        tlist.append(t)
-                    for t in tlist:
-                        t.join()
-                    if errors:
-                        raise Exception(f"download failed: {errors[0]}")
-                else:
-                    # Fallback single-thread (resume-aware)
-                    if threads > 1 and (resume or dloffset > 0):
-                        self.signals.log.emit("Note: resume or existing partial download disables multi-thread; falling back to single-thread.")
-                    self._dl_start_base = dloffset
-                    self.signals.dl_set_range.emit(dloffset, size)
-                    pos = dloffset
-                    attempts = 0
-                    backoff = 1
-                    while pos < size:
-                        try:
-                            initdownload(client, filename)
-                            r = client.downloadfile(path + filename, pos)
-                            with open(out_file, 'ab' if pos else 'wb') as fd:
-                                if pos:
-                                    fd.seek(0, os.SEEK_END)
-                                for chunk in r.iter_content(chunk_size=0x10000):
-                                    if not chunk:
-                                        continue
-                                    fd.write(chunk)
-                                    fd.flush()
-                                    n = len(chunk)
-                                    pos += n
-                                    self.signals.dl_progress.emit(n)
-                            attempts = 0
-                            backoff = 1
-                        except Exception as e:
-                            attempts += 1
-                            if attempts > 10:
-                                raise e
-                            time.sleep(min(60, backoff))
-                            backoff *= 2
-                            try:
-                                pos = os.stat(out_file).st_size
-                            except Exception:
-                                pass
+                if key:
+                    self.signals.log.emit(f"Decryption complete: {target}")
+                    self.signals.dl_done.emit(target)
+                    return
+                self.signals.log.emit(fusclient.format_connection_stats())
                 # Optional auto-decrypt
                 if self.chk_autodec.isChecked():
                     dec_out = out_file.replace('.enc4', '').replace('.enc2', '')
@@ -895,22 +868,13 @@ class MainWindow(QMainWindow):
                 length = os.stat(infile).st_size
                 self.signals.dec_set_range.emit(length)
 
-                def progress_wrapper(src, dst, key, total_len):
-                    def write_and_progress(data: bytes):
-                        n = dst.write(data)
-                        self.signals.dec_progress.emit(n)
-                        return n
-                    class OutWrap:
-                        def write(self, data):
-                            return write_and_progress(data)
-                    crypt.decrypt_progress(src, OutWrap(), key, total_len)
-
                 getkey = crypt.getv2key if encver == 2 else crypt.getv4key
                 key = getkey(args.fw_ver, args.dev_model, args.dev_region, args.dev_imei)
                 if not key:
                     raise Exception("Failed to obtain decryption key")
                 with open(infile, "rb") as inf, open(outfile, "wb") as outf:
-                    progress_wrapper(inf, outf, key, length)
+                    # One progress signal per decrypted buffer (8 MiB)
+                    crypt.decrypt_progress(inf, outf, key, length, progress_cb=self.signals.dec_progress.emit)
                 self.signals.dec_done.emit(outfile)
             except Exception as e:
                 self.signals.error.emit(str(e))
@@ -11,9 +11,10 @@ except Exception:  # pragma: no cover
 def imei_required(args) -> bool:
     """
     Determine whether an IMEI/serial is required for the requested command.
-    Required for download and decrypt with v4.
+    Required for download and ls (every BinaryInform request), decrypt with v4,
+    and extract/unpack, which only ask when they need a v4 key.
     """
-    if args.command == "download":
+    if args.command in ("download", "ls", "extract", "unpack"):
         return True
     if args.command == "decrypt" and getattr(args, "enc_ver", 4) == 4:
         return True
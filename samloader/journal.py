@@ -0,0 +1,156 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Sidecar journal of byte ranges that are safely on disk (resumable segmented downloads). """
+
+import json
+import os
+import threading
+from typing import List, Optional, Tuple
+
+JOURNAL_SUFFIX = ".samjournal"
+JOURNAL_VERSION = 1
+
+Range = Tuple[int, int]
+
+
+def journal_path(out: str) -> str:
+    """ Return the journal path kept next to the output file. """
+    return out + JOURNAL_SUFFIX
+
+
+def merge_ranges(ranges) -> List[Range]:
+    """ Merge overlapping/adjacent inclusive (start, end) ranges. """
+    merged: List[Range] = []
+    for st, en in sorted(r for r in ranges if r[0] <= r[1]):
+        if merged and st <= merged[-1][1] + 1:
+            if en > merged[-1][1]:
+                merged[-1] = (merged[-1][0], en)
+        else:
+            merged.append((st, en))
+    return merged
+
+
+def missing_ranges(done, size: int) -> List[Range]:
+    """ Return the inclusive ranges of [0, size) not covered by `done`. """
+    out: List[Range] = []
+    pos = 0
+    for st, en in merge_ranges(done):
+        if st > pos:
+            out.append((pos, st - 1))
+        pos = max(pos, en + 1)
+    if pos < size:
+        out.append((pos, size - 1))
+    return out
+
+
+class RangeJournal:
+    """ Append-only record of completed byte ranges for one output file.
+
+    The first line is a JSON header identifying the download; every further line
+    is "start end" (inclusive). Callers only commit a range after the matching
+    data has been written (and fsync'ed, unless the "none" sync policy of
+    writer.OutputWriter is used), and a torn last line left by SIGKILL or a
+    power loss is ignored on load, so the journal never claims bytes that are
+    not really on disk.
+    """
+    def __init__(self, path: str, filename: str, size: int, done=(), mode: str = "raw"):
+        self.path = path
+        self.filename = filename
+        self.size = size
+        self.mode = mode
+        self._done = merge_ranges(done)
+        self._lock = threading.Lock()
+        self._fh = None
+
+    @classmethod
+    def create(cls, path: str, filename: str, size: int, done=(), mode: str = "raw") -> "RangeJournal":
+        """ Atomically write a fresh (compacted) journal and open it for appending.
+        `mode` records what the output holds: "raw" server bytes or "dec" plaintext. """
+        jr = cls(path, filename, size, done, mode)
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            fh.write(json.dumps({"v": JOURNAL_VERSION, "file": filename, "size": size, "mode": mode}) + "\n")
+            for st, en in jr._done:
+                fh.write(f"{st} {en}\n")
+            fh.flush()
+            os.fsync(fh.fileno())
+        os.replace(tmp, path)
+        jr._fh = open(path, "a", encoding="utf-8")
+        return jr
+
+    @classmethod
+    def load(cls, path: str, filename: str, size: int, mode: str = "raw") -> Optional["RangeJournal"]:
+        """ Load an existing journal; returns None if missing or for another file. """
+        try:
+            with open(path, "r", encoding="utf-8") as fh:
+                lines = fh.read().split("\n")
+        except FileNotFoundError:
+            return None
+        try:
+            hdr = json.loads(lines[0])
+        except ValueError:
+            return None
+        if hdr.get("v") != JOURNAL_VERSION or hdr.get("file") != filename or hdr.get("size") != size:
+            return None
+        if hdr.get("mode", "raw") != mode:
+            return None
+        done = []
+        # The last element is either "" (clean newline) or a torn, untrusted line
+        for line in lines[1:-1]:
+            parts = line.split()
+            if len(parts) != 2:
+                continue
+            try:
+                st, en = int(parts[0]), int(parts[1])
+            except ValueError:
+                continue
+            if 0 <= st <= en < size:
+                done.append((st, en))
+        # Rewrite compacted so the journal does not grow across many resumes
+        return cls.create(path, filename, size, done, mode)
+
+    def commit(self, st: int, en: int):
+        """ Durably record [st, en] as written. Data must already be fsync'ed. """
+        self.commit_many([(st, en)])
+
+    def commit_many(self, ranges, sync: bool = True):
+        """ Record several ranges with a single journal write (and fsync if `sync`). """
+        ranges = [(st, en) for st, en in ranges if st <= en]
+        if not ranges:
+            return
+        with self._lock:
+            self._done = merge_ranges(self._done + ranges)
+            if self._fh is not None:
+                self._fh.write("".join(f"{st} {en}\n" for st, en in ranges))
+                self._fh.flush()
+                if sync:
+                    os.fsync(self._fh.fileno())
+
+    def done_ranges(self) -> List[Range]:
+        with self._lock:
+            return list(self._done)
+
+    def done_bytes(self) -> int:
+        with self._lock:
+            return sum(en - st + 1 for st, en in self._done)
+
+    def missing(self) -> List[Range]:
+        with self._lock:
+            return missing_ranges(self._done, self.size)
+
+    def complete(self) -> bool:
+        return not self.missing()
+
+    def close(self):
+        with self._lock:
+            if self._fh is not None:
+                self._fh.close()
+                self._fh = None
+
+    def remove(self):
+        """ Close and delete the journal (download finished). """
+        self.close()
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
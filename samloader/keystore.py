@@ -0,0 +1,137 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Local store of V4 decryption keys, so decrypting needs no FUS round trip once a
+key is known, and keys fetched on a connected host can be shipped to offline ones. """
+
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional
+
+from .store import file_lock
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".samloader", "keys.json")
+EXPORT_VERSION = 1
+
+
+def key_id(model: str, region: str, version: str) -> str:
+    """ "MODEL/REGION/VERSION"; `version` should be normalized (versionfetch.normalizevercode). """
+    return f"{model.strip().upper()}/{region.strip().upper()}/{version.strip().upper()}"
+
+
+class KeyStore:
+    """ Keys by (model, region, version) in one JSON file, rewritten atomically and
+    changed under `<path>.lock` so several samloader processes can share it. """
+    def __init__(self, path: str = DEFAULT_PATH):
+        self.path = path
+        self._lock = threading.Lock()
+
+    @contextmanager
+    def _locked(self):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with self._lock, file_lock(self.path + ".lock"):
+            yield
+
+    def _load(self) -> dict:
+        try:
+            with open(self.path, "r", encoding="utf-8") as fh:
+                data = json.load(fh) or {}
+        except Exception:
+            data = {}
+        keys = data.get("keys")
+        return keys if isinstance(keys, dict) else {}
+
+    def _save(self, keys: dict):
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        tmp = f"{self.path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"version": EXPORT_VERSION, "keys": keys}, fh, indent=2, sort_keys=True)
+        os.replace(tmp, self.path)
+
+    def get(self, model: str, region: str, version: str) -> Optional[bytes]:
+        with self._lock:
+            ent = self._load().get(key_id(model, region, version))
+        try:
+            return bytes.fromhex(ent["key"]) if ent else None
+        except (KeyError, TypeError, ValueError):
+            return None
+
+    def put(self, model: str, region: str, version: str, key: bytes):
+        with self._locked():
+            keys = self._load()
+            keys[key_id(model, region, version)] = {"key": key.hex(), "added": round(time.time())}
+            self._save(keys)
+
+    def entries(self) -> List[dict]:
+        """ Known keys, sorted by model/region/version. """
+        with self._lock:
+            keys = self._load()
+        return [dict(v, id=k) for k, v in sorted(keys.items())]
+
+    def export(self, path: str, patterns: Optional[List[str]] = None) -> int:
+        """ Write the keys (those whose id matches one of the glob `patterns`, if given) to `path`. """
+        import fnmatch
+        with self._lock:
+            keys = self._load()
+        if patterns:
+            keys = {k: v for k, v in keys.items() if any(fnmatch.fnmatch(k, p.upper()) for p in patterns)}
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump({"version": EXPORT_VERSION, "keys": keys}, fh, indent=2, sort_keys=True)
+        os.replace(tmp, path)
+        return len(keys)
+
+    def import_file(self, path: str) -> int:
+        """ Merge the keys of an exported file; returns how many were new or changed.
+        Raises ValueError for a malformed file. """
+        with open(path, "r", encoding="utf-8") as fh:
+            data = json.load(fh)
+        incoming = data.get("keys") if isinstance(data, dict) else None
+        if not isinstance(incoming, dict):
+            raise ValueError(f"{path}: not a samloader key export")
+        for kid, ent in incoming.items():
+            if not isinstance(ent, dict) or not re.match(r"^[0-9a-fA-F]{32}$", str(ent.get("key", ""))) \
+                    or kid.count("/") < 2:
+                raise ValueError(f"{path}: invalid entry {kid!r}")
+        with self._locked():
+            keys = self._load()
+            changed = sum(1 for kid, ent in incoming.items()
+                          if keys.get(kid.upper(), {}).get("key") != ent["key"].lower())
+            for kid, ent in incoming.items():
+                keys[kid.upper()] = {"key": ent["key"].lower(), "added": ent.get("added", round(time.time()))}
+            self._save(keys)
+        return changed
+
+
+def prefetch(jobs, workers: int = 4, store: Optional[KeyStore] = None, log=print) -> int:
+    """ Fetch and store the V4 keys of manifest `jobs` (batch.Job: model, region,
+    imei, optional version, latest if missing) with `workers` threads. Returns the
+    number of jobs whose key could not be obtained. """
+    from . import crypt
+    from . import imei
+    from . import versionfetch
+    store = store or KeyStore()
+
+    def one(job):
+        try:
+            if imei.fixup_imei(job):
+                raise Exception("IMEI/serial missing or invalid")
+            ver = versionfetch.normalizevercode(job.version or versionfetch.getlatestver(job.model, job.region))
+            if store.get(job.model, job.region, ver):
+                log(f"{job.label} {ver}: already known")
+                return True
+            if crypt.getv4key(ver, job.model, job.region, job.imei, store) is None:
+                raise Exception("no key returned")
+            log(f"{job.label} {ver}: fetched")
+            return True
+        except Exception as e:
+            log(f"{job.label}: {e}")
+            return False
+
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(one, jobs))
+    return results.count(False)
@@ -2,18 +2,99 @@
 # Copyright (C) 2020 nlscc
 
 import argparse
+import io
 import os
-import base64
 import xml.etree.ElementTree as ET
 from tqdm import tqdm
-import threading
 import time
 
 from . import request
+from . import batch
+from . import checksum
 from . import crypt
+from . import downloader
 from . import fusclient
+from . import fwindex
 from . import versionfetch
 from . import imei
+from . import journal
+from . import keystore
+from . import progress
+from . import ratelimit
+from . import remotezip
+from . import segments
+from . import serve
+from . import store
+from . import unpack
+from . import writer
+from . import zipstream
+
+def _threads_arg(value):
+    try:
+        return segments.parse_threads(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def _rate_arg(value):
+    try:
+        return ratelimit.parse_rate(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+def _size_arg(value):
+    try:
+        size = store.parse_size(value)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+    if size < 16:
+        raise argparse.ArgumentTypeError("must be at least 16 bytes")
+    return size
+
+class _CliEvents(downloader.DownloadEvents):
+    """ Download events rendered as a tqdm progress bar and printed lines, and
+    optionally as JSON lines (progress.JsonLinesSink). """
+    def __init__(self, show_md5=False, sink=None):
+        self.show_md5 = show_md5
+        self.sink = sink
+        self.pbar = None
+        self.filename = None
+        self.done = 0
+        self.total = 0
+    def started(self, filename, size, done, resuming):
+        self.filename, self.done, self.total = filename, done, size
+        if self.sink is not None:
+            self.sink.event("start", file=filename, done=done, total=size, resuming=resuming)
+        if not self._json_stdout():
+            print("resuming" if resuming else "downloading", filename)
+        self.pbar = tqdm(total=size, initial=done, unit="B", unit_scale=True, disable=self._json_stdout())
+    def progress(self, n):
+        # Called from the download's single publisher thread
+        self.done += n
+        self.pbar.update(n)
+        if self.sink is not None:
+            self.sink.progress(self.filename, n, self.done, self.total)
+    def md5(self, expected):
+        if self.sink is not None:
+            self.sink.event("md5", file=self.filename, md5=expected)
+        if self.show_md5:
+            self.message("MD5: " + expected)
+    def message(self, text):
+        if self.sink is not None:
+            self.sink.event("message", file=self.filename, text=text)
+            if self._json_stdout():
+                return
+        if self.pbar is not None:
+            self.pbar.write(text)
+        else:
+            print(text)
+    def _json_stdout(self):
+        return self.sink is not None and self.sink.stdout
+    def close(self):
+        if self.pbar is not None:
+            self.pbar.close()
+            self.pbar = None
+        if self.sink is not None and self.filename is not None:
+            self.sink.event("end", file=self.filename, done=self.done, total=self.total)
 
 def main():
     parser = argparse.ArgumentParser(description="Download and query firmware for Samsung devices.")
@@ -33,19 +114,114 @@ def main():
     dload.add_argument("-v", "--fw-ver", help="firmware version to download", required=True)
     dload.add_argument("-R", "--resume", help="resume an unfinished download", action="store_true")
     dload.add_argument("-M", "--show-md5", help="print the expected MD5 hash of the downloaded file", action="store_true")
+    dload.add_argument("--no-verify", help="do not check the downloaded data against the server's MD5", action="store_true")
     dload.add_argument("-D", "--do-decrypt", help="auto-decrypt the downloaded file after downloading", action="store_true")
-    dload.add_argument("-T", "--threads", type=int, default=1, help="number of download threads (default: 1)")
+    dload.add_argument("--in-place", action="store_true", help="with -D: decrypt the downloaded file in place instead of writing a copy")
+    dload.add_argument("-S", "--stream-decrypt", help="decrypt while downloading (single pass, the encrypted file is never written)", action="store_true")
+    dload.add_argument("-T", "--threads", type=_threads_arg, default=1, help="number of download threads, or 'auto' to adapt to measured throughput (default: 1)")
     dload.add_argument("--retries", type=int, default=10, help="max consecutive retry attempts on connection errors (default: 10)")
+    dload.add_argument("--hedge", action="store_true", help="let idle threads take over ranges that stall far below the median speed")
+    dload.add_argument("--sync", choices=writer.SYNC_POLICIES, default="checkpoint",
+                       help="when written data is fsync'ed and recorded for --resume: after every range, at periodic checkpoints, or never (default: checkpoint)")
+    dload.add_argument("--limit", type=_rate_arg, default=None, metavar="RATE",
+                       help="cap the total download speed across all threads, e.g. 512K, 20M (bytes/s)")
+    dload.add_argument("--limit-schedule", metavar="SPEC",
+                       help="time-window limits, e.g. '09:00-18:00=20M,18:00-09:00=off', or @FILE to read them "
+                            "from a file that is re-read when it changes")
+    dload.add_argument("--store", nargs="?", const=store.DEFAULT_DIR, metavar="DIR",
+                       help="use a local firmware store: reuse a stored copy instead of downloading, and keep new downloads (default DIR: ~/.samloader/store)")
+    dload.add_argument("--mirror", metavar="URL", help="fetch firmware data from a 'samloader serve' mirror instead of the FUS cloud host")
+    dload.add_argument("--net-stats", action="store_true", help="print HTTP connection reuse and write/fsync statistics after the download")
+    dload.add_argument("--progress-json", metavar="FILE",
+                       help="also report progress as JSON lines (10 per second) to FILE, or '-' for stdout instead of the progress bar")
+    dload.add_argument("--only", action="append", metavar="GLOB",
+                       help="download and decrypt only the zip members matching GLOB, e.g. 'CSC_*' (repeatable); "
+                            "they are written to the output directory")
+    dload.add_argument("--reuse-from", metavar="OLD_ZIP",
+                       help="build the decrypted zip by copying members that are unchanged in OLD_ZIP (an older "
+                            "decrypted firmware zip) and downloading only the rest")
     dload_out = dload.add_mutually_exclusive_group(required=True)
     dload_out.add_argument("-O", "--out-dir", help="output the server filename to the specified directory")
     dload_out.add_argument("-o", "--out-file", help="output to the specified file")
     chkupd = subparsers.add_parser("checkupdate", help="check for the latest available firmware version")
     chkupd.add_argument("--raw", action="store_true", help="print raw four-part version code only")
+    chkupd.add_argument("-T", "--threads", type=_threads_arg, default=1, help="download threads if you choose to download, or 'auto' (default: 1)")
+    chkupd.add_argument("--retries", type=int, default=10, help="max consecutive retry attempts on connection errors (default: 10)")
+    bat = subparsers.add_parser("batch", help="download every model/region pair of a JSON or CSV manifest")
+    bat.add_argument("manifest", help="JSON list of {model, region[, imei][, version]} objects, or CSV with those columns")
+    bat.add_argument("-O", "--out-dir", required=True, help="directory for the downloaded files")
+    bat.add_argument("-T", "--threads", type=int, default=8, help="total connections shared by all jobs (default: 8)")
+    bat.add_argument("-j", "--jobs", type=int, default=2, help="files downloaded at the same time (default: 2)")
+    bat.add_argument("--retries", type=int, default=10, help="max consecutive retry attempts on connection errors (default: 10)")
+    bat.add_argument("--no-verify", help="do not check the downloaded data against the server's MD5", action="store_true")
+    bat.add_argument("--sync", choices=writer.SYNC_POLICIES, default="checkpoint", help="durability policy, as for download")
+    bat.add_argument("--limit", type=_rate_arg, default=None, metavar="RATE", help="cap the total download speed, as for download")
+    bat.add_argument("--limit-schedule", metavar="SPEC", help="time-window limits, as for download")
+    bat.add_argument("--store", nargs="?", const=store.DEFAULT_DIR, metavar="DIR", help="use a local firmware store, as for download")
+    bat.add_argument("--mirror", metavar="URL", help="fetch firmware data from a 'samloader serve' mirror")
+    bat.add_argument("--progress-json", metavar="FILE", help="also report progress as JSON lines to FILE ('-': stdout), as for download")
+    srv = subparsers.add_parser("serve", help="run a LAN mirror that caches firmware downloads for other samloader instances")
+    srv.add_argument("--bind", default="0.0.0.0", help="address to listen on (default: all)")
+    srv.add_argument("--port", type=int, default=serve.DEFAULT_PORT, help=f"port to listen on (default: {serve.DEFAULT_PORT})")
+    srv.add_argument("--cache-dir", default=serve.DEFAULT_CACHE_DIR, help="where cached firmware is kept (default: ~/.samloader/mirror)")
+    srv.add_argument("-T", "--threads", type=int, default=4, help="upstream connections per file (default: 4)")
+    srv.add_argument("--retries", type=int, default=10, help="max consecutive retry attempts on connection errors (default: 10)")
+    st = subparsers.add_parser("store", help="manage the local firmware store")
+    st.add_argument("--dir", default=store.DEFAULT_DIR, help="store directory (default: ~/.samloader/store)")
+    st_sub = st.add_subparsers(dest="store_command")
+    st_sub.add_parser("ls", help="list stored firmware, most recently used first")
+    st_gc = st_sub.add_parser("gc", help="evict least recently used firmware")
+    st_gc.add_argument("--max-size", help="shrink the store to this size, e.g. 500G; saved and applied after every download")
+    st_gc.add_argument("--max-age", type=float, help="also evict firmware unused for this many days")
+    st_gc.add_argument("--no-limit", action="store_true", help="forget a saved --max-size")
+    keys = subparsers.add_parser("keys", help="manage the local store of V4 decryption keys")
+    keys_sub = keys.add_subparsers(dest="keys_command")
+    keys_sub.add_parser("ls", help="list known keys")
+    keys_exp = keys_sub.add_parser("export", help="write known keys to a file, e.g. for offline hosts")
+    keys_exp.add_argument("file", help="file to write")
+    keys_exp.add_argument("--only", action="append", metavar="GLOB", help="only keys whose MODEL/REGION/VERSION matches GLOB, e.g. 'SM-S918B/*' (repeatable)")
+    keys_imp = keys_sub.add_parser("import", help="add the keys of exported files to the local store")
+    keys_imp.add_argument("file", nargs="+", help="files written by 'keys export'")
+    keys_pre = keys_sub.add_parser("prefetch", help="fetch the keys of every entry of a batch manifest")
+    keys_pre.add_argument("manifest", help="JSON or CSV manifest, as for batch (version: latest if omitted)")
+    keys_pre.add_argument("-j", "--jobs", type=int, default=4, help="keys fetched at the same time (default: 4)")
+    verify = subparsers.add_parser("verify", help="check a downloaded file against its expected MD5")
+    verify.add_argument("file", help="downloaded (encrypted) firmware file")
+    verify.add_argument("--md5", help="expected MD5 (default: the one saved when the file was downloaded)")
+    lsz = subparsers.add_parser("ls", help="list the members of a firmware zip on the server, without downloading it")
+    lsz.add_argument("-v", "--fw-ver", help="firmware version", required=True)
+    lsz.add_argument("--only", action="append", metavar="GLOB", help="only members matching GLOB (repeatable)")
+    lsz.add_argument("--mirror", metavar="URL", help="read from a 'samloader serve' mirror instead of the FUS cloud host")
+    ext = subparsers.add_parser("extract", help="extract images from a firmware zip, .enc2/.enc4 or tar by name, using a saved index")
+    ext.add_argument("file", help="firmware zip, encrypted firmware (.enc2/.enc4) or .tar(.md5)")
+    ext.add_argument("pattern", nargs="*", help="glob on member or image names, e.g. 'vbmeta.img.lz4' or 'CSC_*' (default: list everything)")
+    ext.add_argument("-O", "--out-dir", default=".", help="directory for the extracted files (default: current directory)")
+    ext.add_argument("-v", "--fw-ver", help="firmware version, to decrypt .enc2/.enc4 files")
+    ext.add_argument("-l", "--list", action="store_true", help="list the matching entries instead of extracting them")
+    ext.add_argument("--reindex", action="store_true", help="rebuild the index even if a saved one is up to date")
+    unp = subparsers.add_parser("unpack", help="unpack the tar.md5 archives of a firmware and decompress its .lz4 images in parallel")
+    unp.add_argument("file", nargs="+", help="firmware zip, encrypted firmware (.enc2/.enc4) or .tar(.md5) files")
+    unp.add_argument("-O", "--out-dir", default=".", help="output directory, one subdirectory per archive (default: current directory)")
+    unp.add_argument("-v", "--fw-ver", help="firmware version, to decrypt .enc2/.enc4 files on the fly")
+    unp.add_argument("-j", "--jobs", type=int, default=0, help="processes decompressing .lz4 images (default: one per CPU)")
+    unp.add_argument("--only", action="append", metavar="GLOB", help="only the archives matching GLOB, e.g. 'AP_*' (repeatable)")
+    unp.add_argument("--no-lz4", action="store_true", help="leave .lz4 images compressed")
+    unp.add_argument("--keep-lz4", action="store_true", help="keep the .lz4 files next to the decompressed images")
     decrypt = subparsers.add_parser("decrypt", help="decrypt an encrypted firmware")
     decrypt.add_argument("-v", "--fw-ver", help="encrypted firmware version", required=True)
     decrypt.add_argument("-V", "--enc-ver", type=int, choices=[2, 4], default=None, help="encryption version (auto-detected if omitted)")
     decrypt.add_argument("-i", "--in-file", help="encrypted firmware file input", required=True)
-    decrypt.add_argument("-o", "--out-file", help="decrypted firmware file output", required=True)
+    decrypt.add_argument("-o", "--out-file", help="decrypted firmware file output (with --in-place: the new name, default: the input without .enc2/.enc4)")
+    decrypt.add_argument("--in-place", action="store_true",
+                         help="decrypt the input file over itself and rename it (no second copy on disk; an interrupted run can be continued)")
+    decrypt.add_argument("-j", "--jobs", type=int, default=1,
+                         help="decrypt with N threads writing in parallel, 0 for one per CPU (default: 1)")
+    decrypt.add_argument("--buffer-size", type=_size_arg, default=crypt.DECRYPT_BUFFER, metavar="SIZE",
+                         help="bytes read and decrypted per step (per thread with -j), e.g. 8M (default: 8M)")
+    decrypt.add_argument("--extract", metavar="DIR",
+                         help="write the members of the decrypted zip to DIR instead of the zip itself")
+    decrypt.add_argument("--only", action="append", metavar="GLOB",
+                         help="with --extract: only members matching GLOB, e.g. 'AP_*' (repeatable)")
     args = parser.parse_args()
 
     # Handle standalone region list request early
@@ -148,6 +324,83 @@ def main():
             print(f"- {item.get('time','')}  {item.get('model','')} {item.get('region','')}  {item.get('version','')}\n  {item.get('file','')}")
         return 0
 
+    if args.command == "store":
+        try:
+            fw_store = store.FirmwareStore(args.dir)
+            if args.store_command == "gc":
+                max_size = store.parse_size(args.max_size) if args.max_size else None
+                if max_size is not None or args.no_limit:
+                    fw_store.set_max_size(max_size)
+                max_size = fw_store.max_size()
+                max_age = args.max_age * 86400 if args.max_age is not None else None
+                removed = fw_store.gc(max_size, max_age)
+                for ent in removed:
+                    print("evicted", ent["file"])
+                print(f"{len(removed)} evicted, {len(fw_store.entries())} kept")
+                return 0
+            ents = fw_store.entries()
+            for ent in ents:
+                used = time.strftime("%Y-%m-%d %H:%M", time.localtime(ent.get("last_used", 0)))
+                print(f"- {ent['file']}  {ent['size']} bytes  md5 {ent['md5']}  last used {used}")
+            cap = fw_store.max_size()
+            print(f"{len(ents)} files, {sum(e['size'] for e in ents)} bytes" + (f" (cap {cap} bytes)" if cap else ""))
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return 1
+
+    if args.command == "keys":
+        key_store = keystore.KeyStore()
+        try:
+            if args.keys_command == "export":
+                print(f"exported {key_store.export(args.file, args.only)} keys to {args.file}")
+            elif args.keys_command == "import":
+                for path in args.file:
+                    print(f"{path}: {key_store.import_file(path)} new or changed keys")
+            elif args.keys_command == "prefetch":
+                jobs = batch.load_manifest(args.manifest)
+                failed = keystore.prefetch(jobs, args.jobs, key_store)
+                print(f"{len(jobs) - failed} of {len(jobs)} keys available")
+                return 1 if failed else 0
+            else:
+                ents = key_store.entries()
+                for ent in ents:
+                    print(f"- {ent['id']}  {ent['key']}")
+                print(f"{len(ents)} keys in {key_store.path}")
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"Error: {e}")
+            return 1
+
+    if args.command == "serve":
+        try:
+            serve.serve(args.bind, args.port, args.cache_dir, max(1, args.threads), args.retries)
+        except OSError as e:
+            print(f"Error: {e}")
+            return 1
+        return 0
+
+    if args.command == "verify":
+        expected = (args.md5 or checksum.load_expected(args.file) or "").lower()
+        if not expected:
+            print(f"Error: no expected MD5 known for {args.file}; pass --md5")
+            return 1
+        try:
+            size = os.path.getsize(args.file)
+        except OSError as e:
+            print(f"Error: {e}")
+            return 1
+        pbar = tqdm(total=size, unit="B", unit_scale=True)
+        try:
+            got = checksum.md5_file(args.file, pbar.update)
+        finally:
+            pbar.close()
+        if got != expected:
+            print(f"MD5 mismatch: expected {expected}, got {got}")
+            return 1
+        print("MD5 OK:", got)
+        return 0
+
     # Note: IMEI/serial validation is performed later within each command
     # (download always; decrypt only if encryption is detected as V4).
 
@@ -160,169 +413,147 @@ def main():
             if not args.dev_model or not args.dev_region:
                 print("Error: --dev-model and --dev-region are required for download")
                 return 1
+            if args.in_place and not args.do_decrypt:
+                print("Error: --in-place only applies with -D/--do-decrypt")
+                return 1
+            if args.in_place and args.store:
+                # The store hardlinks the downloaded file, and in-place decryption refuses linked files
+                print("Error: --in-place and --store cannot be combined")
+                return 1
+            if args.only:
+                bad = [opt for opt, on in (("-o/--out-file", args.out_file), ("-D/--do-decrypt", args.do_decrypt),
+                                           ("-S/--stream-decrypt", args.stream_decrypt), ("--store", args.store))
+                       if on]
+                if bad:
+                    # Members are always decrypted into a directory and never stored
+                    print(f"Error: --only cannot be combined with {', '.join(bad)} (use -O DIR for the members)")
+                    return 1
             # Validate/fix IMEI or serial for download
             if imei.fixup_imei(args):
                 return 1
-            client = fusclient.FUSClient()
+            try:
+                ratelimit.configure(args.limit, args.limit_schedule)
+            except (OSError, ValueError) as e:
+                print(f"Error: --limit-schedule: {e}")
+                return 1
+            try:
+                sink = progress.JsonLinesSink(args.progress_json) if args.progress_json else None
+            except OSError as e:
+                print(f"Error: --progress-json: {e}")
+                return 1
+            auto_threads = args.threads == "auto"
+            client = fusclient.FUSClient(pool_size=segments.AUTO_MAX_THREADS if auto_threads else args.threads,
+                                         mirror=args.mirror)
             path, filename, size = getbinaryfile(client, args.fw_ver, args.dev_model, args.dev_imei, args.dev_region)
+            if args.only:
+                return download_members(args, client, path, filename, size, args.out_dir, sink)
+            if args.reuse_from:
+                out = args.out_file if args.out_file else os.path.join(args.out_dir, crypt.decrypted_name(filename))
+                return download_reusing(args, client, path, filename, size, out, sink)
             out = args.out_file if args.out_file else os.path.join(args.out_dir, filename)
+            key = None
+            target = out
+            if args.stream_decrypt:
+                # Fetch the key first so the download workers write plaintext straight away
+                target = out[:-5] if out.lower().endswith((".enc2", ".enc4")) else out
+                if target == out:
+                    print(f"Error: {filename} is not an .enc2/.enc4 file, cannot stream-decrypt")
+                    return 1
+                if os.path.isfile(target) and not (args.resume and os.path.isfile(journal.journal_path(target))):
+                    print(f"file {target} already exists, refusing to auto-decrypt!")
+                    return 1
+                version = 2 if filename.lower().endswith(".enc2") else 4
+                getkey = crypt.getv2key if version == 2 else crypt.getv4key
+                key = getkey(args.fw_ver, args.dev_model, args.dev_region, args.dev_imei)
+                if not key:
+                    return 1
+            if args.do_decrypt and not key:
+                # The encrypted file and its decrypted copy exist side by side until the end
+                dec = crypt.decrypted_name(out)
+                try:
+                    writer.check_free_space([(out, writer.space_needed(out, size))]
+                                            + ([] if args.in_place else [(dec, writer.space_needed(dec, size))]))
+                except Exception as e:
+                    print(f"Error: {e}")
+                    return 1
+            events = _CliEvents(args.show_md5, sink)
             try:
-                dloffset = os.stat(out).st_size if args.resume else 0
-            except FileNotFoundError:
-                args.resume = None
-                dloffset = 0
-
-            print("resuming" if args.resume else "downloading", filename)
-            if dloffset == size:
+                result = downloader.download(client, path, filename, size, target, args.threads, args.resume,
+                                             args.retries, args.hedge, not args.no_verify, key, args.sync, events,
+                                             store=store.FirmwareStore(args.store) if args.store else None)
+            except Exception as e:
+                if sink is not None:
+                    sink.event("error", file=filename, text=str(e))
+                print(f"Error: download failed: {e}")
+                return 1
+            finally:
+                events.close()
+                if sink is not None:
+                    sink.close()
+            if result["skipped"]:
                 print("already downloaded!")
+                if not args.do_decrypt:
+                    return 0
+            if args.show_md5 and not result["md5"]:
+                print("MD5: <unavailable>")
+            if args.net_stats:
+                print(fusclient.format_connection_stats())
+                print(f"output: {result['writes']} writes, {result['fsyncs']} fsyncs")
+            if key:
+                print("decryption complete:", target)
                 return 0
-            initdownload(client, filename)
-            # Multi-threaded segmented download when requested and starting fresh
-            if getattr(args, "threads", 1) > 1 and not args.resume and dloffset == 0:
-                threads_num = max(1, int(args.threads))
-                # Optionally show MD5 if available (fetch tiny range to get headers)
-                if args.show_md5:
-                    try:
-                        rhead = client.downloadfile(path + filename, 0, 0)
-                        if "Content-MD5" in rhead.headers:
-                            print("MD5:", base64.b64decode(rhead.headers["Content-MD5"]).hex())
-                        rhead.close()
-                    except Exception:
-                        print("MD5: <unavailable>")
-                # Preallocate file
-                try:
-                    with open(out, "wb") as fd:
-                        fd.truncate(size)
-                except Exception:
-                    # Fallback preallocation method
-                    with open(out, "wb") as fd:
-                        if size > 0:
-                            fd.seek(size - 1)
-                            fd.write(b"\0")
-                # Dynamic chunk-queue downloader with 1 GiB chunks
-                import queue
-                CHUNK = 64 * 1024 * 1024  # 64 MiB
-                chunks_q = queue.Queue()
-                # Enqueue chunks as (start, end) inclusive
-                off = 0
-                while off < size:
-                    end = min(off + CHUNK, size) - 1
-                    chunks_q.put((off, end))
-                    off = end + 1
-                pbar = tqdm(total=size, initial=0, unit="B", unit_scale=True)
-                pbar_lock = threading.Lock()
-                stop_event = threading.Event()
-                errors = []
-                def dl_worker():
-                    while not stop_event.is_set():
-                        try:
-                            st, en = chunks_q.get_nowait()
-                        except Exception:
-                            return
-                        pos = st
-                        attempts = 0
-                        backoff = 1
-                        while pos <= en and not stop_event.is_set():
-                            try:
-                                r = client.downloadfile(path + filename, pos, en)
-                                with open(out, "r+b") as fdw:
-                                    fdw.seek(pos)
-                                    for chunk in r.iter_content(chunk_size=0x10000):
-                                        if stop_event.is_set():
-                                            return
-                                        if not chunk:
-                                            continue
-                                        fdw.write(chunk)
-                                        pos += len(chunk)
-                                        with pbar_lock:
-                                            pbar.update(len(chunk))
-                                attempts = 0
-                                backoff = 1
-                            except Exception as e:
-                                attempts += 1
-                                if attempts > args.retries:
-                                    errors.append(e)
-                                    stop_event.set()
-                                    return
-                                time.sleep(min(60, backoff))
-                                backoff = min(60, backoff * 2)
-                        chunks_q.task_done()
-                tlist = []
-                for _ in range(threads_num):
-                    t = threading.Thread(target=dl_worker, daemon=True)
-                    t.start()
-                    tlist.append(t)
-                for t in tlist:
-                    t.join()
-                pbar.close()
-                if errors:
-                    print(f"Error: download failed: {errors[0]}")
-                    return 1
-            else:
-                # Fallback to single-threaded download (supports resume + auto-retry)
-                if getattr(args, "threads", 1) > 1 and (args.resume or dloffset > 0):
-                    print("Note: resume or existing partial download disables multi-thread; falling back to single-thread.")
-                # Prepare output file
-                if not args.resume:
-                    # Start fresh: truncate file to zero to avoid mixing with old partials
-                    with open(out, "wb"):
-                        pass
-                elif not os.path.exists(out):
-                    # Resume requested but file missing: create it empty and continue from 0
-                    with open(out, "wb"):
-                        pass
-                pos = dloffset
-                attempts = 0
-                backoff = 1
-                md5_printed = False
-                pbar = tqdm(total=size, initial=dloffset, unit="B", unit_scale=True)
-                try:
-                    while pos < size:
-                        try:
-                            r = client.downloadfile(path+filename, pos)
-                            if args.show_md5 and not md5_printed and "Content-MD5" in r.headers:
-                                try:
-                                    print("MD5:", base64.b64decode(r.headers["Content-MD5"]).hex())
-                                except Exception:
-                                    print("MD5: <unavailable>")
-                                md5_printed = True
-                            with open(out, "r+b") as fd:
-                                fd.seek(pos)
-                                for chunk in r.iter_content(chunk_size=0x10000):
-                                    if not chunk:
-                                        continue
-                                    fd.write(chunk)
-                                    fd.flush()
-                                    pos += len(chunk)
-                                    pbar.update(len(chunk))
-                            # Successful stream; reset attempts and backoff for next loop (if any)
-                            attempts = 0
-                            backoff = 1
-                        except Exception as e:
-                            attempts += 1
-                            if attempts > args.retries:
-                                print(f"Error: download failed after {args.retries} retries: {e}")
-                                return 1
-                            time.sleep(min(60, backoff))
-                            backoff *= 2
-                            # Re-evaluate current pos from disk to avoid duplicating bytes
-                            try:
-                                pos = os.stat(out).st_size
-                            except Exception:
-                                pass
-                finally:
-                    pbar.close()
             if args.do_decrypt: # decrypt the file if needed
-                # Remove a single trailing .enc2/.enc4 extension if present
-                dec = out[:-5] if out.lower().endswith(".enc4") else (out[:-5] if out.lower().endswith(".enc2") else out)
-                if os.path.isfile(dec):
+                # A decrypted file with a journal is an interrupted decryption: continue it
+                if os.path.isfile(dec) and not os.path.isfile(journal.journal_path(dec)):
                     print(f"file {dec} already exists, refusing to auto-decrypt!")
                     return 1
                 print("decrypting", out)
                 version = 2 if filename.endswith(".enc2") else 4
                 decrypt_file(args, version, out, dec)
-                os.remove(out)
+                if not args.in_place:
+                    os.remove(out)
 
+        elif args.command == "extract":
+            return extract_entries(args)
+        elif args.command == "unpack":
+            return unpack_files(args)
+        elif args.command == "ls":
+            if not args.dev_model or not args.dev_region:
+                print("Error: --dev-model and --dev-region are required for ls")
+                return 1
+            if imei.fixup_imei(args):
+                return 1
+            client = fusclient.FUSClient(mirror=args.mirror)
+            path, filename, size = getbinaryfile(client, args.fw_ver, args.dev_model, args.dev_imei, args.dev_region)
+            rz = _remote_zip(args, client, path, filename, size)
+            if rz is None:
+                return 1
+            members = remotezip.select(rz.members(), args.only)
+            for m in members:
+                print(f"{m.size:>14}  {m.compressed_size:>14}  {m.name}")
+            print(f"{len(members)} members, {sum(m.size for m in members)} bytes ({filename})")
+        elif args.command == "batch":
+            try:
+                jobs = batch.load_manifest(args.manifest)
+                ratelimit.configure(args.limit, args.limit_schedule)
+                sink = progress.JsonLinesSink(args.progress_json) if args.progress_json else None
+            except (OSError, ValueError) as e:
+                print(f"Error: {e}")
+                return 1
+            if not jobs:
+                print("Manifest is empty.")
+                return 0
+            connections = max(1, args.threads)
+            client = fusclient.FUSClient(pool_size=connections, mirror=args.mirror)
+            batch.resolve(client, jobs)
+            try:
+                ok = batch.run(client, jobs, args.out_dir, connections, args.jobs, args.retries, not args.no_verify,
+                               args.sync, store.FirmwareStore(args.store) if args.store else None, sink)
+            finally:
+                if sink is not None:
+                    sink.close()
+            print(batch.summary(jobs))
+            return 0 if ok else 1
         elif args.command == "checkupdate":
             if not args.dev_model or not args.dev_region:
                 print("Error: --dev-model and --dev-region are required for checkupdate")
@@ -359,77 +590,40 @@ def main():
                 if imei.fixup_imei(dlargs):
                     print("Error: IMEI/serial is required to download. Please re-run with -i/--dev-imei.")
                     return 1
-                # Start download into current working directory
-                client = fusclient.FUSClient()
+                # Start download into current working directory (continues a partial file)
+                client = fusclient.FUSClient(pool_size=segments.AUTO_MAX_THREADS if args.threads == "auto" else args.threads)
                 path, filename, size = getbinaryfile(client, ver, dlargs.dev_model, dlargs.dev_imei, dlargs.dev_region)
                 out = os.path.join(os.getcwd(), filename)
+                events = _CliEvents()
                 try:
-                    dloffset = os.stat(out).st_size
-                except FileNotFoundError:
-                    dloffset = 0
-                print(("resuming" if dloffset else "downloading"), filename)
-                if dloffset == size:
+                    result = downloader.download(client, path, filename, size, out, args.threads, True,
+                                                 args.retries, events=events)
+                except Exception as e:
+                    print(f"Error: download failed: {e}")
+                    return 1
+                finally:
+                    events.close()
+                if result["skipped"]:
                     print("already downloaded!")
-                    download_ok = True
-                else:
-                    initdownload(client, filename)
-                    # Prepare output file (resume-aware)
-                    if dloffset == 0:
-                        with open(out, "wb"):
-                            pass
-                    pos = dloffset
-                    attempts = 0
-                    backoff = 1
-                    pbar = tqdm(total=size, initial=dloffset, unit="B", unit_scale=True)
-                    try:
-                        while pos < size:
-                            try:
-                                r = client.downloadfile(path + filename, pos)
-                                with open(out, "r+b") as fd:
-                                    fd.seek(pos)
-                                    for chunk in r.iter_content(chunk_size=0x10000):
-                                        if not chunk:
-                                            continue
-                                        fd.write(chunk)
-                                        fd.flush()
-                                        pos += len(chunk)
-                                        pbar.update(len(chunk))
-                                attempts = 0
-                                backoff = 1
-                            except Exception as e:
-                                attempts += 1
-                                if attempts > 10:
-                                    print(f"Error: download failed after 10 retries: {e}")
-                                    return 1
-                                time.sleep(min(60, backoff))
-                                backoff *= 2
-                                try:
-                                    pos = os.stat(out).st_size
-                                except Exception:
-                                    pass
-                    finally:
-                        pbar.close()
-                    download_ok = (pos >= size)
-                if download_ok:
-                    try:
-                        resp2 = input("Do you want to decrypt it in the current directory? [y/N]: ").strip().lower()
-                    except EOFError:
-                        resp2 = ""
-                    if resp2 in ("y", "yes"):
-                        # Determine enc version from filename
-                        encver = 2 if filename.lower().endswith(".enc2") else 4
-                        dec = out[:-5] if out.lower().endswith(".enc4") else (out[:-5] if out.lower().endswith(".enc2") else out)
-                        if os.path.isfile(dec):
-                            print(f"file {dec} already exists, refusing to decrypt!")
-                            return 1
-                        # Prepare args for decrypt
-                        dlargs.fw_ver = ver
-                        ret = decrypt_file(dlargs, encver, out, dec)
-                        if ret == 0:
-                            print("decryption complete:", dec)
-                        else:
-                            print("Error: decryption failed")
-                            return ret
+                try:
+                    resp2 = input("Do you want to decrypt it in the current directory? [y/N]: ").strip().lower()
+                except EOFError:
+                    resp2 = ""
+                if resp2 in ("y", "yes"):
+                    # Determine enc version from filename
+                    encver = 2 if filename.lower().endswith(".enc2") else 4
+                    dec = out[:-5] if out.lower().endswith(".enc4") else (out[:-5] if out.lower().endswith(".enc2") else out)
+                    if os.path.isfile(dec):
+                        print(f"file {dec} already exists, refusing to decrypt!")
+                        return 1
+                    # Prepare args for decrypt
+                    dlargs.fw_ver = ver
+                    ret = decrypt_file(dlargs, encver, out, dec)
+                    if ret == 0:
+                        print("decryption complete:", dec)
+                    else:
+                        print("Error: decryption failed")
+                        return ret
         elif args.command == "decrypt":
             if not args.dev_model or not args.dev_region:
                 print("Error: --dev-model and --dev-region are required for decrypt")
@@ -473,7 +667,16 @@ def main():
                     return 1
                 # propagate possibly filled imei back
                 args.dev_imei = getattr(av, "dev_imei", args.dev_imei)
-            return decrypt_file(args, encver, args.in_file, args.out_file)
+            if args.only and not args.extract:
+                print("Error: --only requires --extract")
+                return 1
+            if args.extract and args.in_place:
+                print("Error: --extract and --in-place cannot be combined")
+                return 1
+            if not args.out_file and not args.in_place and not args.extract:
+                print("Error: --out-file is required (or use --in-place or --extract)")
+                return 1
+            return decrypt_file(args, encver, args.in_file, args.out_file or crypt.decrypted_name(args.in_file))
         return 0
     except requests.exceptions.Timeout:
         print("Error: network timeout while contacting the server. Please try again later.")
@@ -504,14 +707,181 @@ def decrypt_file(args, version, encrypted, decrypted):
     key = getkey(args.fw_ver, args.dev_model, args.dev_region, args.dev_imei)
     if not key:
         return 1
+    if getattr(args, "extract", None):
+        return extract_file(encrypted, key, args.extract, args.only)
+    if getattr(args, "in_place", False):
+        with tqdm(total=os.path.getsize(encrypted) if os.path.exists(encrypted) else 0,
+                  unit="B", unit_scale=True) as pbar:
+            crypt.decrypt_in_place(encrypted, key, decrypted, pbar.update)
+        return 0
+    if crypt.inplace_pending(encrypted):
+        raise Exception(f"{encrypted} is partly decrypted in place; run again with --in-place to finish it")
     length = os.stat(encrypted).st_size
-    with open(encrypted, "rb") as inf, open(decrypted, "wb") as outf:
-        crypt.decrypt_progress(inf, outf, key, length)
+    writer.check_free_space([(decrypted, writer.space_needed(decrypted, length))])
+    jobs = getattr(args, "jobs", 1)
+    jobs = jobs if jobs > 0 else (os.cpu_count() or 1)
+    bufsize = getattr(args, "buffer_size", crypt.DECRYPT_BUFFER)
+    if os.path.isfile(journal.journal_path(decrypted)):
+        print("continuing an interrupted decryption of", encrypted)
+    # Resumable: an interrupted run continues from its last checkpoint
+    with tqdm(total=length, unit="B", unit_scale=True) as pbar:
+        crypt.decrypt_parallel(encrypted, decrypted, key, jobs, pbar.update, bufsize)
+    return 0
+
+def extract_file(encrypted, key, dest, patterns):
+    """ Decrypt `encrypted` straight into its zip members under `dest`; the zip is never written. """
+    length = os.stat(encrypted).st_size
+    os.makedirs(dest, exist_ok=True)
+    with open(encrypted, "rb", buffering=0) as raw, tqdm(total=length, unit="B", unit_scale=True) as pbar:
+        plain = io.BufferedReader(crypt.DecryptReader(raw, key, length, pbar.update), crypt.DECRYPT_BUFFER)
+        written = zipstream.extract(plain, dest, patterns, log=pbar.write)
+    if not written:
+        print("no members matched" if patterns else "no members found")
+        return 1
+    print(f"extracted {len(written)} file(s) to {dest}")
     return 0
 
-def initdownload(client, filename):
-    req = request.binaryinit(filename, client.nonce)
-    resp = client.makereq("NF_DownloadBinaryInitForMass.do", req)
+def _remote_zip(args, client, path, filename, size):
+    """ The zip inside server file `filename`, readable with range requests; None without a key. """
+    if not filename.lower().endswith((".enc2", ".enc4")):
+        print(f"Error: {filename} is not an .enc2/.enc4 file")
+        return None
+    getkey = crypt.getv2key if filename.lower().endswith(".enc2") else crypt.getv4key
+    key = getkey(args.fw_ver, args.dev_model, args.dev_region, args.dev_imei)
+    if not key:
+        return None
+    downloader.initdownload(client, filename)
+    return remotezip.RemoteZip(client, path, filename, size, key, getattr(args, "retries", 10))
+
+def download_members(args, client, path, filename, size, dest, sink):
+    """ download --only: fetch and decrypt just the matching members of the firmware zip into `dest`. """
+    rz = _remote_zip(args, client, path, filename, size)
+    if rz is None:
+        return 1
+    members = remotezip.select(rz.members(), args.only)
+    if not members:
+        print("no members matched:", ", ".join(args.only))
+        return 1
+    total = sum(rz.entry_range(m)[1] - rz.entry_range(m)[0] for m in members)
+    os.makedirs(dest, exist_ok=True)
+    writer.check_free_space([(os.path.join(dest, m.name), m.size) for m in members])
+    events = _CliEvents(False, sink)
+    events.started(filename, total, 0, False)
+    bus = progress.ProgressBus(total)
+    bus.subscribe(lambda delta, _done, _total: events.progress(delta))
+    bus.start()
+    try:
+        try:
+            paths = remotezip.extract(rz, dest, args.only, events.message, bus.add, args.resume)
+        finally:
+            bus.close()
+    except Exception as e:
+        if sink is not None:
+            sink.event("error", file=filename, text=str(e))
+        print(f"Error: download failed: {e}")
+        return 1
+    finally:
+        events.close()
+        if sink is not None:
+            sink.close()
+    print(f"extracted {len(paths)} of {len(rz.members())} members ({sum(m.size for m in members)} bytes) to {dest}")
+    return 0
+
+def download_reusing(args, client, path, filename, size, out, sink):
+    """ download --reuse-from: rebuild the decrypted zip `out` from the unchanged members of an older zip plus ranges of the new one. """
+    if args.stream_decrypt or args.do_decrypt:
+        print("Error: --reuse-from already writes the decrypted zip; drop -S/-D")
+        return 1
+    if not os.path.isfile(args.reuse_from):
+        print(f"Error: {args.reuse_from} not found")
+        return 1
+    if os.path.isfile(out):
+        print(f"file {out} already exists!")
+        return 1
+    rz = _remote_zip(args, client, path, filename, size)
+    if rz is None:
+        return 1
+    writer.check_free_space([(out, size)])
+    md5 = None if args.no_verify else downloader.fetch_expected_md5(client, path, filename)
+    events = _CliEvents(args.show_md5, sink)
+    events.started(filename, size, 0, False)
+    if md5:
+        events.md5(md5)
+    bus = progress.ProgressBus(size)
+    bus.subscribe(lambda delta, _done, _total: events.progress(delta))
+    bus.start()
+    try:
+        try:
+            stats = remotezip.fetch_reusing(rz, args.reuse_from, out, md5, events.message, bus.add)
+        finally:
+            bus.close()
+    except Exception as e:
+        if sink is not None:
+            sink.event("error", file=filename, text=str(e))
+        print(f"Error: download failed: {e}")
+        return 1
+    finally:
+        events.close()
+        if sink is not None:
+            sink.close()
+    print(f"{out}: reused {stats['reused']} bytes from {args.reuse_from}, downloaded {stats['fetched']} bytes")
+    return 0
+
+def _file_key(args, path):
+    """ (ok, key): the decryption key for an .enc2/.enc4 `path` (None for other files). """
+    if not fwindex.is_encrypted(path):
+        return True, None
+    if not args.fw_ver or not args.dev_model or not args.dev_region:
+        print(f"Error: {path} is encrypted: -v/--fw-ver, --dev-model and --dev-region are needed for its key")
+        return False, None
+    if path.lower().endswith(".enc4") and imei.fixup_imei(args):
+        print(f"Error: {path} is V4-encrypted: its key needs an IMEI/serial (-i/--dev-imei)")
+        return False, None
+    getkey = crypt.getv2key if path.lower().endswith(".enc2") else crypt.getv4key
+    key = getkey(args.fw_ver, args.dev_model, args.dev_region, args.dev_imei)
+    return key is not None, key
+
+def extract_entries(args):
+    """ samloader extract: find entries through the bundle's index and copy them out. """
+    ok, key = _file_key(args, args.file)
+    if not ok:
+        return 1
+    index = fwindex.get(args.file, key, args.reindex)
+    entries = fwindex.find(index, args.pattern)
+    if not args.pattern or args.list:
+        for e in entries:
+            print(f"{e['size']:>14}  {e['name']}")
+        print(f"{len(entries)} entries")
+        return 0
+    if not entries:
+        print("nothing matched:", ", ".join(args.pattern))
+        return 1
+    with tqdm(total=sum(e["size"] for e in entries), unit="B", unit_scale=True) as pbar:
+        paths = fwindex.extract(args.file, entries, args.out_dir, key, pbar.write, pbar.update)
+    print(f"extracted {len(paths)} file(s) to {args.out_dir}")
+    return 0
+
+def unpack_files(args):
+    """ samloader unpack: tar.md5 archives out of firmware files, MD5-checked, .lz4 images decompressed in parallel. """
+    keys = set()
+    for path in args.file:
+        ok, key = _file_key(args, path)
+        if not ok:
+            return 1
+        keys.add(key)
+    if len(keys - {None}) > 1:
+        print("Error: unpack one firmware version at a time")
+        return 1
+    key = next(iter(keys - {None}), None)
+    total = unpack.total_size(args.file, key, args.only)
+    with tqdm(total=total, unit="B", unit_scale=True) as pbar:
+        count = unpack.unpack(args.file, args.out_dir, key, args.jobs, args.only, not args.no_lz4, args.keep_lz4,
+                              pbar.write, pbar.update)
+    if not count:
+        print("no tar archives found")
+        return 1
+    print(f"unpacked {count} archive(s) to {args.out_dir}")
+    return 0
 
 def getbinaryfile(client, fw, model, imei, region):
     # Normalize the firmware version string to the expected 4-part form
@@ -0,0 +1,101 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Coalesced progress reporting: many download threads, one publisher at a fixed rate. """
+
+import json
+import sys
+import threading
+import time
+
+PUBLISH_HZ = 10.0
+
+
+class ProgressBus:
+    """ Aggregates byte counts from download threads and publishes them to sinks.
+
+    add() only bumps a counter owned by the calling thread (no lock is taken
+    after a thread's first call); a publisher thread sums the counters
+    PUBLISH_HZ times a second and calls every sink with (delta, done, total),
+    always from that single thread. close() publishes whatever is left.
+    """
+    def __init__(self, total: int, done: int = 0, hz: float = PUBLISH_HZ):
+        self.total = total
+        self.done = done
+        self.interval = 1.0 / hz
+        self._cells = []
+        self._local = threading.local()
+        self._register = threading.Lock()
+        self._sinks = []
+        self._published = 0
+        self._closed = threading.Event()
+        self._thread = None
+
+    def subscribe(self, sink):
+        """ Add a callable sink(delta, done, total). """
+        self._sinks.append(sink)
+
+    def add(self, n: int):
+        cell = getattr(self._local, "cell", None)
+        if cell is None:
+            cell = self._local.cell = [0]
+            with self._register:
+                self._cells.append(cell)
+        cell[0] += n
+
+    def start(self) -> "ProgressBus":
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        while not self._closed.wait(self.interval):
+            self.publish()
+
+    def publish(self):
+        with self._register:
+            cells = list(self._cells)
+        seen = sum(c[0] for c in cells)
+        delta = seen - self._published
+        if delta <= 0:
+            return
+        self._published = seen
+        self.done += delta
+        for sink in self._sinks:
+            sink(delta, self.done, self.total)
+
+    def close(self):
+        self._closed.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self.publish()
+
+
+class JsonLinesSink:
+    """ Machine-readable progress: one JSON object per line, e.g.
+    {"event": "progress", "file": "...", "done": 1048576, "total": 4194304, "rate": 1.2e7, "time": 1700000000.0}.
+    Besides "progress", records are written for "start", "message" and "end". """
+    def __init__(self, path: str = "-"):
+        self.stdout = path == "-"
+        self._fh = sys.stdout if self.stdout else open(path, "a", encoding="utf-8")
+        self._lock = threading.Lock()
+        self._rates = {}
+
+    def event(self, kind: str, **fields):
+        rec = {"event": kind}
+        rec.update(fields)
+        rec["time"] = round(time.time(), 3)
+        with self._lock:
+            self._fh.write(json.dumps(rec) + "\n")
+            self._fh.flush()
+
+    def progress(self, filename: str, delta: int, done: int, total: int):
+        now = time.monotonic()
+        with self._lock:
+            last = self._rates.get(filename)
+            self._rates[filename] = (now, done)
+        rate = (done - last[1]) / (now - last[0]) if last and now > last[0] else 0.0
+        self.event("progress", file=filename, delta=delta, done=done, total=total, rate=round(rate, 1))
+
+    def close(self):
+        if not self.stdout:
+            self._fh.close()
@@ -0,0 +1,187 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Process-wide bandwidth limit (token bucket) with optional time-window schedules. """
+
+import datetime
+import os
+import re
+import threading
+import time
+from typing import List, Optional, Tuple
+
+BURST_SECS = 0.5  # the bucket holds at most half a second of traffic...
+MIN_BURST = 256 * 1024  # ...but never less than 256 KiB
+MAX_SLEEP = 0.25  # re-check the rate this often while waiting (live schedule changes)
+RELOAD_SECS = 1.0  # how often the effective rate / a schedule file is re-evaluated
+
+_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3}
+_RATE_RE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([KMG]?)(?:I?B)?(?:/S)?\s*$")
+_WINDOW_RE = re.compile(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$")
+
+
+def parse_rate(value: str) -> Optional[float]:
+    """ Parse a rate like "20M", "512K" or "1.5G" (bytes per second, binary units).
+    "0", "off", "none" and "unlimited" mean no limit (None). Raises ValueError. """
+    text = str(value).strip().upper()
+    if text in ("", "0", "OFF", "NONE", "UNLIMITED"):
+        return None
+    m = _RATE_RE.match(text)
+    if not m:
+        raise ValueError(f"invalid rate: {value!r} (use e.g. 512K, 20M, 1G)")
+    rate = float(m.group(1)) * _UNITS[m.group(2)]
+    return rate if rate > 0 else None
+
+
+def format_rate(rate: Optional[float]) -> str:
+    if rate is None:
+        return "unlimited"
+    for unit in ("G", "M", "K"):
+        if rate >= _UNITS[unit]:
+            return f"{rate / _UNITS[unit]:g}{unit}B/s"
+    return f"{rate:g}B/s"
+
+
+class Schedule:
+    """ Rates for time-of-day windows, e.g. "09:00-18:00=20M, 18:00-09:00=off".
+
+    Entries are separated by commas, semicolons or newlines ("#" starts a
+    comment). A window may wrap past midnight; the first matching window wins.
+    An entry without a window ("=5M" or just "5M") sets the rate used outside
+    every window, which otherwise is the --limit rate.
+    """
+    def __init__(self, windows: List[Tuple[int, int, Optional[float]]], default=False):
+        self.windows = windows
+        self.default = default  # False: not set by the schedule
+
+    @classmethod
+    def parse(cls, text: str) -> "Schedule":
+        windows = []
+        default = False
+        for raw in re.split(r"[,;\n]", text):
+            entry = raw.split("#", 1)[0].strip()
+            if not entry:
+                continue
+            span, sep, rate = entry.rpartition("=")
+            if not sep or not span.strip():
+                default = parse_rate(rate)
+                continue
+            m = _WINDOW_RE.match(span)
+            if not m:
+                raise ValueError(f"invalid schedule window: {span.strip()!r} (use HH:MM-HH:MM)")
+            h1, m1, h2, m2 = (int(g) for g in m.groups())
+            if h1 > 24 or h2 > 24 or m1 > 59 or m2 > 59:
+                raise ValueError(f"invalid schedule window: {span.strip()!r}")
+            windows.append((h1 * 60 + m1, h2 * 60 + m2, parse_rate(rate)))
+        return cls(windows, default)
+
+    def rate_at(self, when: datetime.datetime, base: Optional[float]) -> Optional[float]:
+        """ The rate in effect at `when`; `base` applies outside every window. """
+        minute = when.hour * 60 + when.minute
+        for st, en, rate in self.windows:
+            if (st <= minute < en) if st <= en else (minute >= st or minute < en):
+                return rate
+        return base if self.default is False else self.default
+
+
+class RateLimiter:
+    """ Token bucket shared by every download thread.
+
+    Workers call throttle(n) after receiving n bytes and sleep while the
+    bucket is in debt, which in turn slows the TCP reads. The effective rate is
+    re-evaluated about once per second from the base rate and the schedule, so
+    a new time window (or an edited "@file" schedule) applies to running
+    downloads without restarting them.
+    """
+    def __init__(self, rate: Optional[float] = None, schedule: Optional[str] = None):
+        self._lock = threading.Lock()
+        self._tokens = 0.0
+        self._stamp = time.monotonic()
+        self._checked = 0.0
+        self._rate = None
+        self.configure(rate, schedule)
+
+    def configure(self, rate: Optional[float] = None, schedule: Optional[str] = None):
+        """ Set the base rate (bytes/s, None for unlimited) and an optional schedule:
+        schedule text, or "@path" to read it from a file that is re-read when it changes.
+        Raises ValueError for an invalid schedule. """
+        path = schedule[1:] if schedule and schedule.startswith("@") else None
+        parsed = None
+        if path:
+            with open(path, "r", encoding="utf-8") as fh:
+                parsed = Schedule.parse(fh.read())
+        elif schedule:
+            parsed = Schedule.parse(schedule)
+        with self._lock:
+            self._base = rate
+            self._schedule = parsed
+            self._path = path
+            self._mtime = os.path.getmtime(path) if path else None
+            self._checked = 0.0
+
+    def rate(self) -> Optional[float]:
+        """ Current effective rate in bytes/s (None: unlimited). """
+        with self._lock:
+            self._refresh(time.monotonic())
+            return self._rate
+
+    def _refresh(self, now: float):
+        if now - self._checked < RELOAD_SECS:
+            return
+        self._checked = now
+        if self._path:
+            try:
+                mtime = os.path.getmtime(self._path)
+                if mtime != self._mtime:
+                    with open(self._path, "r", encoding="utf-8") as fh:
+                        self._schedule = Schedule.parse(fh.read())
+                    self._mtime = mtime
+            except (OSError, ValueError):
+                pass  # keep the last good schedule while the file is being edited
+        rate = self._schedule.rate_at(datetime.datetime.now(), self._base) if self._schedule else self._base
+        if rate != self._rate:
+            self._rate = rate
+            self._tokens = min(self._tokens, self._burst())
+
+    def _burst(self) -> float:
+        return max(MIN_BURST, self._rate * BURST_SECS) if self._rate else 0.0
+
+    def throttle(self, n: int):
+        """ Account for `n` received bytes, sleeping as long as needed to stay under the rate. """
+        with self._lock:
+            now = time.monotonic()
+            self._refresh(now)
+            if self._rate is None:
+                self._stamp = now
+                return
+            self._tokens = min(self._burst(), self._tokens + (now - self._stamp) * self._rate)
+            self._stamp = now
+            self._tokens -= n
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self._refresh(now)
+                if self._rate is None:
+                    return
+                self._tokens = min(self._burst(), self._tokens + (now - self._stamp) * self._rate)
+                self._stamp = now
+                if self._tokens >= 0:
+                    return
+                wait = -self._tokens / self._rate
+            time.sleep(min(MAX_SLEEP, wait))
+
+
+_limiter = RateLimiter()
+
+
+def configure(rate: Optional[float] = None, schedule: Optional[str] = None):
+    """ Configure the process-wide limiter used by all downloads. """
+    _limiter.configure(rate, schedule)
+
+
+def current_rate() -> Optional[float]:
+    return _limiter.rate()
+
+
+def throttle(n: int):
+    """ Called by download workers for every chunk received. """
+    _limiter.throttle(n)
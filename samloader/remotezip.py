@@ -0,0 +1,336 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Read the firmware zip inside an encrypted server file without downloading it:
+AES-ECB blocks decrypt independently, so the central directory and single
+members are fetched with range requests and decrypted on the fly. """
+
+import hashlib
+import io
+import os
+import struct
+import time
+import zipfile
+from typing import Dict, List, Optional
+
+from Cryptodome.Cipher import AES
+
+from . import fusclient
+from . import ratelimit
+from . import zipstream
+
+RECV_BUFFER = 1024 * 1024  # ciphertext read and decrypted per step
+TAIL_SIZE = 0x10000 + 22 + 20  # largest EOCD record (with comment) plus the ZIP64 locator
+
+_EOCD = struct.Struct("<4s4H2LH")
+_ZIP64_LOCATOR = struct.Struct("<4sLQL")
+_ZIP64_EOCD = struct.Struct("<4sQ2H2L4Q")
+_CENTRAL = struct.Struct("<4s6H3L5H2L")
+
+
+class RangeReader(io.RawIOBase):
+    """ Plaintext of bytes [start, end) of encrypted server file `file`, read
+    sequentially through one range request that is re-issued from where it
+    stopped after a connection error (up to `retries` times in a row).
+    `progress_cb(n)` gets the ciphertext bytes received. """
+    def __init__(self, client, file: str, start: int, end: int, key: bytes, retries: int = 10, progress_cb=None):
+        self.client = client
+        self.file = file
+        self.pos = start
+        self.end = end
+        self.retries = retries
+        self.progress_cb = progress_cb
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        self._fetch = start - start % 16
+        self._stop = end + (-end) % 16
+        self._buf = bytearray(min(RECV_BUFFER, max(16, self._stop - self._fetch)))
+        self._view = memoryview(b"")
+        self._r = None
+        self._body = None
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, b) -> int:
+        if self.pos >= self.end:
+            return 0
+        if not len(self._view):
+            self._fill()
+        n = min(len(b), len(self._view))
+        b[:n] = self._view[:n]
+        self._view = self._view[n:]
+        self.pos += n
+        return n
+
+    def _fill(self):
+        """ Receive, decrypt and expose the next whole blocks. """
+        view = memoryview(self._buf)[:min(len(self._buf), self._stop - self._fetch)]
+        got = 0
+        attempts = 0
+        backoff = 1
+        while got < len(view) and (got == 0 or got % 16):
+            try:
+                if self._body is None:
+                    self._r = self.client.downloadfile(self.file, self._fetch + got, self._stop - 1)
+                    self._body = fusclient.BodyReader(self._r)
+                n = self._body.readinto(view[got:])
+                if not n:
+                    raise Exception("connection closed early")
+                ratelimit.throttle(n)
+                got += n
+                attempts = 0
+            except Exception as e:
+                self._drop()
+                attempts += 1
+                if attempts > self.retries:
+                    raise Exception(f"failed after {self.retries} retries: {e}")
+                time.sleep(min(60, backoff))
+                backoff *= 2
+        got -= got % 16
+        block = view[:got]
+        self.cipher.decrypt(block, output=block)
+        if self.progress_cb is not None:
+            self.progress_cb(got)
+        start = self.pos - self._fetch
+        self._view = block[start:min(got, self.end - self._fetch)]
+        self._fetch += got
+        if self._fetch >= self._stop:
+            self._drop()
+
+    def _drop(self):
+        if self._r is not None:
+            self._r.close()
+        self._r = self._body = None
+
+    def close(self):
+        self._drop()
+        super().close()
+
+
+class RemoteZip:
+    """ The zip inside encrypted server file `path` + `filename` (`size` bytes,
+    as reported by FUS), decrypted with `key`. """
+    def __init__(self, client, path: str, filename: str, size: int, key: bytes, retries: int = 10):
+        self.client = client
+        self.file = path + filename
+        self.size = size
+        self.key = key
+        self.retries = retries
+        self._members = None
+        self._cd_offset = None
+
+    def read(self, offset: int, n: int) -> bytes:
+        """ `n` plaintext bytes at `offset`. """
+        with RangeReader(self.client, self.file, offset, offset + n, self.key, self.retries) as r:
+            data = r.read(n)
+            while len(data) < n:
+                more = r.read(n - len(data))
+                if not more:
+                    raise Exception("unexpected end of data")
+                data += more
+            return data
+
+    def plain_size(self) -> int:
+        if self.size % 16 or not self.size:
+            raise Exception("invalid encrypted file size")
+        pad = self.read(self.size - 16, 16)[-1]
+        if not 1 <= pad <= 16:
+            raise Exception("invalid padding (wrong key?)")
+        return self.size - pad
+
+    def members(self) -> List[zipstream.Member]:
+        """ Every member, from the (ZIP64) central directory, in archive order. """
+        if self._members is not None:
+            return self._members
+        plain = self.plain_size()
+        tail_at = max(0, plain - TAIL_SIZE)
+        tail = self.read(tail_at, plain - tail_at)
+        pos = tail.rfind(b"PK\x05\x06")
+        if pos < 0 or pos + _EOCD.size > len(tail):
+            raise Exception("no zip end record found (not a zip, or wrong key?)")
+        _sig, _d, _cd, _nd, count, cd_size, cd_offset, _c = _EOCD.unpack_from(tail, pos)
+        if 0xFFFF in (count,) or 0xFFFFFFFF in (cd_size, cd_offset):
+            loc = pos - _ZIP64_LOCATOR.size
+            if loc < 0 or tail[loc:loc + 4] != b"PK\x06\x07":
+                raise Exception("ZIP64 end locator missing")
+            z64_at = _ZIP64_LOCATOR.unpack_from(tail, loc)[2]
+            rec = self.read(z64_at, _ZIP64_EOCD.size)
+            fields = _ZIP64_EOCD.unpack(rec)
+            if fields[0] != b"PK\x06\x06":
+                raise Exception("ZIP64 end record missing")
+            count, cd_size, cd_offset = fields[7], fields[8], fields[9]
+        cd = self.read(cd_offset, cd_size)
+        members = []
+        at = 0
+        for _ in range(count):
+            if cd[at:at + 4] != b"PK\x01\x02":
+                raise Exception("corrupt central directory")
+            f = _CENTRAL.unpack_from(cd, at)
+            flags, method, crc, csize, size, nlen, elen, clen, offset = f[3], f[4], f[7], f[8], f[9], f[10], f[11], f[12], f[16]
+            at += _CENTRAL.size
+            name = zipstream.decode_name(cd[at:at + nlen], flags)
+            extra = cd[at + nlen:at + nlen + elen]
+            at += nlen + elen + clen
+            size, csize, offset = zipstream.parse_zip64_extra(extra, [size, csize, offset])
+            members.append(zipstream.Member(name, method, flags, crc, csize, size, offset))
+        self._members = members
+        self._cd_offset = cd_offset
+        return members
+
+    def local_header(self, member: zipstream.Member) -> bytes:
+        """ The local file header of `member` (signature to end of the extra field). """
+        nlen, elen = struct.unpack("<HH", self.read(member.offset + 26, 4))
+        return self.read(member.offset, 30 + nlen + elen)
+
+    def entry_range(self, member: zipstream.Member):
+        """ (start, end) of `member`'s local entry: header, data and data descriptor. """
+        later = [m.offset for m in self.members() if m.offset > member.offset]
+        return member.offset, min(later) if later else self._cd_offset
+
+    def extract(self, member: zipstream.Member, dest: str, log=print, progress_cb=None) -> str:
+        """ Download, decrypt and CRC-check one member into `dest`; returns its path. """
+        start, end = self.entry_range(member)
+        raw = RangeReader(self.client, self.file, start, end, self.key, self.retries, progress_cb)
+        with io.BufferedReader(raw, RECV_BUFFER) as fh:
+            written = zipstream.extract(fh, dest, None, log)
+        if len(written) != 1:
+            raise Exception(f"{member.name}: local entry not found")
+        return written[0]
+
+
+def select(members: List[zipstream.Member], patterns: Optional[List[str]]) -> List[zipstream.Member]:
+    """ Members matching the glob `patterns` (directories excluded). """
+    return [m for m in members if not m.name.endswith("/") and zipstream.matches(m.name, patterns)]
+
+
+def extract(rz: RemoteZip, dest: str, patterns: Optional[List[str]], log=print, progress_cb=None,
+            resume: bool = False) -> List[str]:
+    """ Extract the members of `rz` matching `patterns` into `dest`. With `resume`,
+    members already present with the right size are kept. """
+    paths = []
+    for m in select(rz.members(), patterns):
+        target = zipstream.safe_path(dest, m.name)
+        if resume and os.path.isfile(target) and os.path.getsize(target) == m.size:
+            log(f"{m.name} already extracted")
+            if progress_cb is not None:
+                start, end = rz.entry_range(m)
+                progress_cb(end - start)
+        else:
+            rz.extract(m, dest, log, progress_cb)
+        paths.append(target)
+    return paths
+
+
+class _Assembler:
+    """ Writes the rebuilt zip sequentially and hashes its encrypted form, which
+    is what the server's MD5 covers (AES-ECB is deterministic). """
+    def __init__(self, fh, key: bytes):
+        self.fh = fh
+        self.cipher = AES.new(key, AES.MODE_ECB)
+        self.md5 = hashlib.md5()
+        self.written = 0
+        self._carry = b""
+
+    def write(self, data):
+        self.fh.write(data)
+        self.written += len(data)
+        data = self._carry + bytes(data)
+        n = len(data) - len(data) % 16
+        self.md5.update(self.cipher.encrypt(data[:n]))
+        self._carry = data[n:]
+
+    def hexdigest(self) -> str:
+        pad = 16 - len(self._carry)
+        h = self.md5.copy()
+        h.update(self.cipher.encrypt(self._carry + bytes([pad]) * pad))
+        return h.hexdigest()
+
+
+def _local_members(path: str) -> Dict[tuple, tuple]:
+    """ (method, crc, compressed size, size) -> (data offset, compressed size) for zip `path`. """
+    found = {}
+    with zipfile.ZipFile(path) as z, open(path, "rb") as fh:
+        for info in z.infolist():
+            fh.seek(info.header_offset)
+            head = fh.read(30)
+            if len(head) < 30 or head[:4] != zipstream.LOCAL_SIG:
+                continue
+            nlen, elen = struct.unpack_from("<HH", head, 26)
+            key = (info.compress_type, info.CRC, info.compress_size, info.file_size)
+            found[key] = (info.header_offset + 30 + nlen + elen, info.compress_size)
+    return found
+
+
+def _copy_remote(rz: RemoteZip, start: int, end: int, out: _Assembler, progress_cb=None):
+    if end <= start:
+        return
+    buf = memoryview(bytearray(min(RECV_BUFFER, end - start)))
+    with RangeReader(rz.client, rz.file, start, end, rz.key, rz.retries) as r:
+        while True:
+            n = r.readinto(buf)
+            if not n:
+                break
+            out.write(buf[:n])
+            if progress_cb is not None:
+                progress_cb(n)
+    if out.written != end:
+        raise Exception("unexpected end of data")
+
+
+def _copy_local(fh, offset: int, n: int, out: _Assembler, progress_cb=None):
+    buf = memoryview(bytearray(min(RECV_BUFFER, max(1, n))))
+    fh.seek(offset)
+    while n:
+        got = fh.readinto(buf[:min(len(buf), n)])
+        if not got:
+            raise Exception("old zip is truncated")
+        out.write(buf[:got])
+        n -= got
+        if progress_cb is not None:
+            progress_cb(got)
+
+
+def fetch_reusing(rz: RemoteZip, old_zip: str, out: str, md5: Optional[str] = None, log=print,
+                  progress_cb=None) -> Dict[str, int]:
+    """ Rebuild the zip of `rz` as `out`, copying the data of every member whose
+    method, CRC32 and sizes match a member of local zip `old_zip` (names are not
+    compared: they carry the build version), and
+    fetching everything else (headers, changed members, central directory) by
+    range. With `md5` (the server MD5 of the encrypted file) the result is
+    verified. Returns the number of bytes reused and fetched. """
+    old = _local_members(old_zip)
+    members = sorted(rz.members(), key=lambda m: m.offset)
+    plain = rz.plain_size()
+    stats = {"reused": 0, "fetched": 0}
+    part = out + ".part"
+    with open(old_zip, "rb") as oldf, open(part, "wb") as fh:
+        asm = _Assembler(fh, rz.key)
+        pos = 0
+        for m in members:
+            start, end = rz.entry_range(m)
+            _copy_remote(rz, pos, start, asm, progress_cb)
+            match = old.get((m.method, m.crc, m.compressed_size, m.size))
+            if match is None:
+                log(f"fetching {m.name}")
+                _copy_remote(rz, start, end, asm, progress_cb)
+                stats["fetched"] += end - start
+            else:
+                log(f"reusing {m.name}")
+                header = rz.local_header(m)
+                asm.write(header)
+                _copy_local(oldf, match[0], match[1], asm, progress_cb)
+                # Data descriptor, if any
+                _copy_remote(rz, start + len(header) + match[1], end, asm, progress_cb)
+                stats["reused"] += match[1]
+                stats["fetched"] += end - start - match[1]
+            pos = end
+        _copy_remote(rz, pos, plain, asm, progress_cb)
+        stats["fetched"] += plain - pos
+    if md5:
+        got = asm.hexdigest()
+        if got != md5.lower():
+            os.remove(part)
+            raise Exception(f"MD5 mismatch for the rebuilt firmware: expected {md5}, got {got}")
+    else:
+        log("the server sent no MD5; the rebuilt zip is not verified")
+    os.replace(part, out)
+    return stats
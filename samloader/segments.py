@@ -0,0 +1,242 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Range scheduling and connection-count control for segmented downloads. """
+
+import threading
+import time
+from typing import List, Optional, Tuple
+
+Range = Tuple[int, int]
+
+MIN_CHUNK = 4 * 1024 * 1024  # 4 MiB
+MAX_CHUNK = 256 * 1024 * 1024  # 256 MiB
+DEFAULT_CHUNK = 64 * 1024 * 1024  # 64 MiB
+PROBE_CHUNK = 8 * 1024 * 1024  # used until the first throughput sample
+ALIGN = 64 * 1024  # range boundaries stay 64 KiB aligned (and thus AES block aligned)
+
+MIN_SPLIT = 1024 * 1024  # never steal less than 1 MiB
+HEDGE_MIN_AGE = 5.0  # seconds a task runs before it can be judged stalled
+HEDGE_RATIO = 0.25  # stalled: below a quarter of the median task throughput
+
+AUTO_START_THREADS = 2
+AUTO_MAX_THREADS = 16
+
+
+def parse_threads(value: str):
+    """ argparse type for -T: a positive integer or "auto". """
+    if str(value).strip().lower() == "auto":
+        return "auto"
+    try:
+        n = int(value)
+    except ValueError:
+        raise ValueError(f"invalid thread count: {value!r} (use a number or 'auto')")
+    if n < 1:
+        raise ValueError("thread count must be >= 1")
+    return n
+
+
+class Task:
+    """ A range being downloaded by one worker. `pos` is the next byte to write;
+    `en` may be lowered by the scheduler when another worker steals the tail. """
+    __slots__ = ("st", "pos", "en", "started")
+
+    def __init__(self, st: int, en: int):
+        self.st = st
+        self.pos = st
+        self.en = en
+        self.started = time.monotonic()
+
+
+class RangeScheduler:
+    """ Hands out pieces of the missing ranges to download workers.
+
+    Pieces are cut on demand (rather than pre-split into a queue) so their size
+    can follow the measured throughput, and they never cross ALIGN boundaries
+    except at the end of a missing range. Once nothing is pending, an idle
+    worker steals the second half of the largest in-flight task instead of
+    waiting for it; with `hedge` set, a task running far below the median
+    throughput is taken over from its current position.
+    """
+    def __init__(self, missing: List[Range], hedge: bool = False):
+        self._pending = [r for r in missing if r[0] <= r[1]]
+        self._active: List[Task] = []
+        self._lock = threading.Lock()
+        self.hedge = hedge
+        self.steals = 0
+        self.hedges = 0
+        self._rates: List[float] = []  # throughput of finished tasks, for the hedge median
+
+    def remaining(self) -> int:
+        with self._lock:
+            return sum(en - st + 1 for st, en in self._pending)
+
+    def empty(self) -> bool:
+        with self._lock:
+            return not self._pending
+
+    def take(self, max_len: int) -> Optional[Task]:
+        """ Start the next task of at most `max_len` bytes, or None when nothing is left. """
+        with self._lock:
+            if not self._pending:
+                task = self._steal()
+            else:
+                st, en = self._pending[0]
+                cut = st + max(ALIGN, max_len)
+                cut -= cut % ALIGN
+                if cut <= st or cut > en:
+                    self._pending.pop(0)
+                else:
+                    self._pending[0] = (cut, en)
+                    en = cut - 1
+                task = Task(st, en)
+            if task is not None:
+                self._active.append(task)
+            return task
+
+    def claim(self, task: Task, n: int) -> int:
+        """ Reserve up to `n` bytes at task.pos for writing; returns how many may be written. """
+        with self._lock:
+            allowed = max(0, min(n, task.en - task.pos + 1))
+            task.pos += allowed
+            return allowed
+
+    def end_of(self, task: Task) -> int:
+        with self._lock:
+            return task.en
+
+    def finish(self, task: Task):
+        with self._lock:
+            if task in self._active:
+                self._active.remove(task)
+                age = time.monotonic() - task.started
+                if age > 0 and task.pos > task.st:
+                    self._rates = (self._rates + [(task.pos - task.st) / age])[-32:]
+
+    def busy(self) -> bool:
+        """ True while any task is still in flight. """
+        with self._lock:
+            return bool(self._active)
+
+    def _steal(self) -> Optional[Task]:
+        live = [t for t in self._active if t.en - t.pos + 1 > 0]
+        if not live:
+            return None
+        if self.hedge:
+            victim = self._stalled(live)
+            if victim is not None:
+                cut = -(-victim.pos // ALIGN) * ALIGN
+                if cut <= victim.en:
+                    new = Task(cut, victim.en)
+                    victim.en = cut - 1
+                    self.hedges += 1
+                    return new
+        victim = max(live, key=lambda t: t.en - t.pos)
+        left = victim.en - victim.pos + 1
+        if left < 2 * MIN_SPLIT:
+            return None
+        mid = victim.pos + left // 2
+        mid -= mid % ALIGN
+        if mid <= victim.pos:
+            return None
+        new = Task(mid, victim.en)
+        victim.en = mid - 1
+        self.steals += 1
+        return new
+
+    def _stalled(self, live: List[Task]) -> Optional[Task]:
+        now = time.monotonic()
+        aged = [t for t in live if now - t.started >= HEDGE_MIN_AGE]
+        rates = sorted(self._rates + [(t.pos - t.st) / (now - t.started) for t in aged])
+        if not aged or len(rates) < 2:
+            return None
+        median = rates[len(rates) // 2]
+        slow = [t for t in aged if (t.pos - t.st) / (now - t.started) < median * HEDGE_RATIO]
+        if not slow:
+            return None
+        return max(slow, key=lambda t: t.en - t.pos)
+
+
+class AimdController:
+    """ Additive-increase / multiplicative-decrease control of the connection count.
+
+    Aggregate throughput is sampled every `interval` seconds. While adding a
+    connection raises it by at least `gain`, one more is added; when it does
+    not, the last one is dropped and the count is held for a while before
+    probing again. Errors or a collapse of throughput halve the count.
+    """
+    def __init__(self, start: int = AUTO_START_THREADS, max_conns: int = AUTO_MAX_THREADS,
+                 interval: float = 2.0, gain: float = 0.10, hold: int = 5):
+        self.max_conns = max(1, max_conns)
+        self.target = max(1, min(start, self.max_conns))
+        self.peak = self.target
+        self.rate = 0.0
+        self.interval = interval
+        self.gain = gain
+        self.hold = hold
+        self._lock = threading.Lock()
+        self._bytes = 0
+        self._errors = 0
+        self._last = time.monotonic()
+        self._prev_rate = 0.0
+        self._best_rate = 0.0
+        self._probing = False
+        self._hold_left = 0
+
+    def add(self, n: int):
+        with self._lock:
+            self._bytes += n
+
+    def error(self):
+        with self._lock:
+            self._errors += 1
+
+    def tick(self) -> bool:
+        """ Re-evaluate the target if an interval has elapsed; returns True if it did. """
+        now = time.monotonic()
+        with self._lock:
+            elapsed = now - self._last
+            if elapsed < self.interval:
+                return False
+            rate = self._bytes / elapsed
+            errors = self._errors
+            self._bytes = 0
+            self._errors = 0
+            self._last = now
+            self.rate = rate
+            if errors or (self._best_rate and rate < self._best_rate * 0.5):
+                # Congestion or server push-back: back off hard
+                self.target = max(1, self.target // 2)
+                self._probing = False
+                self._hold_left = self.hold
+                self._best_rate = rate
+            elif self._probing:
+                if rate >= self._prev_rate * (1.0 + self.gain):
+                    self.target = min(self.max_conns, self.target + 1)
+                else:
+                    self.target = max(1, self.target - 1)
+                    self._probing = False
+                    self._hold_left = self.hold
+            elif self._hold_left > 0:
+                self._hold_left -= 1
+            elif self.target < self.max_conns:
+                self.target += 1
+                self._probing = True
+            self._prev_rate = rate
+            self._best_rate = max(self._best_rate, rate)
+            self.peak = max(self.peak, self.target)
+            return True
+
+    def chunk_size(self, seconds: float = 8.0) -> int:
+        """ Range size worth about `seconds` of transfer on one connection. """
+        with self._lock:
+            if not self.rate:
+                return PROBE_CHUNK
+            per_conn = self.rate / max(1, self.target)
+        return int(max(MIN_CHUNK, min(MAX_CHUNK, per_conn * seconds)))
+
+
+def fixed_chunk_size(remaining: int, threads: int) -> int:
+    """ Range size for a fixed thread count: 64 MiB, but small enough that a
+    small file is still spread over every thread. """
+    share = remaining // max(1, threads * 2)
+    return max(MIN_CHUNK, min(DEFAULT_CHUNK, share))
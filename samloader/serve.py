@@ -0,0 +1,284 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" `samloader serve`: a LAN caching mirror of the FUS cloud download endpoint.
+
+Clients (other samloader instances with --mirror, or any HTTP client) request
+/NF_DownloadBinaryForMass.do?file=<path><filename> exactly as from the FUS cloud
+host. The first request for a file starts a background segmented download into
+the cache directory; every request is then answered from the cache, with HTTP
+Range support and sendfile, while the file is still arriving.
+"""
+
+import base64
+import os
+import re
+import socket
+import sys
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+from urllib.parse import parse_qs, urlsplit
+
+from . import checksum
+from . import downloader
+from . import fusclient
+from . import journal
+
+DEFAULT_PORT = 8484
+DEFAULT_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".samloader", "mirror")
+ENDPOINT = "/NF_DownloadBinaryForMass.do"
+SEND_CHUNK = 8 * 1024 * 1024  # bytes handed to one sendfile()/write() call
+WAIT_TIMEOUT = 120.0  # give up on a client when no new data arrives for this long
+
+
+class CacheEntry:
+    """ A cached server file: which bytes are on disk, and a condition to wait for more. """
+    def __init__(self, path: str, filename: str, out: str, size: int, md5: Optional[str]):
+        self.path = path
+        self.filename = filename
+        self.out = out
+        self.size = size
+        self.md5 = md5
+        self.error = None
+        self.complete = False
+        self._have = []
+        self._cond = threading.Condition()
+
+    def mark(self, offset: int, n: int):
+        """ Record bytes [offset, offset+n) as written and wake waiting clients. """
+        with self._cond:
+            self._have = journal.merge_ranges(self._have + [(offset, offset + n - 1)])
+            self._cond.notify_all()
+
+    def finish(self, error=None):
+        with self._cond:
+            self.error = error
+            self.complete = error is None
+            if self.complete:
+                self._have = [(0, self.size - 1)] if self.size else []
+            self._cond.notify_all()
+
+    def available(self, pos: int, timeout: float = WAIT_TIMEOUT) -> int:
+        """ Block until the byte at `pos` is cached; returns the end (exclusive) of the
+        cached run starting there. Raises if the download failed or stalled. """
+        with self._cond:
+            while True:
+                for st, en in self._have:
+                    if st <= pos <= en:
+                        return en + 1
+                if self.error is not None:
+                    raise Exception(f"upstream download failed: {self.error}")
+                if not self._cond.wait(timeout):
+                    raise Exception("upstream download stalled")
+
+
+class MirrorCache:
+    """ Cache entries by server filename; fills missing files from the FUS cloud host. """
+    def __init__(self, cache_dir: str = DEFAULT_CACHE_DIR, threads: int = 4, retries: int = 10, log=print):
+        self.cache_dir = cache_dir
+        self.threads = threads
+        self.retries = retries
+        self.log = log
+        self._entries: Dict[str, CacheEntry] = {}
+        self._lock = threading.Lock()
+        self._file_locks: Dict[str, threading.Lock] = {}
+        self._client = None
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def client(self) -> fusclient.FUSClient:
+        with self._lock:
+            if self._client is None:
+                self._client = fusclient.FUSClient(pool_size=self.threads)
+            return self._client
+
+    def get(self, file_param: str) -> CacheEntry:
+        """ The entry for FUS file "<path><filename>", starting its download if needed. """
+        filename = os.path.basename(file_param)
+        if not filename or filename in (".", ".."):
+            raise ValueError("invalid file name")
+        path = file_param[:len(file_param) - len(filename)]
+        with self._lock:
+            entry = self._entries.get(filename)
+            if entry is not None and entry.error is None:
+                return entry
+            file_lock = self._file_locks.setdefault(filename, threading.Lock())
+        # Entries are created under a per-file lock: a file is never fetched twice,
+        # and a slow upstream setup for one file does not hold up the others
+        with file_lock:
+            with self._lock:
+                entry = self._entries.get(filename)
+                if entry is not None and entry.error is None:
+                    return entry
+            out = os.path.join(self.cache_dir, filename)
+            md5 = checksum.load_expected(out) if os.path.isfile(out + checksum.MD5_SUFFIX) else None
+            if md5 and os.path.isfile(out) and not os.path.exists(journal.journal_path(out)):
+                # The .md5 sidecar is only written once a file is complete and verified
+                entry = CacheEntry(path, filename, out, os.path.getsize(out), md5)
+                entry.finish()
+            else:
+                client = self.client()
+                downloader.initdownload(client, filename)
+                size, md5 = self._probe(client, path, filename)
+                entry = CacheEntry(path, filename, out, size, md5)
+                jr = downloader.open_segmented(out, filename, size, True)
+                for st, en in jr.done_ranges():
+                    entry.mark(st, en - st + 1)
+                threading.Thread(target=self._fill, args=(entry, jr), daemon=True).start()
+            with self._lock:
+                self._entries[filename] = entry
+            return entry
+
+    def _probe(self, client, path, filename):
+        """ Size and MD5 of a server file from the headers of a 1-byte range request. """
+        r = client.downloadfile(path + filename, 0, 0)
+        try:
+            m = re.match(r"bytes\s+\d+-\d+/(\d+)", r.headers.get("Content-Range", ""))
+            size = int(m.group(1)) if m else int(r.headers["Content-Length"])
+            return size, checksum.md5_from_header(r)
+        finally:
+            r.close()
+
+    def _fill(self, entry: CacheEntry, jr):
+        self.log(f"caching {entry.filename} ({entry.size} bytes)")
+        try:
+            downloader.download_segmented(self.client(), entry.path, entry.filename, entry.out, jr, self.threads,
+                                          self.retries, md5=entry.md5, on_write=entry.mark)
+        except Exception as e:
+            self.log(f"caching {entry.filename} failed: {e}")
+            entry.finish(e)
+            return
+        if not entry.md5:
+            entry.md5 = checksum.md5_file(entry.out)
+        checksum.save_expected(entry.out, entry.md5)
+        entry.finish()
+        self.log(f"cached {entry.filename}")
+
+
+def parse_range(header: Optional[str], size: int):
+    """ (start, end) inclusive for a single-range "bytes=" header; None for the whole
+    file; raises ValueError when unsatisfiable. """
+    if not header:
+        return None
+    m = re.match(r"^\s*bytes\s*=\s*(\d*)\s*-\s*(\d*)\s*$", header)
+    if not m or (not m.group(1) and not m.group(2)):
+        return None  # multiple or malformed ranges: send everything
+    if not m.group(1):
+        n = int(m.group(2))
+        if n == 0:
+            raise ValueError("empty suffix range")
+        return max(0, size - n), size - 1
+    start = int(m.group(1))
+    end = min(int(m.group(2)), size - 1) if m.group(2) else size - 1
+    if start >= size or end < start:
+        raise ValueError("range not satisfiable")
+    return start, end
+
+
+class MirrorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    cache: MirrorCache = None
+
+    def do_HEAD(self):
+        self._serve(body=False)
+
+    def do_GET(self):
+        self._serve(body=True)
+
+    def log_message(self, format, *args):
+        pass
+
+    def _fail(self, code: int, text: str, size: Optional[int] = None):
+        data = (text + "\n").encode()
+        self.send_response(code)
+        if size is not None:
+            self.send_header("Content-Range", f"bytes */{size}")
+        self.send_header("Content-Type", "text/plain")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _serve(self, body: bool):
+        url = urlsplit(self.path)
+        if url.path != ENDPOINT:
+            return self._fail(404, "not found")
+        files = parse_qs(url.query).get("file")
+        if not files:
+            return self._fail(400, "missing file parameter")
+        try:
+            entry = self.cache.get(files[0])
+        except ValueError as e:
+            return self._fail(400, str(e))
+        except Exception as e:
+            return self._fail(502, f"upstream error: {e}")
+        try:
+            rng = parse_range(self.headers.get("Range"), entry.size)
+        except ValueError:
+            return self._fail(416, "range not satisfiable", entry.size)
+        start, end = rng if rng is not None else (0, entry.size - 1)
+        self.send_response(206 if rng is not None else 200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(max(0, end - start + 1)))
+        if rng is not None:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{entry.size}")
+        if entry.md5:
+            self.send_header("Content-MD5", base64.b64encode(bytes.fromhex(entry.md5)).decode())
+        self.end_headers()
+        if not body:
+            return
+        self.wfile.flush()
+        try:
+            self._send(entry, start, end + 1)
+        except Exception as e:
+            # Headers are out: all we can do is drop the connection
+            self.log_error("%s", e)
+            self.close_connection = True
+
+    def _send(self, entry: CacheEntry, pos: int, stop: int):
+        sock = self.connection
+        use_sendfile = hasattr(os, "sendfile")
+        with open(entry.out, "rb", buffering=0) as fh:
+            while pos < stop:
+                avail = min(entry.available(pos), stop)
+                while pos < avail:
+                    count = min(SEND_CHUNK, avail - pos)
+                    if use_sendfile:
+                        try:
+                            n = os.sendfile(sock.fileno(), fh.fileno(), pos, count)
+                        except OSError:
+                            use_sendfile = False
+                            continue
+                    else:
+                        fh.seek(pos)
+                        data = fh.read(count)
+                        self.wfile.write(data)
+                        n = len(data)
+                    if n <= 0:
+                        raise Exception("short transfer")
+                    pos += n
+
+
+class MirrorServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients dropping idle keep-alive connections is normal
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            return
+        super().handle_error(request, client_address)
+
+
+def serve(bind: str = "0.0.0.0", port: int = DEFAULT_PORT, cache_dir: str = DEFAULT_CACHE_DIR,
+          threads: int = 4, retries: int = 10):
+    """ Run the mirror until interrupted. """
+    cache = MirrorCache(cache_dir, threads, retries)
+    handler = type("Handler", (MirrorHandler,), {"cache": cache})
+    httpd = MirrorServer((bind, port), handler)
+    host = socket.gethostname() if bind in ("", "0.0.0.0") else bind
+    print(f"serving {cache_dir} on port {port}; clients: samloader ... download --mirror http://{host}:{port}/")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        httpd.server_close()
@@ -0,0 +1,227 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Local content-addressed firmware store shared by downloads (opt-in with --store). """
+
+import contextlib
+import json
+import os
+import re
+import shutil
+import threading
+import time
+from typing import List, Optional
+
+DEFAULT_DIR = os.path.join(os.path.expanduser("~"), ".samloader", "store")
+INDEX_NAME = "index.json"
+LOCK_NAME = "index.lock"
+OBJECTS_DIR = "objects"
+
+FICLONE = 0x40049409  # Linux ioctl: share the extents of another file (btrfs, xfs, ...)
+
+_SIZE_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+
+
+def parse_size(value: str) -> int:
+    """ Parse a size like "500G" or "1.5T" (binary units). Raises ValueError. """
+    m = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:I?B)?\s*$", str(value).strip().upper())
+    if not m:
+        raise ValueError(f"invalid size: {value!r} (use e.g. 500G)")
+    return int(float(m.group(1)) * _SIZE_UNITS[m.group(2)])
+
+
+def object_key(filename: str, size: int, md5: str) -> str:
+    return f"{md5.lower()}-{size}-{os.path.basename(filename)}"
+
+
+def _reflink(src: str, dst: str):
+    import fcntl
+    with open(src, "rb") as inf, open(dst, "wb") as outf:
+        fcntl.ioctl(outf.fileno(), FICLONE, inf.fileno())
+
+
+def link_or_copy(src: str, dst: str) -> str:
+    """ Make `dst` hold the content of `src` as cheaply as possible; returns
+    "hardlink", "reflink" or "copy". """
+    try:
+        os.link(src, dst)
+        return "hardlink"
+    except OSError:
+        pass
+    try:
+        _reflink(src, dst)
+        return "reflink"
+    except Exception:
+        try:
+            os.remove(dst)
+        except OSError:
+            pass
+    shutil.copyfile(src, dst)
+    return "copy"
+
+
+@contextlib.contextmanager
+def file_lock(path: str):
+    """ Hold an exclusive lock on `path` (created if missing), shared by all processes. """
+    fh = open(path, "a+b")
+    try:
+        if os.name == "nt":
+            import msvcrt
+            fh.seek(0)
+            while True:
+                try:
+                    msvcrt.locking(fh.fileno(), msvcrt.LK_LOCK, 1)
+                    break
+                except OSError:
+                    pass  # LK_LOCK gives up after 10 attempts; keep waiting
+        else:
+            import fcntl
+            fcntl.flock(fh.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if os.name == "nt":
+                import msvcrt
+                fh.seek(0)
+                msvcrt.locking(fh.fileno(), msvcrt.LK_UNLCK, 1)
+            else:
+                import fcntl
+                fcntl.flock(fh.fileno(), fcntl.LOCK_UN)
+    finally:
+        fh.close()
+
+
+class FirmwareStore:
+    """ Verified firmware files keyed by server filename + size + MD5.
+
+    Objects live in `<root>/objects/<md5>-<size>-<filename>`; `<root>/index.json`
+    records when each one was added and last used (for LRU eviction) and an
+    optional size cap applied after every insert. Every read-modify-write of the
+    index happens under `<root>/index.lock`, so several samloader processes can
+    share a store.
+    """
+    def __init__(self, root: str = DEFAULT_DIR):
+        self.root = root
+        self._lock = threading.Lock()
+        os.makedirs(os.path.join(root, OBJECTS_DIR), exist_ok=True)
+
+    @contextlib.contextmanager
+    def _locked(self):
+        with self._lock, file_lock(os.path.join(self.root, LOCK_NAME)):
+            yield
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.root, OBJECTS_DIR, key)
+
+    def _load(self) -> dict:
+        try:
+            with open(os.path.join(self.root, INDEX_NAME), "r", encoding="utf-8") as fh:
+                index = json.load(fh) or {}
+        except Exception:
+            index = {}
+        index.setdefault("objects", {})
+        index.setdefault("max_size", None)
+        # Objects whose file vanished are forgotten
+        index["objects"] = {k: v for k, v in index["objects"].items() if os.path.isfile(self._path(k))}
+        return index
+
+    def _save(self, index: dict):
+        path = os.path.join(self.root, INDEX_NAME)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as fh:
+            json.dump(index, fh, indent=2)
+        os.replace(tmp, path)
+
+    def lookup(self, filename: str, size: int) -> Optional[dict]:
+        """ The stored object for a server file, if any (marked as used). """
+        name = os.path.basename(filename)
+        with self._locked():
+            index = self._load()
+            for key, ent in index["objects"].items():
+                if ent.get("file") == name and ent.get("size") == size \
+                        and os.path.getsize(self._path(key)) == size:
+                    ent["last_used"] = time.time()
+                    self._save(index)
+                    return dict(ent, key=key, path=self._path(key))
+        return None
+
+    def materialize(self, entry: dict, out: str) -> str:
+        """ Place a stored object at `out` (replacing what is there); returns the method used. """
+        tmp = out + ".store.tmp"
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        method = link_or_copy(entry["path"], tmp)
+        os.replace(tmp, out)
+        return method
+
+    def add(self, path: str, filename: str, size: int, md5: str) -> dict:
+        """ Record a verified download (linked into the store when possible). """
+        key = object_key(filename, size, md5)
+        obj = self._path(key)
+        if not os.path.isfile(obj):
+            tmp = f"{obj}.{os.getpid()}.tmp"
+            if os.path.exists(tmp):
+                os.remove(tmp)
+            link_or_copy(path, tmp)
+            os.replace(tmp, obj)
+        now = time.time()
+        with self._locked():
+            index = self._load()
+            ent = index["objects"].setdefault(key, {"file": os.path.basename(filename), "size": size,
+                                                    "md5": md5.lower(), "added": now})
+            ent["last_used"] = now
+            self._save(index)
+            cap = index.get("max_size")
+        if cap:
+            self.gc(cap, keep=key)
+        return dict(ent, key=key, path=obj)
+
+    def entries(self) -> List[dict]:
+        """ Stored objects, most recently used first. """
+        with self._locked():
+            index = self._load()
+        ents = [dict(v, key=k, path=self._path(k)) for k, v in index["objects"].items()]
+        return sorted(ents, key=lambda e: e.get("last_used", 0), reverse=True)
+
+    def set_max_size(self, max_size: Optional[int]):
+        with self._locked():
+            index = self._load()
+            index["max_size"] = max_size
+            self._save(index)
+
+    def max_size(self) -> Optional[int]:
+        with self._locked():
+            return self._load().get("max_size")
+
+    def gc(self, max_size: Optional[int] = None, max_age: Optional[float] = None, keep: str = None) -> List[dict]:
+        """ Evict least recently used objects until the store fits in `max_size` bytes,
+        and objects unused for `max_age` seconds. Returns the evicted entries. """
+        removed = []
+        with self._locked():
+            index = self._load()
+            objs = index["objects"]
+            order = sorted(objs, key=lambda k: objs[k].get("last_used", 0))
+            total = sum(objs[k]["size"] for k in order)
+            now = time.time()
+            for key in order:
+                if key == keep:
+                    continue
+                too_old = max_age is not None and now - objs[key].get("last_used", 0) > max_age
+                too_big = max_size is not None and total > max_size
+                if not (too_old or too_big):
+                    continue
+                try:
+                    os.remove(self._path(key))
+                except FileNotFoundError:
+                    pass
+                total -= objs[key]["size"]
+                removed.append(dict(objs.pop(key), key=key))
+            # Leftovers of interrupted inserts (old enough not to be in progress)
+            for name in os.listdir(os.path.join(self.root, OBJECTS_DIR)):
+                if name.endswith(".tmp"):
+                    try:
+                        if now - os.path.getmtime(self._path(name)) > 3600:
+                            os.remove(self._path(name))
+                    except OSError:
+                        pass
+            self._save(index)
+        return removed
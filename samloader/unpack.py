@@ -0,0 +1,211 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" `samloader unpack`: unpack the AP/BL/CP/CSC tar.md5 archives of a firmware
+and decompress their .lz4 images, using every core.
+
+Each tar is read once as a stream (straight out of the zip, decrypting on the
+fly for .enc2/.enc4): a hashing thread checks the MD5 line Samsung appends to
+the tar while its entries are written out, and finished .lz4 images are
+decompressed on a process pool while the next entries are still streaming.
+LZ4 support needs the optional `lz4` package (pip install samloader[lz4]), or
+else the lz4 command-line tool on PATH.
+"""
+
+import hashlib
+import os
+import queue
+import re
+import shutil
+import subprocess
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from typing import List, Optional
+
+from . import fwindex
+from . import zipstream
+
+UNPACK_BUFFER = 1024 * 1024  # tar stream read size
+HOLD_BACK = 1024  # bytes kept back from the hash until the end: they may hold the MD5 line
+TAR_NAMES = (".tar", ".tar.md5")
+LZ4_MISSING = "LZ4 decompression needs the lz4 package (pip install lz4) or the lz4 tool on PATH; or use --no-lz4"
+
+_TRAILER = re.compile(rb"^([0-9a-fA-F]{32})\s+\S")
+
+try:
+    import lz4.frame as lz4frame
+except ImportError:
+    lz4frame = None
+
+
+def lz4_available() -> bool:
+    return lz4frame is not None or shutil.which("lz4") is not None
+
+
+def decompress_lz4(src: str, keep: bool = False) -> str:
+    """ Decompress `src` (an LZ4 frame file) next to it without the .lz4 suffix;
+    the source is removed unless `keep`. Runs in the worker processes. """
+    dst = src[:-4]
+    part = dst + ".part"
+    if lz4frame is not None:
+        with lz4frame.open(src, "rb") as inf, open(part, "wb") as out:
+            shutil.copyfileobj(inf, out, 8 * 1024 * 1024)
+    elif shutil.which("lz4"):
+        subprocess.run(["lz4", "-d", "-f", "-q", src, part], check=True)
+    else:
+        raise Exception(LZ4_MISSING)
+    os.replace(part, dst)
+    if not keep:
+        os.remove(src)
+    return dst
+
+
+class _TarHasher(threading.Thread):
+    """ MD5 of a .tar.md5 stream without its trailing MD5 line, computed in its
+    own thread from the chunks passed to feed(). """
+    def __init__(self):
+        super().__init__(daemon=True)
+        self._chunks = queue.Queue(maxsize=64)
+        self._md5 = hashlib.md5()
+        self._tail = b""
+        self.error = None
+
+    def feed(self, data: bytes):
+        self._chunks.put(data)
+
+    def run(self):
+        try:
+            while True:
+                data = self._chunks.get()
+                if data is None:
+                    return
+                if len(data) >= HOLD_BACK:
+                    self._md5.update(self._tail)
+                    self._md5.update(data[:-HOLD_BACK])
+                    self._tail = data[-HOLD_BACK:]
+                else:
+                    self._tail += data
+                    if len(self._tail) > 2 * HOLD_BACK:
+                        self._md5.update(self._tail[:-HOLD_BACK])
+                        self._tail = self._tail[-HOLD_BACK:]
+        except Exception as e:
+            self.error = e
+            while self._chunks.get() is not None:
+                pass
+
+    def finish(self):
+        """ (expected, actual) MD5, or None when the stream has no MD5 line. """
+        self._chunks.put(None)
+        self.join()
+        if self.error is not None:
+            raise self.error
+        # The tar ends with zero blocks, so the MD5 line starts after the last NUL
+        cut = self._tail.rfind(b"\0") + 1
+        m = _TRAILER.match(self._tail[cut:])
+        if not m:
+            self._md5.update(self._tail)
+            return None
+        self._md5.update(self._tail[:cut])
+        return m.group(1).decode().lower(), self._md5.hexdigest()
+
+
+class _Tee:
+    """ Passes what tarfile reads on to the hasher and the progress callback. """
+    def __init__(self, fh, hasher: _TarHasher, progress_cb=None):
+        self.fh = fh
+        self.hasher = hasher
+        self.progress_cb = progress_cb
+
+    def read(self, n: int = -1) -> bytes:
+        data = self.fh.read(n)
+        if data:
+            self.hasher.feed(data)
+            if self.progress_cb is not None:
+                self.progress_cb(len(data))
+        return data
+
+
+def _tar_dir(name: str) -> str:
+    base = os.path.basename(name)
+    for suffix in (".md5", ".tar"):
+        if base.lower().endswith(suffix):
+            base = base[:-len(suffix)]
+    return base
+
+
+def unpack_tar(fh, name: str, dest: str, pool=None, keep_lz4: bool = False, log=print, progress_cb=None):
+    """ Unpack tar stream `fh` (named `name`) into `dest`/<tar name>, verifying
+    its MD5 line if it has one. .lz4 entries are submitted to `pool` for
+    decompression; returns those futures. """
+    outdir = os.path.join(dest, _tar_dir(name))
+    hasher = _TarHasher()
+    hasher.start()
+    tee = _Tee(fh, hasher, progress_cb)
+    futures = []
+    try:
+        with tarfile.open(fileobj=tee, mode="r|", bufsize=UNPACK_BUFFER) as tar:
+            for ti in tar:
+                if not ti.isfile():
+                    continue
+                target = zipstream.safe_path(outdir, ti.name)
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                log(f"{name}: {ti.name}")
+                with tar.extractfile(ti) as src, open(target, "wb") as out:
+                    shutil.copyfileobj(src, out, UNPACK_BUFFER)
+                if pool is not None and target.lower().endswith(".lz4"):
+                    futures.append(pool.submit(decompress_lz4, target, keep_lz4))
+        # The MD5 line (and any padding) after the end-of-archive blocks
+        while tee.read(UNPACK_BUFFER):
+            pass
+    finally:
+        result = hasher.finish()
+    if result is not None and result[0] != result[1]:
+        raise Exception(f"{name}: MD5 mismatch (expected {result[0]}, got {result[1]}); the archive is corrupt")
+    if result is None:
+        log(f"{name}: no MD5 line, not verified")
+    return futures
+
+
+def _tars(path: str, key: Optional[bytes], patterns: Optional[List[str]]):
+    """ (name, size, opener) for the tars to unpack from `path`: a tar itself, or the tar members of a (encrypted) zip. """
+    if path.lower().endswith(TAR_NAMES):
+        yield os.path.basename(path), os.path.getsize(path), lambda: open(path, "rb")
+        return
+    payload = fwindex.open_payload(path, key, UNPACK_BUFFER)
+    try:
+        with zipfile.ZipFile(payload) as z:
+            for info in z.infolist():
+                if info.filename.lower().endswith(TAR_NAMES) and zipstream.matches(info.filename, patterns):
+                    yield info.filename, info.file_size, lambda info=info: z.open(info)
+    finally:
+        payload.close()
+
+
+def unpack(paths: List[str], dest: str, key: Optional[bytes] = None, jobs: int = 0, patterns: Optional[List[str]] = None,
+           lz4: bool = True, keep_lz4: bool = False, log=print, progress_cb=None) -> int:
+    """ Unpack the tars of every file in `paths` into `dest`, decompressing .lz4
+    images on `jobs` processes (0: one per CPU) unless `lz4` is off. Returns the
+    number of tars unpacked. """
+    if lz4 and not lz4_available():
+        raise Exception(LZ4_MISSING)
+    count = 0
+    pool = ProcessPoolExecutor(max_workers=jobs or os.cpu_count() or 1) if lz4 else None
+    futures = []
+    try:
+        for path in paths:
+            for name, _size, opener in _tars(path, key, patterns):
+                with opener() as fh:
+                    futures += unpack_tar(fh, name, dest, pool, keep_lz4, log, progress_cb)
+                count += 1
+        for f in futures:
+            log(f"decompressed {os.path.relpath(f.result(), dest)}")
+    finally:
+        if pool is not None:
+            pool.shutdown(wait=True)
+    return count
+
+
+def total_size(paths: List[str], key: Optional[bytes] = None, patterns: Optional[List[str]] = None) -> int:
+    """ Bytes of tar data unpack() will read, for a progress bar. """
+    return sum(size for path in paths for _name, size, _opener in _tars(path, key, patterns))
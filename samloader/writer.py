@@ -0,0 +1,231 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Shared output file with positional writes, write coalescing and fsync policies. """
+
+import errno
+import os
+import shutil
+import threading
+import time
+from typing import Iterable, Tuple
+
+COALESCE = 1024 * 1024  # 1 MiB per write syscall
+CHECKPOINT_BYTES = 256 * 1024 * 1024  # checkpoint policy: fsync at least every 256 MiB...
+CHECKPOINT_SECS = 10.0  # ...or every 10 seconds
+
+SYNC_POLICIES = ("none", "checkpoint", "always")
+
+
+def _gib(n: int) -> str:
+    return f"{n / 1024 ** 3:.2f} GiB"
+
+
+def preallocate(fd: int, size: int) -> bool:
+    """ Reserve disk blocks for the first `size` bytes of the open file `fd`
+    (posix_fallocate), so threads writing at scattered offsets get one
+    contiguous extent instead of a fragmented sparse file. Returns False where
+    that is not supported (Windows, some filesystems); raises on ENOSPC. """
+    if size <= 0 or not hasattr(os, "posix_fallocate"):
+        return False
+    try:
+        os.posix_fallocate(fd, 0, size)
+        return True
+    except OSError as e:
+        if e.errno == errno.ENOSPC:
+            raise Exception(f"not enough free disk space to allocate {_gib(size)}") from e
+        return False
+
+
+def space_needed(path: str, size: int) -> int:
+    """ Bytes still to be allocated for `path` to hold `size` bytes, counting the
+    blocks an existing (not hardlinked) file already has. """
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return size
+    if st.st_nlink > 1:
+        return size
+    have = st.st_blocks * 512 if hasattr(st, "st_blocks") else st.st_size
+    return max(0, size - have)
+
+
+def check_free_space(needs: Iterable[Tuple[str, int]]):
+    """ Raise if the filesystems of the given (path, bytes) pairs cannot hold
+    them all; pairs on the same filesystem are added up. """
+    per_dev = {}
+    for path, n in needs:
+        folder = os.path.dirname(os.path.abspath(path))
+        dev = os.stat(folder).st_dev
+        entry = per_dev.setdefault(dev, [folder, 0])
+        entry[1] += n
+    for folder, n in per_dev.values():
+        free = shutil.disk_usage(folder).free
+        if n > free:
+            raise Exception(f"not enough free disk space in {folder}: need {_gib(n)}, {_gib(free)} available")
+
+
+class OutputWriter:
+    """ An output file opened once and written with positional writes from any thread.
+
+    Finished ranges are reported with commit(); when they reach the range
+    journal depends on the durability policy:
+      - "always": fsync, then journal, for every range;
+      - "checkpoint": ranges are batched and journaled after one fsync per
+        CHECKPOINT_BYTES / CHECKPOINT_SECS, so at most one checkpoint is lost
+        on power failure;
+      - "none": journaled right away without any fsync (survives a killed
+        process, not a power loss).
+    `on_write(offset, n)` is called after every write, e.g. to let readers
+    follow data that is not journaled yet.
+    """
+    def __init__(self, path: str, jr=None, sync: str = "checkpoint", on_write=None):
+        if sync not in SYNC_POLICIES:
+            raise ValueError(f"unknown sync policy: {sync}")
+        self.path = path
+        self.jr = jr
+        self.sync = sync
+        self.on_write = on_write
+        self.fd = os.open(path, os.O_RDWR | getattr(os, "O_BINARY", 0))
+        self.pool = BufferPool()
+        self.writes = 0
+        self.fsyncs = 0
+        self._lock = threading.Lock()
+        self._pending = []
+        self._pending_bytes = 0
+        self._last_sync = time.monotonic()
+
+    def pwrite(self, data, offset: int):
+        """ Write all of `data` at `offset` (os.pwrite, or lseek+write where unavailable). """
+        view = memoryview(data)
+        start = offset
+        while len(view):
+            if hasattr(os, "pwrite"):
+                n = os.pwrite(self.fd, view, offset)
+            else:
+                with self._lock:
+                    os.lseek(self.fd, offset, os.SEEK_SET)
+                    n = os.write(self.fd, view)
+            self.writes += 1
+            view = view[n:]
+            offset += n
+        if self.on_write is not None:
+            self.on_write(start, offset - start)
+
+    def buffer(self, offset: int) -> "CoalescingBuffer":
+        """ A per-worker buffer (from the pool) for a sequential stream starting at `offset`. """
+        return CoalescingBuffer(self, offset)
+
+    def commit(self, st: int, en: int):
+        """ Report [st, en] as written; it reaches the journal per the sync policy. """
+        if st > en:
+            return
+        if self.sync == "always":
+            self._fsync()
+            if self.jr is not None:
+                self.jr.commit(st, en)
+            return
+        if self.sync == "none":
+            if self.jr is not None:
+                self.jr.commit_many([(st, en)], sync=False)
+            return
+        with self._lock:
+            self._pending.append((st, en))
+            self._pending_bytes += en - st + 1
+            due = (self._pending_bytes >= CHECKPOINT_BYTES
+                   or time.monotonic() - self._last_sync >= CHECKPOINT_SECS)
+        if due:
+            self.checkpoint()
+
+    def checkpoint(self):
+        """ fsync the data, then journal every range committed since the last checkpoint. """
+        with self._lock:
+            pending, self._pending = self._pending, []
+            self._pending_bytes = 0
+            self._last_sync = time.monotonic()
+        if self.sync != "none":
+            self._fsync()
+        if pending and self.jr is not None:
+            self.jr.commit_many(pending, sync=self.sync != "none")
+
+    def _fsync(self):
+        os.fsync(self.fd)
+        self.fsyncs += 1
+
+    def close(self):
+        """ Final checkpoint and close. """
+        if self.fd is None:
+            return
+        try:
+            self.checkpoint()
+        finally:
+            os.close(self.fd)
+            self.fd = None
+
+
+class BufferPool:
+    """ Reusable COALESCE-sized bytearrays. A buffer is created only when none is
+    free, so memory stays at (concurrent streams) x COALESCE whatever the file size. """
+    def __init__(self, size: int = COALESCE):
+        self.size = size
+        self.created = 0
+        self._free = []
+        self._lock = threading.Lock()
+
+    def get(self) -> bytearray:
+        with self._lock:
+            if self._free:
+                return self._free.pop()
+            self.created += 1
+        return bytearray(self.size)
+
+    def put(self, buf: bytearray):
+        with self._lock:
+            self._free.append(buf)
+
+
+class CoalescingBuffer:
+    """ A pooled buffer for one sequential stream, written with one pwrite per COALESCE bytes.
+
+    Data is received in place into space() and accounted with advance(n), or
+    copied in with add(). close() writes what is left and returns the buffer
+    to the pool; `offset` is the file position after the data written so far.
+    """
+    def __init__(self, writer: OutputWriter, offset: int):
+        self.writer = writer
+        self.offset = offset
+        self._buf = writer.pool.get()
+        self._view = memoryview(self._buf)
+        self._fill = 0
+
+    def space(self) -> memoryview:
+        """ The free part of the buffer (never empty). """
+        return self._view[self._fill:]
+
+    def advance(self, n: int):
+        """ `n` bytes were placed at the start of space(). """
+        self._fill += n
+        if self._fill >= len(self._view):
+            self.flush()
+
+    def add(self, data):
+        data = memoryview(data)
+        while len(data):
+            n = min(len(data), len(self._view) - self._fill)
+            self._view[self._fill:self._fill + n] = data[:n]
+            data = data[n:]
+            self.advance(n)
+
+    def flush(self):
+        if self._fill:
+            self.writer.pwrite(self._view[:self._fill], self.offset)
+            self.offset += self._fill
+            self._fill = 0
+
+    def close(self):
+        if self._buf is None:
+            return
+        try:
+            self.flush()
+        finally:
+            self.writer.pool.put(self._buf)
+            self._buf = self._view = None
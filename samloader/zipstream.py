@@ -0,0 +1,221 @@
+# SPDX-License-Identifier: GPL-3.0+
+
+""" Streaming ZIP extraction: members are read from their local headers in order,
+so the archive never has to exist as a file (see decrypt --extract). """
+
+import fnmatch
+import os
+import struct
+import zlib
+from dataclasses import dataclass
+from typing import List, Optional
+
+LOCAL_SIG = b"PK\x03\x04"
+DESCRIPTOR_SIG = b"PK\x07\x08"
+ZIP64_EXTRA = 0x0001
+STORED = 0
+DEFLATED = 8
+COPY_CHUNK = 8 * 1024 * 1024
+
+_LOCAL = struct.Struct("<HHHHHIIIHH")  # after the signature
+
+
+@dataclass
+class Member:
+    """ A ZIP member as described by its local header (or central directory entry). """
+    name: str
+    method: int
+    flags: int
+    crc: int
+    compressed_size: int
+    size: int
+    offset: int = 0  # of the local header (central directory entries only)
+    zip64: bool = False
+
+
+def decode_name(raw: bytes, flags: int) -> str:
+    return raw.decode("utf-8" if flags & 0x800 else "cp437", "replace")
+
+
+def parse_zip64_extra(extra: bytes, values: List[int]) -> List[int]:
+    """ Replace the 0xFFFFFFFF entries of `values` (in ZIP64 extra field order:
+    size, compressed size, header offset) with the values of the ZIP64 extra field. """
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, n = struct.unpack_from("<HH", extra, pos)
+        if tag == ZIP64_EXTRA:
+            data = extra[pos + 4:pos + 4 + n]
+            idx = 0
+            out = list(values)
+            for i, v in enumerate(values):
+                if v == 0xFFFFFFFF and idx + 8 <= len(data):
+                    out[i] = struct.unpack_from("<Q", data, idx)[0]
+                    idx += 8
+            return out
+        pos += 4 + n
+    return values
+
+
+def matches(name: str, patterns: Optional[List[str]]) -> bool:
+    """ True if `name` (or its base name) matches one of the glob `patterns`; no patterns match everything. """
+    if not patterns:
+        return True
+    base = name.rsplit("/", 1)[-1]
+    return any(fnmatch.fnmatch(name, p) or fnmatch.fnmatch(base, p) for p in patterns)
+
+
+def safe_path(dest: str, name: str) -> str:
+    """ Where member `name` goes under `dest`; raises for absolute or escaping paths. """
+    parts = [p for p in name.replace("\\", "/").split("/") if p not in ("", ".")]
+    if not parts or ".." in parts or name.startswith(("/", "\\")) or ":" in parts[0]:
+        raise Exception(f"refusing to extract unsafe member name: {name!r}")
+    return os.path.join(dest, *parts)
+
+
+class _Source:
+    """ A readable stream with push-back (for data read past a deflate stream's end). """
+    def __init__(self, fh):
+        self.fh = fh
+        self._pending = b""
+
+    def read(self, n: int) -> bytes:
+        if self._pending:
+            data, self._pending = self._pending[:n], self._pending[n:]
+            if len(data) < n:
+                data += self.fh.read(n - len(data))
+            return data
+        return self.fh.read(n)
+
+    def read_exact(self, n: int) -> bytes:
+        data = self.read(n)
+        while len(data) < n:
+            more = self.fh.read(n - len(data))
+            if not more:
+                raise Exception("unexpected end of ZIP data")
+            data += more
+        return data
+
+    def unread(self, data: bytes):
+        self._pending = data + self._pending
+
+    def skip(self, n: int):
+        if self._pending:
+            k = min(n, len(self._pending))
+            self._pending = self._pending[k:]
+            n -= k
+        if n and self.fh.seekable():
+            self.fh.seek(n, os.SEEK_CUR)
+            return
+        while n:
+            data = self.fh.read(min(COPY_CHUNK, n))
+            if not data:
+                raise Exception("unexpected end of ZIP data")
+            n -= len(data)
+
+
+def _copy_stored(src: _Source, n: int, out, crc: int) -> int:
+    while n:
+        data = src.read(min(COPY_CHUNK, n))
+        if not data:
+            raise Exception("unexpected end of ZIP data")
+        n -= len(data)
+        crc = zlib.crc32(data, crc)
+        if out is not None:
+            out.write(data)
+    return crc
+
+
+def _copy_deflated(src: _Source, known: Optional[int], out, crc: int) -> int:
+    d = zlib.decompressobj(-15)
+    left = known
+    while not d.eof:
+        data = src.read(COPY_CHUNK if left is None else min(COPY_CHUNK, left))
+        if not data:
+            raise Exception("unexpected end of ZIP data")
+        if left is not None:
+            left -= len(data)
+        plain = d.decompress(data)
+        crc = zlib.crc32(plain, crc)
+        if out is not None:
+            out.write(plain)
+    if d.unused_data:
+        src.unread(d.unused_data)
+    if left:
+        src.skip(left)
+    return crc
+
+
+def copy_data(fh, method: int, compressed_size: int, out) -> int:
+    """ Copy the data of a member starting at the position of `fh` to `out`,
+    decompressing it; returns its CRC32. """
+    if method == STORED:
+        return _copy_stored(_Source(fh), compressed_size, out, 0)
+    if method == DEFLATED:
+        return _copy_deflated(_Source(fh), compressed_size, out, 0)
+    raise Exception(f"unsupported compression method {method}")
+
+
+def extract(fh, dest: str, patterns: Optional[List[str]] = None, log=print) -> List[str]:
+    """ Extract the members of the ZIP archive read sequentially from `fh` into
+    `dest`, only those matching `patterns` (globs on the name or base name) if
+    given. Members are CRC-checked; skipped members are passed over without
+    decompressing (seeked over when `fh` is seekable) unless their size is only
+    given by a data descriptor. Returns the paths written. """
+    src = _Source(fh)
+    written = []
+    while True:
+        sig = src.read(4)
+        if sig != LOCAL_SIG:
+            break  # central directory (or end of data): no more members
+        ver, flags, method, _t, _d, crc, csize, size, nlen, elen = _LOCAL.unpack(src.read_exact(_LOCAL.size))
+        name = decode_name(src.read_exact(nlen), flags)
+        extra = src.read_exact(elen)
+        size, csize = parse_zip64_extra(extra, [size, csize])
+        zip64 = any(tag == ZIP64_EXTRA for tag in _extra_tags(extra))
+        if flags & 0x1:
+            raise Exception(f"{name}: encrypted ZIP members are not supported")
+        descriptor = bool(flags & 0x8)
+        if method not in (STORED, DEFLATED):
+            raise Exception(f"{name}: unsupported compression method {method}")
+        if method == STORED and descriptor and not csize:
+            raise Exception(f"{name}: stored member without sizes is not supported")
+        wanted = not name.endswith("/") and matches(name, patterns)
+        target = safe_path(dest, name) if wanted else None
+        if not wanted and (method == STORED or csize):
+            # The compressed size is known: no need to inflate a member that is not kept
+            src.skip(csize)
+        else:
+            out = None
+            if target is not None:
+                os.makedirs(os.path.dirname(target), exist_ok=True)
+                log(f"extracting {name}")
+                out = open(target + ".part", "wb")
+            try:
+                if method == STORED:
+                    got = _copy_stored(src, csize, out, 0)
+                else:
+                    got = _copy_deflated(src, None if descriptor and not csize else csize, out, 0)
+            finally:
+                if out is not None:
+                    out.close()
+        if descriptor:
+            head = src.read_exact(4)
+            if head != DESCRIPTOR_SIG:
+                src.unread(head)
+            desc = src.read_exact(20 if zip64 else 12)
+            crc = struct.unpack_from("<I", desc)[0]
+        if target is not None:
+            if got != crc:
+                os.remove(target + ".part")
+                raise Exception(f"{name}: CRC mismatch (corrupt data or wrong key?)")
+            os.replace(target + ".part", target)
+            written.append(target)
+    return written
+
+
+def _extra_tags(extra: bytes):
+    pos = 0
+    while pos + 4 <= len(extra):
+        tag, n = struct.unpack_from("<HH", extra, pos)
+        yield tag
+        pos += 4 + n
@@ -36,5 +36,8 @@ setuptools.setup(
         "requests",
         "PyQt6"
     ],
+    extras_require={
+        "lz4": ["lz4"],
+    },
     python_requires='>=3.6',
 )